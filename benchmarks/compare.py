@@ -0,0 +1,70 @@
+"""
+Diffs two benchmark result files produced by benchmarks.run.
+
+    python -m benchmarks.compare base.json new.json [--fail-over 10]
+
+Prints every numeric metric that exists in both files with its relative
+change. With --fail-over, exits non-zero when any latency (*_ms) metric got
+slower, or any throughput (*_per_sec) metric got worse, by more than that
+many percent.
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    if isinstance(results, list):
+        results = {str(i): item for i, item in enumerate(results)}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if key == "meta":
+            continue
+        if isinstance(value, (dict, list)):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def regression(name: str, change: float) -> float:
+    """
+    How much worse the metric got, in percent; negative means it improved.
+    """
+    if name.endswith("_ms"):
+        return change
+    if name.endswith("_per_sec"):
+        return -change
+    return 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--fail-over", type=float, default=None)
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = flatten(json.load(f))
+    with open(args.new) as f:
+        new = flatten(json.load(f))
+
+    failed = []
+    print(f"{'metric':<90} {'base':>12} {'new':>12} {'change':>9}")
+    for name in sorted(base.keys() & new.keys()):
+        change = (new[name] - base[name]) / base[name] * 100 if base[name] else 0.0
+        print(f"{name:<90} {base[name]:>12.3f} {new[name]:>12.3f} {change:>+8.1f}%")
+        if args.fail_over is not None and regression(name, change) > args.fail_over:
+            failed.append(name)
+
+    if failed:
+        print(f"\n{len(failed)} metrics regressed by more than {args.fail_over}%:")
+        for name in failed:
+            print(f"  {name}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
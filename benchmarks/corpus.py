@@ -0,0 +1,39 @@
+import random
+import string
+from typing import List, Tuple
+
+
+class SyntheticCorpus:
+    """
+    Deterministic ASCII corpus. Word frequencies follow a Zipf-like
+    distribution so queries hit some terms far more often than others, the
+    way real documents do.
+    """
+    def __init__(self, seed: int = 0, vocabulary_size: int = 5000):
+        self.rng = random.Random(seed)
+        self.vocabulary = [
+            "".join(self.rng.choices(string.ascii_lowercase, k=self.rng.randint(3, 10)))
+            for _ in range(vocabulary_size)
+        ]
+        self.weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+
+    def words(self, n: int) -> List[str]:
+        return self.rng.choices(self.vocabulary, weights=self.weights, k=n)
+
+    def document(self, size_bytes: int) -> str:
+        text = []
+        length = 0
+        while length < size_bytes:
+            sentence = " ".join(self.words(self.rng.randint(6, 20))).capitalize() + ". "
+            text.append(sentence)
+            length += len(sentence)
+        return "".join(text)[:size_bytes]
+
+    def documents(self, n: int, size_bytes: int, start: int = 0) -> List[Tuple[str, str]]:
+        """
+        (file name, text) pairs, named so that successive calls don't collide.
+        """
+        return [(f"bench_{i:07d}.txt", self.document(size_bytes)) for i in range(start, start + n)]
+
+    def queries(self, n: int) -> List[str]:
+        return [" ".join(self.words(self.rng.randint(3, 8))) for _ in range(n)]
@@ -0,0 +1,261 @@
+"""
+Load and throughput benchmark for the document ingest API.
+
+Runs the app against local stand-ins (see stand_ins.py), ingests synthetic
+corpora of increasing size through the upload endpoint, then measures
+/search and the conversation endpoints at each requested concurrency.
+Results are written as JSON for diffing between releases with compare.py,
+and the generated requests can be recorded in requests.jsonl format and
+replayed later.
+
+    python -m benchmarks.run --docs 100,1000 --concurrency 1,8,32 --out results.json
+    python -m benchmarks.run --docs 1000 --record requests.jsonl
+    python -m benchmarks.run --docs 1000 --replay requests.jsonl
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import httpx
+
+from .corpus import SyntheticCorpus
+from .stand_ins import DEFAULT_DATABASE_URL, ServerThread, StandIns
+from .workload import RequestLog, latency_stats, read_request_log, request_entry, run_requests
+
+
+CHUNK_SIZE = 1024
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+async def create_fixture(client: httpx.AsyncClient, users: int) -> Dict[str, str]:
+    """
+    One organization with `users` members. Returns placeholder name -> id.
+    """
+    fixture = {}
+    org = (await client.post("/organizations/create", json={"name": "bench-org"})).json()
+    fixture["org_0"] = org["id"]
+    for i in range(users):
+        user = (await client.post("/users/create", json={
+            "username": f"bench-user-{i}",
+            "email": f"bench-user-{i}@example.com",
+            "organization_id": org["id"],
+        })).json()
+        fixture[f"user_{i}"] = user["id"]
+    return fixture
+
+
+async def ingest(client: httpx.AsyncClient, fixture: Dict[str, str], documents, users: int, concurrency: int) -> dict:
+    """
+    Uploads the documents round-robin across the users (every fifth goes to
+    the organization). Tasks run eagerly, so each upload returns once its
+    chunks are embedded and committed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def upload(i: int, name: str, body: str):
+        nonlocal errors
+        if i % 5 == 4:
+            owner_id, owner_type = fixture["org_0"], "organization"
+        else:
+            owner_id, owner_type = fixture[f"user_{i % users}"], "user"
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(
+                f"/files/{owner_id}/uploadFile",
+                params={"owner_type": owner_type},
+                files={"file": (name, body.encode("utf-8"), "text/plain")},
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(upload(i, name, body) for i, (name, body) in enumerate(documents)))
+    elapsed = time.perf_counter() - start
+
+    total_bytes = sum(len(body) for _, body in documents)
+    total_chunks = sum(math.ceil(len(body) / CHUNK_SIZE) for _, body in documents)
+    return {
+        "documents": len(documents),
+        "chunks": total_chunks,
+        "bytes": total_bytes,
+        "seconds": elapsed,
+        "docs_per_sec": len(documents) / elapsed,
+        "chunks_per_sec": total_chunks / elapsed,
+        "errors": errors,
+        "upload_latency": latency_stats(latencies),
+    }
+
+
+def search_entries(corpus: SyntheticCorpus, users: int, queries: int) -> List[dict]:
+    return [
+        request_entry("GET /search/{user_id}", "GET", f"/search/{{user_{i % users}}}", params={"query": query})
+        for i, query in enumerate(corpus.queries(queries))
+    ]
+
+
+async def create_conversations(client: httpx.AsyncClient, fixture: Dict[str, str], users: int,
+                               conversations: int, messages: int) -> None:
+    """
+    Conversations over a few of each user's documents, with answered messages.
+    Adds conversation_N placeholders to the fixture.
+    """
+    from doc_ingest_app.tasks import respond_to_message
+
+    for i in range(conversations):
+        user_id = fixture[f"user_{i % users}"]
+        files = (await client.get(f"/users/{user_id}/getFiles")).json()
+        conversation = (await client.post(f"/conversations/{user_id}/entry", json={
+            "query": "opening question",
+            "document_ids": [file["id"] for file in files[:5]],
+        })).json()
+        fixture[f"conversation_{i}"] = conversation["id"]
+        for j in range(messages):
+            message = (await client.post(f"/conversations/{conversation['id']}/message",
+                                         json={"query": f"question {j}"})).json()
+            respond_to_message.delay(message["id"], conversation["id"], f"answer {j} " * 20)
+
+
+def conversation_entries(corpus: SyntheticCorpus, conversations: int, requests: int) -> List[dict]:
+    entries = []
+    for i in range(requests):
+        conversation = f"{{conversation_{i % conversations}}}"
+        kind = i % 4
+        if kind == 0:
+            entries.append(request_entry("GET /conversations/{conversation_id}", "GET",
+                                         f"/conversations/{conversation}"))
+        elif kind == 1:
+            entries.append(request_entry("GET /conversations/{conversation_id}?since", "GET",
+                                         f"/conversations/{conversation}",
+                                         params={"since": datetime.now(timezone.utc).replace(tzinfo=None).isoformat()}))
+        elif kind == 2:
+            entries.append(request_entry("GET /conversations/{conversation_id}/search", "GET",
+                                         f"/conversations/{conversation}/search",
+                                         params={"query": corpus.queries(1)[0]}))
+        else:
+            entries.append(request_entry("POST /conversations/{conversation_id}/message", "POST",
+                                         f"/conversations/{conversation}/message",
+                                         json_body={"query": corpus.queries(1)[0]}))
+    return entries
+
+
+async def etag_revalidation(client: httpx.AsyncClient, fixture: Dict[str, str], conversations: int) -> dict:
+    """
+    Latency of conditional GETs that come back 304.
+    """
+    latencies = []
+    for i in range(conversations):
+        path = f"/conversations/{fixture[f'conversation_{i}']}"
+        etag = (await client.get(path)).headers.get("etag")
+        start = time.perf_counter()
+        response = await client.get(path, headers={"If-None-Match": etag})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 304:
+            return {"error": f"expected 304, got {response.status_code}"}
+    return latency_stats(latencies)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_benchmark(args, base_url: str) -> dict:
+    corpus = SyntheticCorpus(seed=args.seed)
+    log = RequestLog(args.record)
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "corpora": [],
+    }
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        fixture = await create_fixture(client, args.users)
+
+        ingested = 0
+        for size in sorted(args.docs):
+            documents = corpus.documents(size - ingested, args.doc_bytes, start=ingested)
+            corpus_results = {"documents": size, "ingest": await ingest(client, fixture, documents, args.users, args.ingest_concurrency)}
+            ingested = size
+
+            corpus_results["search"] = {}
+            for concurrency in args.concurrency:
+                entries = search_entries(corpus, args.users, args.queries)
+                corpus_results["search"][str(concurrency)] = await run_requests(client, entries, fixture, concurrency, log)
+            results["corpora"].append(corpus_results)
+
+        await create_conversations(client, fixture, args.users, args.conversations, args.messages)
+        results["conversations"] = {"etag_304": await etag_revalidation(client, fixture, args.conversations)}
+        for concurrency in args.concurrency:
+            entries = conversation_entries(corpus, args.conversations, args.conversation_requests)
+            results["conversations"][str(concurrency)] = await run_requests(client, entries, fixture, concurrency, log)
+
+        if args.replay:
+            entries = read_request_log(args.replay)
+            results["replay"] = {
+                str(concurrency): await run_requests(client, entries, fixture, concurrency)
+                for concurrency in args.concurrency
+            }
+
+        results["search_cache"] = (await client.get("/search/cache/stats")).json()
+        results["replicas"] = (await client.get("/admin/db/replicas")).json()
+
+    log.close()
+    results["meta"]["finished_at"] = datetime.now(timezone.utc).isoformat()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL,
+                        help="local Postgres with pgvector, the database is rebuilt on every run")
+    parser.add_argument("--redis-url", default=None, help="local Redis, fakeredis is used when omitted")
+    parser.add_argument("--replica-url", action="append", default=[],
+                        help="streaming replica of --database-url for read-only routes, repeatable")
+    parser.add_argument("--docs", type=int_list, default=[100], help="comma separated corpus sizes")
+    parser.add_argument("--doc-bytes", type=int, default=8192)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--ingest-concurrency", type=int, default=1)
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8], help="comma separated")
+    parser.add_argument("--queries", type=int, default=200, help="searches per corpus size and concurrency")
+    parser.add_argument("--conversations", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20, help="answered messages per conversation")
+    parser.add_argument("--conversation-requests", type=int, default=200)
+    parser.add_argument("--record", help="write the generated requests to this requests.jsonl file")
+    parser.add_argument("--replay", help="replay a requests.jsonl file after the generated workload")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    with StandIns(args.database_url, args.redis_url, args.replica_url):
+        from doc_ingest_app.main import app
+
+        with ServerThread(app, port=args.port) as server:
+            results = asyncio.run(run_benchmark(args, server.base_url))
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
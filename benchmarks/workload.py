@@ -0,0 +1,116 @@
+import asyncio
+import json
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+import httpx
+
+
+def latency_stats(latencies: List[float], elapsed: Optional[float] = None) -> dict:
+    """
+    Summary of a list of latencies in seconds, reported in milliseconds.
+    """
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))] * 1000
+
+    stats = {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+    if elapsed:
+        stats["requests_per_sec"] = len(ordered) / elapsed
+    return stats
+
+
+def request_entry(route: str, method: str, path: str, params: Optional[dict] = None,
+                  json_body=None, headers: Optional[dict] = None) -> dict:
+    """
+    One request in requests.jsonl format. `path` may contain placeholders such
+    as {user_0} that are filled in from the fixture when the log is replayed,
+    so a log recorded in one environment replays in another.
+    """
+    entry = {"route": route, "method": method, "path": path}
+    if params:
+        entry["params"] = params
+    if json_body is not None:
+        entry["json"] = json_body
+    if headers:
+        entry["headers"] = headers
+    return entry
+
+
+def fill_placeholders(value, fixture: Dict[str, str]):
+    if isinstance(value, str):
+        return value.format(**fixture)
+    if isinstance(value, list):
+        return [fill_placeholders(item, fixture) for item in value]
+    if isinstance(value, dict):
+        return {key: fill_placeholders(item, fixture) for key, item in value.items()}
+    return value
+
+
+def read_request_log(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RequestLog:
+    """
+    Appends every request the benchmark issues to a requests.jsonl file.
+    """
+    def __init__(self, path: Optional[str]):
+        self.file = open(path, "w") if path else None
+
+    def write(self, entry: dict):
+        if self.file:
+            self.file.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+async def run_requests(client: httpx.AsyncClient, entries: Iterable[dict], fixture: Dict[str, str],
+                       concurrency: int, log: Optional[RequestLog] = None) -> dict:
+    """
+    Issues the requests with at most `concurrency` in flight and returns
+    latency stats per route, plus error counts.
+    """
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def issue(entry: dict):
+        async with semaphore:
+            if log:
+                log.write(entry)
+            start = time.perf_counter()
+            response = await client.request(
+                entry["method"],
+                fill_placeholders(entry["path"], fixture),
+                params=fill_placeholders(entry.get("params"), fixture),
+                json=fill_placeholders(entry.get("json"), fixture),
+                headers=entry.get("headers")
+            )
+            latencies[entry["route"]].append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[entry["route"]] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(issue(entry) for entry in entries))
+    elapsed = time.perf_counter() - start
+
+    return {
+        route: {**latency_stats(values, elapsed), "errors": errors[route]}
+        for route, values in latencies.items()
+    }
@@ -0,0 +1,224 @@
+import json
+import logging
+from typing import List, NamedTuple, Optional
+from uuid import UUID
+
+import redis
+from prometheus_client import Counter
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+
+# the whole ingest pipeline: uploads are rejected with 429 beyond these
+INGEST_MAX_QUEUE_DEPTH = 1000
+INGEST_MAX_INFLIGHT_BYTES = 2 * 1024 ** 3
+# one owner's share of it, further uploads wait in the owner's own backlog
+OWNER_MAX_INFLIGHT_FILES = 20
+OWNER_MAX_INFLIGHT_BYTES = INGEST_MAX_INFLIGHT_BYTES // 10
+# uploads beyond this many deferred files are rejected
+OWNER_MAX_DEFERRED = 500
+UPLOAD_RETRY_AFTER_SECONDS = 30
+# counters left behind by a crashed worker reset once nothing touched them for this long
+INFLIGHT_KEY_TTL = 3600
+
+INFLIGHT_BYTES_KEY = "ingest:inflight_bytes"
+OWNER_INFLIGHT_BYTES_KEY = "ingest:inflight_bytes:{}"
+OWNER_INFLIGHT_FILES_KEY = "ingest:inflight_files:{}"
+OWNER_DEFERRED_KEY = "ingest:deferred:{}"
+# owners that have had a backlog since it was last found empty
+DEFERRED_OWNERS_KEY = "ingest:deferred_owners"
+# set once a file's reservation was handed back, so a rerun of its ingest doesn't do it twice
+RELEASED_KEY = "ingest:released:{}"
+
+UPLOAD_ADMISSIONS = Counter(
+    "upload_admissions_total", "Upload admission decisions", ["decision", "reason"]
+)
+
+# KEYS: global bytes, owner bytes, owner files, owner deferred
+# ARGV: size, max global bytes, max owner files, max owner bytes, max deferred, ttl
+ADMIT_SCRIPT = """
+local size = tonumber(ARGV[1])
+local global_bytes = tonumber(redis.call('GET', KEYS[1]) or '0')
+local owner_bytes = tonumber(redis.call('GET', KEYS[2]) or '0')
+local owner_files = tonumber(redis.call('GET', KEYS[3]) or '0')
+local deferred = redis.call('LLEN', KEYS[4])
+
+if global_bytes + size > tonumber(ARGV[2]) then
+    return {'reject', 'inflight_bytes'}
+end
+-- a single file larger than the owner's share still goes through when nothing else of theirs is queued
+local over_share = owner_files >= tonumber(ARGV[3])
+    or (owner_files > 0 and owner_bytes + size > tonumber(ARGV[4]))
+-- a backlog with nothing of theirs in flight has no ingest left to drain it, this upload will
+if (deferred > 0 and owner_files > 0) or over_share then
+    if deferred >= tonumber(ARGV[5]) then
+        return {'reject', 'owner_backlog'}
+    end
+    return {'defer', 'fair_share'}
+end
+
+redis.call('INCRBY', KEYS[1], size)
+redis.call('INCRBY', KEYS[2], size)
+redis.call('INCR', KEYS[3])
+for i = 1, 3 do redis.call('EXPIRE', KEYS[i], ARGV[6]) end
+return {'enqueue', 'ok'}
+"""
+
+# KEYS: global bytes, owner bytes, owner files, optionally the file's released marker
+# ARGV: size, ttl
+RELEASE_SCRIPT = """
+if KEYS[4] and not redis.call('SET', KEYS[4], 1, 'NX', 'EX', ARGV[2]) then
+    return 0
+end
+local size = tonumber(ARGV[1])
+if redis.call('DECRBY', KEYS[1], size) < 0 then redis.call('SET', KEYS[1], 0) end
+if redis.call('DECRBY', KEYS[2], size) < 0 then redis.call('DEL', KEYS[2]) end
+if redis.call('DECR', KEYS[3]) <= 0 then redis.call('DEL', KEYS[3]) end
+return 1
+"""
+
+# KEYS: global bytes, owner bytes, owner files, owner deferred, deferred owners
+# ARGV: ttl, owner id, 1 to only take one when nothing of the owner's is in flight
+TAKE_DEFERRED_SCRIPT = """
+if ARGV[3] == '1' and tonumber(redis.call('GET', KEYS[3]) or '0') > 0 then
+    return false
+end
+local item = redis.call('LPOP', KEYS[4])
+if not item then
+    redis.call('SREM', KEYS[5], ARGV[2])
+    return false
+end
+local size = tonumber(cjson.decode(item)['size'])
+redis.call('INCRBY', KEYS[1], size)
+redis.call('INCRBY', KEYS[2], size)
+redis.call('INCR', KEYS[3])
+for i = 1, 3 do redis.call('EXPIRE', KEYS[i], ARGV[1]) end
+return item
+"""
+
+
+class Admission(NamedTuple):
+    decision: str  # enqueue, defer or reject
+    reason: str
+    retry_after: Optional[int] = None
+
+
+def _owner_keys(owner_id: UUID) -> list:
+    return [
+        INFLIGHT_BYTES_KEY,
+        OWNER_INFLIGHT_BYTES_KEY.format(owner_id),
+        OWNER_INFLIGHT_FILES_KEY.format(owner_id),
+        OWNER_DEFERRED_KEY.format(owner_id),
+    ]
+
+
+def admit_upload(owner_id: UUID, size: int, queue_depth: Optional[int]) -> Admission:
+    """
+    Decides what happens to an upload before it is stored. `enqueue` reserves
+    its bytes against the global and owner budgets, the caller must hand
+    them back through release_upload if the file never reaches the queue.
+    Uploads are admitted when Redis can't be asked.
+    """
+    if queue_depth is not None and queue_depth >= INGEST_MAX_QUEUE_DEPTH:
+        admission = Admission("reject", "queue_depth", UPLOAD_RETRY_AFTER_SECONDS)
+    else:
+        try:
+            decision, reason = cache.redis_client.eval(
+                ADMIT_SCRIPT, 4, *_owner_keys(owner_id),
+                size, INGEST_MAX_INFLIGHT_BYTES, OWNER_MAX_INFLIGHT_FILES,
+                OWNER_MAX_INFLIGHT_BYTES, OWNER_MAX_DEFERRED, INFLIGHT_KEY_TTL
+            )
+            decision, reason = decision.decode(), reason.decode()
+        except redis.RedisError as e:
+            logger.warning("Could not run upload admission for owner %s: %s", owner_id, e)
+            decision, reason = "enqueue", "redis_unavailable"
+        admission = Admission(decision, reason, UPLOAD_RETRY_AFTER_SECONDS if decision == "reject" else None)
+    UPLOAD_ADMISSIONS.labels(admission.decision, admission.reason).inc()
+    return admission
+
+
+def defer_upload(owner_id: UUID, size: int, task_kwargs: dict, front: bool = False) -> bool:
+    """
+    Parks an upload in the owner's backlog, at its head with `front`, e.g.
+    for one taken from it that couldn't be queued. It is queued by
+    take_deferred when one of the owner's running ingests finishes, or by
+    the periodic drain when none is left to. Returns False when the backlog
+    can't be written and the upload should be queued directly.
+    """
+    item = json.dumps({"size": size, "kwargs": task_kwargs}, default=str)
+    try:
+        pipeline = cache.redis_client.pipeline()
+        key = OWNER_DEFERRED_KEY.format(owner_id)
+        if front:
+            pipeline.lpush(key, item)
+        else:
+            pipeline.rpush(key, item)
+        pipeline.sadd(DEFERRED_OWNERS_KEY, str(owner_id))
+        pipeline.execute()
+    except redis.RedisError as e:
+        logger.warning("Could not defer upload for owner %s: %s", owner_id, e)
+        return False
+    return True
+
+
+def release_upload(owner_id: UUID, size: int, file_id: Optional[UUID] = None) -> bool:
+    """
+    Hands an upload's reservation back. With `file_id` it happens at most
+    once per file, returns False when it already did.
+    """
+    keys = _owner_keys(owner_id)[:3]
+    if file_id is not None:
+        keys.append(RELEASED_KEY.format(file_id))
+    try:
+        return bool(cache.redis_client.eval(RELEASE_SCRIPT, len(keys), *keys, size, INFLIGHT_KEY_TTL))
+    except redis.RedisError as e:
+        logger.warning("Could not release in-flight upload for owner %s: %s", owner_id, e)
+        return True
+
+
+def take_deferred(owner_id: UUID, idle_only: bool = False) -> Optional[dict]:
+    """
+    Pops the owner's oldest deferred upload and reserves its bytes, returns
+    its task kwargs and size, or None when the backlog is empty. With
+    `idle_only`, also None while any of the owner's uploads is in flight.
+    """
+    try:
+        item = cache.redis_client.eval(
+            TAKE_DEFERRED_SCRIPT, 5, *_owner_keys(owner_id), DEFERRED_OWNERS_KEY,
+            INFLIGHT_KEY_TTL, str(owner_id), int(idle_only)
+        )
+    except redis.RedisError as e:
+        logger.warning("Could not take deferred upload for owner %s: %s", owner_id, e)
+        return None
+    return json.loads(item) if item else None
+
+
+def deferred_owners() -> List[str]:
+    try:
+        return [owner_id.decode() for owner_id in cache.redis_client.smembers(DEFERRED_OWNERS_KEY)]
+    except redis.RedisError as e:
+        logger.warning("Could not list owners with deferred uploads: %s", e)
+        return []
+
+
+def admission_state(owner_id: Optional[UUID] = None) -> dict:
+    keys = [INFLIGHT_BYTES_KEY]
+    if owner_id:
+        keys += [OWNER_INFLIGHT_BYTES_KEY.format(owner_id), OWNER_INFLIGHT_FILES_KEY.format(owner_id)]
+    values = [int(value or 0) for value in cache.redis_client.mget(keys)]
+    state = {
+        "inflight_bytes": values[0],
+        "max_inflight_bytes": INGEST_MAX_INFLIGHT_BYTES,
+        "max_queue_depth": INGEST_MAX_QUEUE_DEPTH,
+    }
+    if owner_id:
+        state["owner"] = {
+            "inflight_bytes": values[1],
+            "inflight_files": values[2],
+            "deferred": cache.redis_client.llen(OWNER_DEFERRED_KEY.format(owner_id)),
+            "max_inflight_bytes": OWNER_MAX_INFLIGHT_BYTES,
+            "max_inflight_files": OWNER_MAX_INFLIGHT_FILES,
+        }
+    return state
@@ -0,0 +1,381 @@
+import logging
+import queue
+import struct
+import threading
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+import orjson
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from .generations import Generation, active_generation, build_generation_index, embedding_column, index_name
+from .models.sql_models import Chunks, Document
+from .partitions import drop_index
+from .vector_tier import OwnerKey, owner_filter
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_FORMAT_VERSION = 1
+# rows fetched per round trip by the export cursors
+EXPORT_BATCH_ROWS = 2000
+# binary exports start with this line, NDJSON ones with the header record
+BINARY_MAGIC = b"DOCEXPORT1\n"
+# COPY output is sent in frames of about this size, at most COPY_QUEUE_FRAMES of them buffered
+COPY_FRAME_BYTES = 64 * 1024
+COPY_QUEUE_FRAMES = 16
+# imports of at least this many chunks drop the ANN index and build it once
+# afterwards, which beats inserting every row into the HNSW graph. The index
+# covers every partition of chunks, so only when the import is also at least
+# REBUILD_INDEX_MIN_SHARE of the rows already there
+REBUILD_INDEX_MIN_CHUNKS = 100_000
+REBUILD_INDEX_MIN_SHARE = 0.5
+
+DOCUMENT_COLUMNS = ["id", "file_name", "user_id", "organization_id", "ingest_profile"]
+CHUNK_COLUMNS = ["id", "document_id", "chunk", "embedding"]
+
+# session scoped so they survive the commit between loading and inserting
+STAGING_SQL = """
+    CREATE TEMP TABLE import_document (
+        id uuid, file_name varchar, user_id uuid, organization_id uuid, ingest_profile jsonb
+    );
+    CREATE TEMP TABLE import_chunks (id uuid, document_id uuid, chunk varchar, embedding vector({dim}));
+"""
+ESTIMATED_CHUNKS_SQL = """
+    SELECT coalesce(sum(greatest(c.reltuples, 0)), 0)::bigint
+    FROM pg_partition_tree('chunks') t
+    JOIN pg_class c ON c.oid = t.relid
+    WHERE t.isleaf
+"""
+MISSING_OWNERS_SQL = """
+    SELECT count(*) FROM import_document i
+    WHERE (i.user_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM user_account u WHERE u.id = i.user_id))
+       OR (i.organization_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM organization o WHERE o.id = i.organization_id))
+"""
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def _header(owner: OwnerKey, generation: Generation) -> dict:
+    kind, owner_id = owner
+    return {
+        "type": "header",
+        "format": EXPORT_FORMAT_VERSION,
+        "owner_type": kind,
+        "owner_id": owner_id,
+        "model_name": generation.model_name,
+        "dim": generation.dim,
+    }
+
+
+def _export_queries(owner: OwnerKey, generation: Generation):
+    documents = (
+        select(Document.id, Document.file_name, Document.user_id, Document.organization_id, Document.ingest_profile)
+        .where(owner_filter(owner))
+    )
+    chunks = (
+        select(Chunks.id, Chunks.document_id, Chunks.chunk, embedding_column(generation).label("embedding"))
+        .join(Document, Chunks.document_id == Document.id)
+        .where(Chunks.owner_id == owner[1], owner_filter(owner))
+    )
+    return documents, chunks
+
+
+def export_ndjson(engine: Engine, owner: OwnerKey, generation: Generation) -> Iterator[bytes]:
+    """
+    The owner's documents, then their chunks with the generation's vectors,
+    one JSON record per line. Rows come from server-side cursors, so memory
+    stays flat whatever the size of the export.
+    """
+    yield orjson.dumps(_header(owner, generation)) + b"\n"
+    documents, chunks = _export_queries(owner, generation)
+    # one snapshot for both queries, so every exported chunk has its document
+    with engine.connect().execution_options(
+        isolation_level="REPEATABLE READ", stream_results=True, yield_per=EXPORT_BATCH_ROWS
+    ) as conn:
+        for kind, stmt in (("document", documents), ("chunk", chunks)):
+            for batch in conn.execute(stmt).partitions():
+                yield b"".join(
+                    orjson.dumps({"type": kind, **row._asdict()}, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+                    for row in batch
+                )
+
+
+class _FrameWriter:
+    """
+    File object handed to COPY ... TO STDOUT: batches what Postgres sends
+    into length-prefixed frames on a bounded queue, so a slow client holds
+    the COPY back instead of letting it fill memory.
+    """
+    def __init__(self, frames: queue.Queue, cancelled: threading.Event):
+        self.frames = frames
+        self.cancelled = cancelled
+        self._buffer = bytearray()
+
+    def put(self, item) -> None:
+        while not self.cancelled.is_set():
+            try:
+                self.frames.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise ExportCancelled()
+
+    def write(self, data: bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) >= COPY_FRAME_BYTES:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer:
+            self.put(struct.pack(">I", len(self._buffer)) + bytes(self._buffer))
+            self._buffer.clear()
+
+    def end_section(self) -> None:
+        self.flush()
+        self.put(struct.pack(">I", 0))
+
+
+def _copy_sql(engine: Engine, stmt) -> Tuple[str, dict]:
+    compiled = stmt.compile(dialect=engine.dialect)
+    # mogrify only sees the raw parameters, without the Uuid type's bind processing
+    params = {key: str(value) if isinstance(value, UUID) else value for key, value in compiled.params.items()}
+    return compiled.string, params
+
+
+def export_binary(engine: Engine, owner: OwnerKey, generation: Generation) -> Iterator[bytes]:
+    """
+    Same content as export_ndjson as two COPY BINARY sections, documents
+    then chunks. Vectors stay in pgvector's binary form, which keeps the
+    export under half the NDJSON size and spares the import from parsing
+    them. Each section is a run of frames (4 byte big-endian length, data)
+    ended by an empty frame.
+    """
+    yield BINARY_MAGIC + orjson.dumps(_header(owner, generation)) + b"\n"
+
+    frames = queue.Queue(maxsize=COPY_QUEUE_FRAMES)
+    cancelled = threading.Event()
+    done = object()
+
+    def produce():
+        writer = _FrameWriter(frames, cancelled)
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            for stmt in _export_queries(owner, generation):
+                sql, params = _copy_sql(engine, stmt)
+                cursor.copy_expert(
+                    f"COPY ({cursor.mogrify(sql, params).decode()}) TO STDOUT WITH (FORMAT binary)", writer
+                )
+                writer.end_section()
+            raw.rollback()
+            writer.put(done)
+        except ExportCancelled:
+            # the COPY was abandoned halfway, don't hand the connection back to the pool
+            raw.invalidate()
+        except Exception as e:
+            raw.invalidate()
+            try:
+                writer.put(e)
+            except ExportCancelled:
+                pass
+        finally:
+            raw.close()
+
+    threading.Thread(target=produce, name="export-copy", daemon=True).start()
+    try:
+        while True:
+            item = frames.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+
+def _copy_text(value) -> bytes:
+    if value is None:
+        return b"\\N"
+    if isinstance(value, list):
+        value = "[" + ",".join(map(str, value)) + "]"
+    elif isinstance(value, dict):
+        value = orjson.dumps(value).decode()
+    else:
+        value = str(value)
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+    ).encode()
+
+
+class _RecordReader:
+    """
+    File object for COPY ... FROM STDIN over the NDJSON records of one type,
+    in COPY's text format. It stops at the first record of another type and
+    keeps that line in `pending` for the next section's reader.
+    """
+    def __init__(self, lines: Iterator[bytes], kind: str, columns: List[str], pending: Optional[bytes] = None):
+        self.lines = lines
+        self.kind = kind
+        self.columns = columns
+        self.pending = pending
+        self._buffer = bytearray()
+        self._done = False
+
+    def _next_row(self) -> Optional[bytes]:
+        while True:
+            line, self.pending = self.pending or next(self.lines, None), None
+            if line is None:
+                return None
+            if not line.strip():
+                continue
+            record = orjson.loads(line)
+            if record.get("type") != self.kind:
+                self.pending = line
+                return None
+            return b"\t".join(_copy_text(record.get(column)) for column in self.columns) + b"\n"
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            row = self._next_row()
+            if row is None:
+                self._done = True
+            else:
+                self._buffer += row
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Export is truncated")
+    return data
+
+
+class _FrameReader:
+    """
+    File object for COPY ... FROM STDIN over one section of a binary export.
+    """
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self._buffer = bytearray()
+        self._done = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            (length,) = struct.unpack(">I", _read_exact(self.stream, 4))
+            if length:
+                self._buffer += _read_exact(self.stream, length)
+            else:
+                self._done = True
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _check_header(header: dict, generation: Generation) -> None:
+    if header.get("type") != "header" or header.get("format") != EXPORT_FORMAT_VERSION:
+        raise ValueError("Not an export of this format version")
+    # vectors of another model can't be searched with this one's queries
+    if header["model_name"] != generation.model_name or header["dim"] != generation.dim:
+        raise ValueError(
+            f"Export has {header['model_name']} vectors, the active generation uses {generation.model_name}"
+        )
+
+
+def _load_staging(cursor, stream: BinaryIO, binary: bool) -> None:
+    if binary:
+        cursor.copy_expert("COPY import_document FROM STDIN WITH (FORMAT binary)", _FrameReader(stream))
+        cursor.copy_expert("COPY import_chunks FROM STDIN WITH (FORMAT binary)", _FrameReader(stream))
+        return
+    lines = iter(stream)
+    documents = _RecordReader(lines, "document", DOCUMENT_COLUMNS)
+    cursor.copy_expert(f"COPY import_document ({', '.join(DOCUMENT_COLUMNS)}) FROM STDIN", documents)
+    chunks = _RecordReader(lines, "chunk", CHUNK_COLUMNS, pending=documents.pending)
+    cursor.copy_expert(f"COPY import_chunks ({', '.join(CHUNK_COLUMNS)}) FROM STDIN", chunks)
+    if chunks.pending is not None:
+        raise ValueError("Export has records after its chunks")
+
+
+def import_stream(engine: Engine, stream: BinaryIO,
+                  generation_getter: Callable[[], Generation] = active_generation) -> dict:
+    """
+    Loads an export_ndjson or export_binary stream with COPY into staging
+    tables, then inserts the rows in one transaction. Rows whose id already
+    exists are skipped, so an interrupted import can be run again. Vectors go
+    to the active generation's column; imports that are large next to the
+    table rebuild its ANN index afterwards, whether the insert succeeded or
+    not. Returns the counts and the owners whose documents changed.
+    """
+    first = stream.readline()
+    binary = first == BINARY_MAGIC
+    header = orjson.loads(stream.readline() if binary else first)
+    generation = generation_getter()
+    _check_header(header, generation)
+
+    raw = engine.raw_connection()
+    cursor = raw.cursor()
+    rebuild_index = False
+    try:
+        cursor.execute(STAGING_SQL.format(dim=int(generation.dim)))
+        _load_staging(cursor, stream, binary)
+        cursor.execute(MISSING_OWNERS_SQL)
+        if cursor.fetchone()[0]:
+            raise ValueError("Export has documents of users or organizations that don't exist here")
+        cursor.execute("SELECT count(*) FROM import_chunks")
+        staged_chunks = cursor.fetchone()[0]
+        cursor.execute(ESTIMATED_CHUNKS_SQL)
+        existing_chunks = cursor.fetchone()[0]
+        raw.commit()
+
+        rebuild_index = (staged_chunks >= REBUILD_INDEX_MIN_CHUNKS
+                         and staged_chunks >= REBUILD_INDEX_MIN_SHARE * existing_chunks)
+        if rebuild_index:
+            # searches fall back to a scan of the column until the index is back
+            drop_index(engine, index_name(generation))
+
+        cursor.execute(f"""
+            INSERT INTO document ({', '.join(DOCUMENT_COLUMNS)})
+            SELECT {', '.join(DOCUMENT_COLUMNS)} FROM import_document
+            ON CONFLICT (id) DO NOTHING
+        """)
+        documents = cursor.rowcount
+        cursor.execute(f"""
+            INSERT INTO chunks (id, owner_id, document_id, chunk, {generation.column_name})
+            SELECT c.id, coalesce(d.user_id, d.organization_id), c.document_id, c.chunk, c.embedding
+            FROM import_chunks c
+            JOIN document d ON d.id = c.document_id
+            ON CONFLICT (id, owner_id) DO NOTHING
+        """)
+        chunks = cursor.rowcount
+        cursor.execute("SELECT DISTINCT coalesce(user_id, organization_id) FROM import_document")
+        owners = [row[0] for row in cursor.fetchall()]
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        try:
+            cursor.execute("DROP TABLE IF EXISTS import_document, import_chunks")
+            raw.commit()
+        except Exception as e:
+            logger.warning("Could not drop import staging tables: %s", e)
+            raw.invalidate()
+        raw.close()
+        # a failed insert must not leave every owner's searches without the index
+        if rebuild_index:
+            build_generation_index(engine, generation)
+
+    logger.info("Imported %s documents and %s chunks", documents, chunks)
+    return {"documents": documents, "chunks": chunks, "index_rebuilt": rebuild_index, "owners": owners}
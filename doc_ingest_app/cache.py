@@ -0,0 +1,359 @@
+import hashlib
+import logging
+import pickle
+import time
+from array import array
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Any, Callable, Hashable, List, Optional
+from uuid import UUID
+
+import redis
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from .metrics import observe_embedding
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = "redis://localhost:6379/1"
+redis_client = redis.Redis.from_url(REDIS_URL)
+
+OWNER_VERSION_KEY = "owner_version:{}"
+RECENT_WRITE_KEY = "recent_write:{}"
+IDENTITY_VERSION_KEY = "identity_version:{}:{}"
+IDENTITY_VALUE_KEY = "identity:{}:{}:{}"
+IDENTITY_INVALIDATIONS_CHANNEL = "identity:invalidations"
+IDENTITY_LISTEN_RETRY_SECONDS = 1
+IDENTITY_LISTEN_MAX_RETRY_SECONDS = 30
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Small in-process LRU cache where every entry expires after `ttl` seconds.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class CacheStats:
+    """
+    Hit/miss counters for a cache.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def as_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class EmbeddingCache:
+    """
+    Text -> embedding cache. Entries live in an in-process LRU and, when
+    `use_redis` is set, in Redis as packed float32 so every worker shares them.
+    """
+    def __init__(self, namespace: str, maxsize: int = 10000, use_redis: bool = False, redis_ttl: int = 86400):
+        self.namespace = namespace
+        self.use_redis = use_redis
+        self.redis_ttl = redis_ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=redis_ttl)
+        self.stats = CacheStats()
+
+    def _redis_key(self, text: str) -> str:
+        return f"emb:{self.namespace}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+
+    def encode(self, model, texts: List[str]) -> List[List[float]]:
+        """
+        Returns one embedding per text, encoding only the cache misses in a
+        single batched model call.
+        """
+        embeddings: List[Optional[List[float]]] = [self.local.get(text) for text in texts]
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing and self.use_redis:
+            try:
+                packed = redis_client.mget([self._redis_key(texts[i]) for i in missing])
+            except redis.RedisError as e:
+                logger.warning("Embedding cache lookup in Redis failed: %s", e)
+                packed = [None] * len(missing)
+            for i, value in zip(missing, packed):
+                if value is not None:
+                    embeddings[i] = array("f", value).tolist()
+                    self.local.set(texts[i], embeddings[i])
+
+        for embedding in embeddings:
+            self.stats.record(embedding is not None)
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with observe_embedding("query"):
+                encoded = model.encode([texts[i] for i in missing]).tolist()
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                self.local.set(texts[i], embedding)
+            if self.use_redis:
+                try:
+                    with redis_client.pipeline(transaction=False) as pipe:
+                        for i in missing:
+                            pipe.set(self._redis_key(texts[i]), array("f", embeddings[i]).tobytes(), ex=self.redis_ttl)
+                        pipe.execute()
+                except redis.RedisError as e:
+                    logger.warning("Embedding cache write to Redis failed: %s", e)
+        return embeddings
+
+
+def get_owner_versions(*owner_ids: Optional[UUID]) -> Optional[tuple]:
+    """
+    Returns the current data version of each owner, or None when Redis is
+    unreachable and cached results can't be trusted.
+    """
+    keys = [OWNER_VERSION_KEY.format(owner_id) for owner_id in owner_ids if owner_id]
+    try:
+        versions = redis_client.mget(keys)
+    except redis.RedisError as e:
+        logger.warning("Could not read owner versions: %s", e)
+        return None
+    return tuple(int(version or 0) for version in versions)
+
+
+def bump_owner_version(owner_id: Optional[UUID]) -> None:
+    """
+    Marks every cached result that includes the owner's documents as stale.
+    """
+    if not owner_id:
+        return
+    try:
+        redis_client.incr(OWNER_VERSION_KEY.format(owner_id))
+    except redis.RedisError as e:
+        logger.warning("Could not bump version for owner %s: %s", owner_id, e)
+
+
+def mark_recent_write(owner_id: Optional[UUID], seconds: int) -> None:
+    """
+    Records that the owner just wrote, so their reads stay on the primary
+    for `seconds` instead of possibly hitting a replica that hasn't caught up.
+    """
+    if not owner_id:
+        return
+    try:
+        redis_client.set(RECENT_WRITE_KEY.format(owner_id), 1, ex=seconds)
+    except redis.RedisError as e:
+        logger.warning("Could not mark recent write for owner %s: %s", owner_id, e)
+
+
+def has_recent_write(*owner_ids: Optional[UUID]) -> bool:
+    """
+    Whether any of the owners wrote recently. Assumes they did when Redis is
+    unreachable, since reading from the primary is always safe.
+    """
+    keys = [RECENT_WRITE_KEY.format(owner_id) for owner_id in owner_ids if owner_id]
+    if not keys:
+        return False
+    try:
+        return redis_client.exists(*keys) > 0
+    except redis.RedisError as e:
+        logger.warning("Could not check recent writes: %s", e)
+        return True
+
+
+def _column_values(instance) -> dict:
+    return {attr.key: getattr(instance, attr.key) for attr in inspect(instance).mapper.column_attrs}
+
+
+def pack_instance(instance) -> bytes:
+    """
+    Pickles an ORM instance as plain column values, along with the rows of
+    the relationships that were loaded on it, so nothing of SQLAlchemy's
+    instance state ends up in Redis.
+    """
+    state = inspect(instance)
+    related = {}
+    for relationship in state.mapper.relationships:
+        if relationship.key in state.unloaded:
+            continue
+        value = getattr(instance, relationship.key)
+        if relationship.uselist:
+            related[relationship.key] = [_column_values(item) for item in value]
+        else:
+            related[relationship.key] = _column_values(value) if value is not None else None
+    return pickle.dumps({
+        "model": state.mapper.class_.__name__,
+        "columns": _column_values(instance),
+        "related": related,
+    })
+
+
+def unpack_instance(packed: bytes):
+    """
+    Rebuilds what pack_instance stored as detached instances, as if they
+    had been loaded and their session closed.
+    """
+    from .models.sql_models import Base
+
+    data = pickle.loads(packed)
+    models = {mapper.class_.__name__: mapper for mapper in Base.registry.mappers}
+    mapper = models[data["model"]]
+    instance = mapper.class_(**data["columns"])
+    for key, value in data["related"].items():
+        target = mapper.relationships[key].mapper.class_
+        if isinstance(value, list):
+            items = [target(**columns) for columns in value]
+            for item in items:
+                make_transient_to_detached(item)
+            setattr(instance, key, items)
+        elif value is not None:
+            item = target(**value)
+            make_transient_to_detached(item)
+            setattr(instance, key, item)
+        else:
+            setattr(instance, key, None)
+    make_transient_to_detached(instance)
+    return instance
+
+
+class IdentityCache:
+    """
+    Read-through cache for rows that rarely change (users, organizations,
+    conversations), holding detached ORM instances.
+
+    Entries live in an in-process TTL LRU. Invalidations are published on
+    IDENTITY_INVALIDATIONS_CHANNEL, and processes that run `listen` drop
+    their local entry when another process, e.g. a Celery worker, changes
+    the row. With `use_redis` every entity also has a version counter in
+    Redis: a hit is only served when its version is current, and misses are
+    filled from a copy of the row's columns in Redis before falling back
+    to the loader.
+    """
+    def __init__(self, ttl: float = 30.0, maxsize: int = 10000, use_redis: bool = False):
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stats = CacheStats()
+        self._listener: Optional[Thread] = None
+
+    def get(self, kind: str, key: Hashable, loader: Callable[[], Any]) -> Any:
+        version = 0
+        if self.use_redis:
+            try:
+                version = int(redis_client.get(IDENTITY_VERSION_KEY.format(kind, key)) or 0)
+            except redis.RedisError as e:
+                logger.warning("Could not read %s version, bypassing cache: %s", kind, e)
+                return loader()
+
+        entry = self.local.get((kind, key))
+        if entry is not None and entry[0] == version:
+            self.stats.record(True)
+            return entry[1]
+
+        value_key = IDENTITY_VALUE_KEY.format(kind, key, version)
+        if self.use_redis:
+            try:
+                packed = redis_client.get(value_key)
+            except redis.RedisError:
+                packed = None
+            if packed is not None:
+                value = unpack_instance(packed)
+                self.local.set((kind, key), (version, value))
+                self.stats.record(True)
+                return value
+
+        self.stats.record(False)
+        value = loader()
+        if value is not None:
+            self.local.set((kind, key), (version, value))
+            if self.use_redis:
+                try:
+                    redis_client.set(value_key, pack_instance(value), ex=int(self.ttl))
+                except redis.RedisError as e:
+                    logger.warning("Could not store %s in Redis: %s", kind, e)
+        return value
+
+    def invalidate(self, kind: str, key: Hashable) -> None:
+        self.local.invalidate((kind, key))
+        try:
+            if self.use_redis:
+                redis_client.incr(IDENTITY_VERSION_KEY.format(kind, key))
+            redis_client.publish(IDENTITY_INVALIDATIONS_CHANNEL, f"{kind}:{key}")
+        except redis.RedisError as e:
+            logger.warning("Could not publish %s invalidation for %s: %s", kind, key, e)
+
+    def _drop_published(self, data: bytes) -> None:
+        kind, _, key = data.decode().partition(":")
+        try:
+            # entries are keyed by the UUID the routes parse
+            key = UUID(key)
+        except ValueError:
+            pass
+        self.local.invalidate((kind, key))
+
+    def _listen(self) -> None:
+        delay = IDENTITY_LISTEN_RETRY_SECONDS
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(IDENTITY_INVALIDATIONS_CHANNEL)
+                # invalidations sent while unsubscribed are lost, start over
+                self.local.clear()
+                delay = IDENTITY_LISTEN_RETRY_SECONDS
+                for message in pubsub.listen():
+                    self._drop_published(message["data"])
+            except redis.RedisError as e:
+                logger.warning("Lost identity invalidations subscription, retrying in %ss: %s", delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, IDENTITY_LISTEN_MAX_RETRY_SECONDS)
+
+    def listen(self) -> None:
+        """
+        Starts dropping local entries that other processes invalidate, on a
+        background thread. Processes that serve cached entries call it once.
+        """
+        if self._listener is None:
+            self._listener = Thread(target=self._listen, name="identity-invalidations", daemon=True)
+            self._listener.start()
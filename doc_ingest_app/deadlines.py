@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from typing import Annotated, Callable, Optional, TypeVar
+
+from fastapi import Depends, Request
+from psycopg2.errorcodes import QUERY_CANCELED
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import REQUEST_DEADLINE_OUTCOMES
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# seconds a request may take, by route template; other routes get DEFAULT_DEADLINE
+ROUTE_DEADLINES = {
+    "/search/{user_id}": 2.0,
+    "/search/{user_id}/batch": 5.0,
+    "/conversations/{conversation_id}/search": 2.0,
+}
+DEFAULT_DEADLINE = 30.0
+# clients can ask for a shorter deadline, in seconds
+DEADLINE_HEADER = "x-request-timeout"
+# how often a request waiting on the threadpool checks that its client is still there
+DISCONNECT_POLL_SECONDS = 0.1
+# statement_timeout = 0 turns the timeout off, so a spent budget still gets 1ms
+MIN_STATEMENT_TIMEOUT_MS = 1
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def statement_timeout_ms(self, reserve: float = 0.0) -> int:
+        """
+        What is left of the budget, less `reserve` seconds kept for a
+        fallback, as a statement_timeout.
+        """
+        return max(int((self.remaining() - reserve) * 1000), MIN_STATEMENT_TIMEOUT_MS)
+
+
+def route_path(request: Request) -> str:
+    return getattr(request.scope.get("route"), "path", "unmatched")
+
+
+def get_deadline(request: Request) -> Deadline:
+    budget = ROUTE_DEADLINES.get(route_path(request), DEFAULT_DEADLINE)
+    requested = request.headers.get(DEADLINE_HEADER)
+    if requested:
+        try:
+            budget = min(budget, max(float(requested), 0.0))
+        except ValueError:
+            pass
+    return Deadline(budget)
+
+
+DeadlineDep = Annotated[Deadline, Depends(get_deadline)]
+
+
+def bind_deadline(session: Session, deadline: Deadline) -> None:
+    """
+    Gives every transaction the session begins what is left of the
+    deadline as its statement_timeout, so Postgres stops queries the client
+    has stopped waiting for.
+    """
+    @event.listens_for(session, "after_begin")
+    def set_statement_timeout(session, transaction, connection):
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {deadline.statement_timeout_ms()}")
+
+
+def set_statement_timeout(session: Session, deadline: Deadline, reserve: float = 0.0) -> None:
+    # SET doesn't take bind parameters, the value is an int
+    session.connection().exec_driver_sql(
+        f"SET LOCAL statement_timeout = {deadline.statement_timeout_ms(reserve)}"
+    )
+
+
+def query_canceled(e: BaseException) -> bool:
+    # statement_timeout and pg_cancel_backend both end a query with QUERY_CANCELED
+    return isinstance(e, DBAPIError) and getattr(e.orig, "pgcode", None) == QUERY_CANCELED
+
+
+def _discard_result(task: asyncio.Future) -> None:
+    if not task.cancelled():
+        task.exception()
+
+
+async def run_cancellable(request: Request, session: Optional[Session], fn: Callable[..., T], *args) -> T:
+    """
+    Runs the blocking fn(*args) on the threadpool while watching the client.
+    When it disconnects, the query running on the session's connection is
+    cancelled and ClientDisconnected is raised once fn has let go of the
+    session. Without a session, e.g. for a model encode, which can't be
+    interrupted, fn is left to finish on its own and its result dropped.
+    """
+    dbapi_connection = session.connection().connection.dbapi_connection if session is not None else None
+    work = asyncio.ensure_future(run_in_threadpool(fn, *args))
+    try:
+        while not work.done():
+            await asyncio.wait({work}, timeout=DISCONNECT_POLL_SECONDS)
+            if not work.done() and await request.is_disconnected():
+                REQUEST_DEADLINE_OUTCOMES.labels(route_path(request), "disconnected").inc()
+                raise ClientDisconnected()
+        return work.result()
+    finally:
+        if not work.done():
+            if dbapi_connection is None:
+                work.add_done_callback(_discard_result)
+            else:
+                dbapi_connection.cancel()
+                # the session is closed after this returns, fn must be done with it
+                await asyncio.wait({work})
+                _discard_result(work)
@@ -5,7 +5,10 @@ from sqlalchemy.engine import URL, create_engine
 from sqlalchemy.orm import Session, joinedload
 from uuid import UUID
 
+from .cache import IdentityCache
+from .deadlines import Deadline, DeadlineDep, bind_deadline
 from .models.sql_models import Conversation, Document, Organization, User
+from .replicas import REPLICA_URLS, ReplicaRouter
 
 
 url = URL.create(
@@ -17,39 +20,93 @@ url = URL.create(
     database="postgres"
 )
 engine = create_engine(url, echo=True)
+read_router = ReplicaRouter(REPLICA_URLS)
 
-async def get_user(user_id: UUID):
+# user, organization and conversation rows used by the route dependencies
+IDENTITY_CACHE_TTL = 30
+# share entries and invalidations across API workers through Redis
+USE_REDIS_IDENTITY_CACHE = False
+identity_cache = IdentityCache(ttl=IDENTITY_CACHE_TTL, use_redis=USE_REDIS_IDENTITY_CACHE)
+
+
+def load_user(user_id: UUID) -> Optional[User]:
     with Session(engine) as session:
-        user = session.scalar(
+        return session.scalar(
             select(User).where(User.id == user_id)
         )
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        return user
 
-async def get_organization(org_id: UUID):
+def load_organization(org_id: UUID) -> Optional[Organization]:
     with Session(engine) as session:
-        org = session.scalar(
+        return session.scalar(
             select(Organization).where(Organization.id == org_id)
-            .options(joinedload(Organization.users),  # Eager load users
-                     joinedload(Organization.documents))  # Eager load documents
+            .options(joinedload(Organization.users))  # Eager load users
         )
-        if not org:
-            raise HTTPException(status_code=404, detail="Organization not found")
-        return org
+
+def load_conversation(conversation_id: UUID) -> Optional[Conversation]:
+    with Session(engine) as session:
+        return session.scalar(
+            select(Conversation).where(Conversation.id == conversation_id)
+        )
+
+async def get_user(user_id: UUID):
+    """
+    Cached; read-only. Routes that modify the user should use UserForUpdateDep.
+    """
+    user = identity_cache.get("user", user_id, lambda: load_user(user_id))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+async def get_user_for_update(user_id: UUID):
+    user = load_user(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+async def get_organization(org_id: UUID):
+    """
+    Cached; read-only. Routes that modify the organization should use OrganizationForUpdateDep.
+    """
+    org = identity_cache.get("organization", org_id, lambda: load_organization(org_id))
+    if not org:
+        raise HTTPException(status_code=404, detail="Organization not found")
+    return org
+
+async def get_organization_for_update(org_id: UUID):
+    org = load_organization(org_id)
+    if not org:
+        raise HTTPException(status_code=404, detail="Organization not found")
+    return org
 
 def get_session():
     with Session(engine) as session:
         yield session
 
+def read_session(*owner_ids: Optional[UUID], deadline: Optional[Deadline] = None):
+    """
+    Session for read-only routes over the owners' data, on a replica when
+    one is caught up and none of the owners wrote recently. Its queries are
+    cut off when the request's deadline passes.
+    """
+    with Session(read_router.engine_for_read(*owner_ids) or engine) as session:
+        if deadline is not None:
+            bind_deadline(session, deadline)
+        yield session
+
 async def get_conversation(conversation_id: UUID):
-    with Session(engine) as session:
-        conversation = session.scalar(
-            select(Conversation).where(Conversation.id == conversation_id)
-        )
-        if not conversation:
-            raise HTTPException(status_code=404, detail="Conversation not found")
-        return conversation
+    """
+    Cached; read-only. Routes that modify the conversation should use ConversationForUpdateDep.
+    """
+    conversation = identity_cache.get("conversation", conversation_id, lambda: load_conversation(conversation_id))
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversation
+
+async def get_conversation_for_update(conversation_id: UUID):
+    conversation = load_conversation(conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversation
 
 async def validate_document_ids_for_user(
     document_ids: List[UUID],
@@ -79,5 +136,27 @@ async def validate_document_ids_for_user(
 
 SessionDep = Annotated[Session, Depends(get_session)]
 UserDep = Annotated[User, Depends(get_user)]
+UserForUpdateDep = Annotated[User, Depends(get_user_for_update)]
 OrganizationDep = Annotated[Organization, Depends(get_organization)]
-ConversationDep = Annotated[Conversation, Depends(get_conversation)]
\ No newline at end of file
+OrganizationForUpdateDep = Annotated[Organization, Depends(get_organization_for_update)]
+ConversationDep = Annotated[Conversation, Depends(get_conversation)]
+ConversationForUpdateDep = Annotated[Conversation, Depends(get_conversation_for_update)]
+
+
+def get_user_read_session(user: UserDep, deadline: DeadlineDep):
+    yield from read_session(user.id, user.organization_id, deadline=deadline)
+
+def get_organization_read_session(org: OrganizationDep, deadline: DeadlineDep):
+    yield from read_session(org.id, deadline=deadline)
+
+def get_conversation_read_session(conversation: ConversationDep, deadline: DeadlineDep):
+    # writes through the user's organization, e.g. to its documents, change
+    # what the conversation covers as much as the user's own
+    user = identity_cache.get("user", conversation.user_id, lambda: load_user(conversation.user_id))
+    organization_id = user.organization_id if user else None
+    yield from read_session(conversation.user_id, organization_id, deadline=deadline)
+
+
+UserReadSessionDep = Annotated[Session, Depends(get_user_read_session)]
+OrganizationReadSessionDep = Annotated[Session, Depends(get_organization_read_session)]
+ConversationReadSessionDep = Annotated[Session, Depends(get_conversation_read_session)]
@@ -0,0 +1,24 @@
+from threading import Lock
+
+
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+EMBEDDING_DIM = 384
+
+# model name -> loaded model, more than one while a re-embedding job runs
+_embedding_models = {}
+_embedding_model_lock = Lock()
+
+
+def get_embedding_model(model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    Returns the process-wide embedding model, importing sentence_transformers
+    (and torch) and loading the model on first use.
+    """
+    model = _embedding_models.get(model_name)
+    if model is None:
+        with _embedding_model_lock:
+            model = _embedding_models.get(model_name)
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                model = _embedding_models[model_name] = SentenceTransformer(model_name)
+    return model
@@ -0,0 +1,234 @@
+import logging
+from datetime import datetime, timezone
+from typing import List, NamedTuple, Optional, Sequence
+from uuid import UUID
+
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import cast, column, literal_column, select, table, text, types, update, values
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .embeddings import EMBEDDING_DIM, EMBEDDING_MODEL_NAME
+from .models.sql_models import Chunks, EmbeddingGeneration
+from .partitions import create_index, drop_index
+
+logger = logging.getLogger(__name__)
+
+
+class Generation(NamedTuple):
+    id: int
+    model_name: str
+    dim: int
+    column_name: str
+    state: str
+
+
+# what migration 0005 registers; used as is when the schema was created without migrations
+BASE_GENERATION = Generation(1, EMBEDDING_MODEL_NAME, EMBEDDING_DIM, Chunks.embedding.key, "active")
+
+# how long an API process keeps using a generation after another one is activated
+ACTIVE_GENERATION_TTL = 5
+_active_generation_cache = TTLCache(maxsize=1, ttl=ACTIVE_GENERATION_TTL)
+
+HNSW_INDEX_SQL = "USING hnsw ({column} vector_l2_ops) WITH (m = 16, ef_construction = 64)"
+# shrinks as the backfill progresses, so finding the chunks still missing a
+# vector stays cheap right up to the switch
+MISSING_INDEX_SQL = "(id) WHERE {column} IS NULL"
+
+
+def _generation(row: EmbeddingGeneration) -> Generation:
+    return Generation(row.id, row.model_name, row.dim, row.column_name, row.state)
+
+
+def index_name(generation: Generation) -> str:
+    return f"ix_chunks_{generation.column_name}_hnsw"
+
+
+def missing_index_name(generation: Generation) -> str:
+    return f"ix_chunks_{generation.column_name}_missing"
+
+
+def live_generations(session: Session) -> List[Generation]:
+    """
+    Generations new chunks must get vectors for: the active one first, then
+    the one being built, if any.
+    """
+    generations = [
+        _generation(row) for row in session.scalars(
+            select(EmbeddingGeneration)
+            .where(EmbeddingGeneration.state.in_(["active", "building"]))
+            .order_by(EmbeddingGeneration.id)
+        )
+    ]
+    if not any(generation.state == "active" for generation in generations):
+        generations.insert(0, BASE_GENERATION)
+    return sorted(generations, key=lambda generation: generation.state != "active")
+
+
+def active_generation() -> Generation:
+    """
+    The generation searches use, cached briefly. A request should look it up
+    once and use it for both the query encoding and the column it searches;
+    the previous generation's column stays in place until it is dropped.
+    """
+    from . import dependencies
+
+    generation = _active_generation_cache.get("active")
+    if generation is None:
+        with Session(dependencies.engine) as session:
+            generation = live_generations(session)[0]
+        _active_generation_cache.set("active", generation)
+    return generation
+
+
+def embedding_column(generation: Generation):
+    if generation.column_name == Chunks.embedding.key:
+        return Chunks.embedding
+    return literal_column(f"chunks.{generation.column_name}", Vector(generation.dim))
+
+
+def write_vectors(session: Session, generation: Generation, chunk_ids: Sequence[UUID], vectors,
+                  owner_id: Optional[UUID] = None) -> None:
+    """
+    Sets the generation's vector of each chunk with one UPDATE ... FROM VALUES.
+    Passing the chunks' owner limits the update to their partition.
+    """
+    chunks = table(
+        "chunks",
+        column("id", types.UUID),
+        column("owner_id", types.UUID),
+        column(generation.column_name, Vector(generation.dim))
+    )
+    new_vectors = values(
+        column("id", types.UUID),
+        column("vector", Vector(generation.dim)),
+        name="new_vectors"
+    ).data(list(zip(chunk_ids, vectors)))
+    stmt = (
+        update(chunks)
+        .where(chunks.c.id == cast(new_vectors.c.id, types.UUID))
+        .values({generation.column_name: cast(new_vectors.c.vector, Vector(generation.dim))})
+    )
+    if owner_id is not None:
+        stmt = stmt.where(chunks.c.owner_id == owner_id)
+    session.execute(stmt)
+
+
+def fill_missing_vectors(session: Session, generation: Generation, model, batch_size: int) -> int:
+    """
+    Embeds every chunk that has no vector in the generation yet, e.g. ones
+    ingested while the generation was being created. Returns how many.
+    """
+    column = embedding_column(generation)
+    filled = 0
+    while True:
+        rows = session.execute(
+            select(Chunks.id, Chunks.chunk).where(column.is_(None)).limit(batch_size)
+        ).all()
+        if not rows:
+            return filled
+        write_vectors(session, generation, [row.id for row in rows], model.encode([row.chunk for row in rows]))
+        filled += len(rows)
+
+
+def start_generation(engine: Engine, model_name: str, dim: int) -> Generation:
+    """
+    Returns the model's generation, registering it and adding its column when
+    it doesn't exist yet. Only one generation can be building at a time.
+    """
+    with Session(engine) as session, session.begin():
+        existing = session.scalars(
+            select(EmbeddingGeneration)
+            .where(EmbeddingGeneration.state.in_(["active", "building"]))
+            .with_for_update()
+        ).all()
+        for row in existing:
+            if row.model_name == model_name:
+                return _generation(row)
+            if row.state == "building":
+                raise ValueError(f"Generation {row.id} ({row.model_name}) is still being built")
+
+        row = EmbeddingGeneration(model_name=model_name, dim=dim, column_name=f"pending-{model_name}", state="building")
+        session.add(row)
+        session.flush()
+        row.column_name = f"embedding_v{row.id}"
+        # the row and the column become visible together, so ingests never
+        # see a building generation without its column
+        session.execute(text("SET LOCAL lock_timeout = '5s'"))
+        session.execute(text(f"ALTER TABLE chunks ADD COLUMN IF NOT EXISTS {row.column_name} vector({int(dim)})"))
+        return _generation(row)
+
+
+def build_missing_index(engine: Engine, generation: Generation) -> None:
+    create_index(engine, missing_index_name(generation), MISSING_INDEX_SQL.format(column=generation.column_name))
+
+
+def build_generation_index(engine: Engine, generation: Generation) -> None:
+    create_index(engine, index_name(generation), HNSW_INDEX_SQL.format(column=generation.column_name))
+
+
+def activate_generation(engine: Engine, generation: Generation, model, batch_size: int) -> None:
+    """
+    Makes the generation the one searches use and retires the previous one,
+    in a single transaction. Writes to chunks wait while it runs, so no chunk
+    can be committed without a vector in the new generation.
+    """
+    with Session(engine) as session, session.begin():
+        session.execute(text("SET LOCAL lock_timeout = '5s'"))
+        session.execute(text("LOCK TABLE chunks IN SHARE MODE"))
+        filled = fill_missing_vectors(session, generation, model, batch_size)
+        if filled:
+            logger.info("Embedded %s chunks ingested during the switch to generation %s", filled, generation.id)
+        session.execute(
+            update(EmbeddingGeneration)
+            .where(EmbeddingGeneration.state == "active")
+            .values(state="retired")
+        )
+        session.execute(
+            update(EmbeddingGeneration)
+            .where(EmbeddingGeneration.id == generation.id)
+            .values(state="active", activated_at=datetime.now(timezone.utc))
+        )
+    _active_generation_cache.clear()
+    drop_index(engine, missing_index_name(generation))
+
+
+def drop_generation(engine: Engine, generation_id: int) -> Generation:
+    """
+    Frees a retired generation's storage: drops its column, or only the HNSW
+    index for the original `embedding` column, which stays mapped.
+    """
+    with Session(engine) as session:
+        row = session.get(EmbeddingGeneration, generation_id)
+        if row is None or row.state != "retired":
+            raise ValueError(f"Generation {generation_id} is not retired")
+        generation = _generation(row)
+
+    if generation.column_name == Chunks.embedding.key:
+        drop_index(engine, index_name(generation))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SET lock_timeout = '5s'"))
+        if generation.column_name != Chunks.embedding.key:
+            # catalog-only, the space is reclaimed as rows are rewritten
+            conn.execute(text(f"ALTER TABLE chunks DROP COLUMN IF EXISTS {generation.column_name}"))
+        conn.execute(
+            update(EmbeddingGeneration).where(EmbeddingGeneration.id == generation_id).values(state="dropped")
+        )
+    return generation._replace(state="dropped")
+
+
+def list_generations(session: Session) -> List[dict]:
+    return [
+        {
+            "id": row.id,
+            "model_name": row.model_name,
+            "dim": row.dim,
+            "column_name": row.column_name,
+            "state": row.state,
+            "chunks_done": row.chunks_done,
+            "created_at": row.created_at,
+            "activated_at": row.activated_at,
+        }
+        for row in session.scalars(select(EmbeddingGeneration).order_by(EmbeddingGeneration.id))
+    ]
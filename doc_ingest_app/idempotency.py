@@ -0,0 +1,128 @@
+import json
+import logging
+import uuid
+from typing import NamedTuple, Optional
+from uuid import UUID
+
+import redis
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+
+# how long a retried upload with the same Idempotency-Key gets the first response back
+UPLOAD_KEY_TTL = 24 * 3600
+# longer than any ingest, and shorter than the broker's visibility timeout so
+# the lock of a worker that died has lapsed when its task is redelivered
+INGEST_LOCK_TTL = 30 * 60
+# longer than the purge of the largest owner, a purge whose worker died
+# stops blocking a new one once it lapses
+PURGE_CLAIM_TTL = 6 * 3600
+
+UPLOAD_KEY = "ingest:upload_key:{}:{}"
+INGEST_LOCK_KEY = "ingest:lock:{}"
+PURGE_CLAIM_KEY = "purge:owner:{}"
+IN_PROGRESS = b"in_progress"
+
+# KEYS: lock, ARGV: token. Only the run holding the lock may release it
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class UploadClaim(NamedTuple):
+    claimed: bool
+    # the stored response of an earlier upload with the same key
+    response: Optional[dict] = None
+
+
+def claim_upload_key(owner_id: UUID, key: str) -> UploadClaim:
+    """
+    Reserves an upload's Idempotency-Key. A key that is taken returns the
+    response stored for it, or neither while that upload is still running.
+    Uploads go ahead when Redis can't be asked.
+    """
+    redis_key = UPLOAD_KEY.format(owner_id, key)
+    try:
+        if cache.redis_client.set(redis_key, IN_PROGRESS, nx=True, ex=UPLOAD_KEY_TTL):
+            return UploadClaim(True)
+        stored = cache.redis_client.get(redis_key)
+    except redis.RedisError as e:
+        logger.warning("Could not check idempotency key for owner %s: %s", owner_id, e)
+        return UploadClaim(True)
+    if stored is None:
+        # expired in between
+        return claim_upload_key(owner_id, key)
+    if stored == IN_PROGRESS:
+        return UploadClaim(False)
+    return UploadClaim(False, json.loads(stored))
+
+
+def store_upload_response(owner_id: UUID, key: str, response: dict) -> None:
+    try:
+        cache.redis_client.set(UPLOAD_KEY.format(owner_id, key), json.dumps(response, default=str), ex=UPLOAD_KEY_TTL)
+    except redis.RedisError as e:
+        logger.warning("Could not store idempotent response for owner %s: %s", owner_id, e)
+
+
+def release_upload_key(owner_id: UUID, key: str) -> None:
+    """
+    Frees the key of an upload that failed, so the client can retry it.
+    """
+    try:
+        cache.redis_client.delete(UPLOAD_KEY.format(owner_id, key))
+    except redis.RedisError as e:
+        logger.warning("Could not release idempotency key for owner %s: %s", owner_id, e)
+
+
+def acquire_ingest_lock(file_id: UUID) -> Optional[str]:
+    """
+    Takes the per-file ingest lock, returning the token to release it with,
+    or None when another run of the file holds it. Without Redis the
+    ingest goes ahead, the row lock in proccess_file still serializes runs.
+    """
+    token = uuid.uuid4().hex
+    try:
+        if not cache.redis_client.set(INGEST_LOCK_KEY.format(file_id), token, nx=True, ex=INGEST_LOCK_TTL):
+            return None
+    except redis.RedisError as e:
+        logger.warning("Could not take the ingest lock of file %s: %s", file_id, e)
+    return token
+
+
+def release_ingest_lock(file_id: UUID, token: str) -> None:
+    try:
+        cache.redis_client.eval(UNLOCK_SCRIPT, 1, INGEST_LOCK_KEY.format(file_id), token)
+    except redis.RedisError as e:
+        logger.warning("Could not release the ingest lock of file %s: %s", file_id, e)
+
+
+def claim_purge(owner_id: UUID, task_id: str) -> Optional[str]:
+    """
+    Records task_id as the purge of the owner, returning the id of the
+    purge already running for it instead when there is one. Without Redis
+    the purge goes ahead, a second one finds less to delete.
+    """
+    key = PURGE_CLAIM_KEY.format(owner_id)
+    try:
+        if cache.redis_client.set(key, task_id, nx=True, ex=PURGE_CLAIM_TTL):
+            return None
+        running = cache.redis_client.get(key)
+    except redis.RedisError as e:
+        logger.warning("Could not claim the purge of owner %s: %s", owner_id, e)
+        return None
+    if running is None:
+        # finished in between
+        return claim_purge(owner_id, task_id)
+    return running.decode()
+
+
+def release_purge(owner_id: UUID, task_id: str) -> None:
+    try:
+        cache.redis_client.eval(UNLOCK_SCRIPT, 1, PURGE_CLAIM_KEY.format(owner_id), task_id)
+    except redis.RedisError as e:
+        logger.warning("Could not release the purge of owner %s: %s", owner_id, e)
@@ -1,20 +1,37 @@
+import time
+
+# imported first so the startup clock covers the imports below
+from .warmup import start_warmup, state as warmup_state
+
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
+from .deadlines import ClientDisconnected, query_canceled, route_path
+from .dependencies import identity_cache
+from .metrics import REQUEST_DEADLINE_OUTCOMES
 from .scripts.create_db_schema import create_tables, drop_tables
 from .middleware.error_handler import ErrorHandlingMiddleware
-from .routes import organizations, users, search, tasks, files, conversations
+from .middleware.metrics import MetricsMiddleware
+from .routes import admin, health, organizations, users, search, tasks, files, conversations
+
+warmup_state.record("imports", time.perf_counter() - warmup_state.process_started)
 
 app = FastAPI()
+app.include_router(health.router)
 app.include_router(organizations.router)
 app.include_router(users.router)
 app.include_router(search.router)
 app.include_router(tasks.router)
 app.include_router(files.router)
 app.include_router(conversations.router)
+app.include_router(admin.router)
 # app.add_middleware(ErrorHandlingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+warmup_state.record("app_setup", time.perf_counter() - warmup_state.process_started - warmup_state.timings["imports"])
 
 @app.exception_handler(SQLAlchemyError)
 async def sqlalchemy_exception_handler(request, exc):
@@ -22,12 +39,24 @@ async def sqlalchemy_exception_handler(request, exc):
         db_session = request.state.session
         if db_session:
             db_session.rollback()
+    if query_canceled(exc):
+        # the statement ran into the request's deadline
+        REQUEST_DEADLINE_OUTCOMES.labels(route_path(request), "timeout").inc()
+        return JSONResponse(
+            status_code=504,
+            content={"detail": "The request ran out of time."},
+        )
     return JSONResponse(
         status_code=500,
         content={"detail": "A database error occurred.",
                  "error": str(exc)},
     )
 
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request, exc):
+    # nobody reads it, the status is for the logs and metrics
+    return Response(status_code=499)
+
 @app.exception_handler(Exception)
 async def generic_exception_handler(request, exc):
     if hasattr(request.state, "session"):
@@ -54,12 +83,19 @@ async def integrity_error_handler(request, exc):
 
 @app.on_event("startup")
 def on_startup():
-    create_tables()
+    # model loading and connection checks happen in the background, see /health/ready
+    start_warmup()
+    # drop identities deleted or changed by other processes, e.g. purge_owner on a worker
+    identity_cache.listen()
 
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.delete("/drop_tables", tags=["Admin"])
 async def drop_all_tables():
     drop_tables()
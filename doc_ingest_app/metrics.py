@@ -0,0 +1,159 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+REQUEST_COUNT = Counter(
+    "http_requests_total", "HTTP requests", ["method", "route", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "HTTP requests currently being served"
+)
+REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "SQL statements issued per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent in SQL statements per request", ["route"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+DB_STATEMENT_SECONDS = Histogram(
+    "db_statement_duration_seconds", "Duration of individual SQL statements",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+EMBEDDING_SECONDS = Histogram(
+    "embedding_encode_seconds", "Time spent in embedding model encode calls", ["source"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+S3_CALL_SECONDS = Histogram(
+    "s3_call_duration_seconds", "Duration of S3 API calls", ["operation"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+REQUEST_DEADLINE_OUTCOMES = Counter(
+    "request_deadline_outcomes_total", "Requests cut short by their deadline or their client", ["route", "outcome"]
+)
+DB_READ_ROUTES = Counter(
+    "db_read_routes_total", "Read-only sessions by the engine that served them", ["target", "reason"]
+)
+DB_REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds", "Last measured replication lag of each read replica", ["replica"]
+)
+CELERY_QUEUE_WAIT_SECONDS = Histogram(
+    "celery_task_queue_wait_seconds", "Time tasks spent in the broker before a worker started them", ["queue"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+CELERY_TASK_SECONDS = Histogram(
+    "celery_task_duration_seconds", "Task run time", ["queue", "task"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+
+
+class QueueDepthCollector:
+    """
+    Reports the broker backlog of each queue at scrape time.
+    """
+    def __init__(self, depths: Callable[[], Dict[str, int]]):
+        self.depths = depths
+
+    def collect(self):
+        family = GaugeMetricFamily("celery_queue_depth", "Tasks waiting in the broker", labels=["queue"])
+        try:
+            depths = self.depths()
+        except Exception as e:
+            logger.warning("Could not read queue depths: %s", e)
+            depths = {}
+        for queue, depth in depths.items():
+            family.add_metric([queue], depth)
+        yield family
+
+    def describe(self) -> List:
+        # keeps registration from calling collect, which needs the broker
+        return []
+
+
+class RequestStats:
+    """
+    Per-request SQL totals, filled in by the engine hooks while a request runs.
+    """
+    __slots__ = ("db_statements", "db_seconds")
+
+    def __init__(self):
+        self.db_statements = 0
+        self.db_seconds = 0.0
+
+
+# set by MetricsMiddleware for the duration of each HTTP request
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+# applies to every engine in the process
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _observe_statement(conn) -> None:
+    elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+    DB_STATEMENT_SECONDS.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.db_statements += 1
+        stats.db_seconds += elapsed
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _observe_statement(conn)
+
+
+# failed statements, e.g. cancelled by statement_timeout, never reach
+# after_cursor_execute and would leave their start time on the stack
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    # errors while connecting or outside a cursor execute pushed no start time
+    if conn is not None and exception_context.cursor is not None and conn.info.get("query_start_time"):
+        _observe_statement(conn)
+
+
+@contextmanager
+def observe_embedding(source: str):
+    """
+    Times an embedding model call, e.g. `with observe_embedding("query"): model.encode(...)`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        EMBEDDING_SECONDS.labels(source).observe(time.perf_counter() - start)
+
+
+def instrument_s3_client(client):
+    """
+    Records the duration of every API call made through the boto3 client.
+    """
+    def before_call(context, **kwargs):
+        context["metrics_start_time"] = time.perf_counter()
+
+    def after_call(context, model, **kwargs):
+        start = context.pop("metrics_start_time", None)
+        if start is None:
+            return
+        S3_CALL_SECONDS.labels(model.name).observe(time.perf_counter() - start)
+
+    client.meta.events.register("before-call.s3", before_call)
+    client.meta.events.register("after-call.s3", after_call)
+    return client
@@ -0,0 +1,53 @@
+import time
+
+from ..metrics import (
+    REQUEST_COUNT,
+    REQUEST_DB_SECONDS,
+    REQUEST_DB_STATEMENTS,
+    REQUEST_LATENCY,
+    REQUESTS_IN_PROGRESS,
+    RequestStats,
+    request_stats,
+)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording latency, status and SQL totals per route.
+    Unlike BaseHTTPMiddleware it doesn't wrap the request or response, it only
+    watches the response start message for the status code.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_PROGRESS.dec()
+            request_stats.reset(token)
+
+            # the router stores the matched route in the scope, label by its template
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUEST_COUNT.labels(method, route, status_code).inc()
+            REQUEST_LATENCY.labels(method, route).observe(elapsed)
+            REQUEST_DB_STATEMENTS.labels(route).observe(stats.db_statements)
+            REQUEST_DB_SECONDS.labels(route).observe(stats.db_seconds)
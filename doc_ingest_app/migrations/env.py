@@ -0,0 +1,64 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy.engine import create_engine
+
+from doc_ingest_app.models.sql_models import Base
+from doc_ingest_app.scripts.create_db_schema import url
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # embedding_v<N> columns and their indexes are added and dropped by the
+    # re-embedding job, and the partitions of chunks by partitions.py,
+    # autogenerate shouldn't try to remove them
+    if reflected and compare_to is None and name and name.startswith(("embedding_v", "ix_chunks_", "chunks_")):
+        return False
+    return True
+
+
+def run_migrations_offline():
+    context.configure(
+        url=url.render_as_string(hide_password=False),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_on(connection):
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        # one transaction per revision so a concurrent index build only
+        # needs to step out of its own revision's transaction
+        transaction_per_migration=True,
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    # callers running the upgrade from code, e.g. the benchmarks, can pass
+    # a connection to another database in config.attributes
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        run_migrations_on(connection)
+        return
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        run_migrations_on(connection)
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,76 @@
+"""initial schema
+
+Matches the tables `create_tables` used to build on startup. Databases that
+were created that way should be stamped with this revision instead of
+running it: `alembic stamp 0001_initial_schema`.
+
+Revision ID: 0001_initial_schema
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+from pgvector.sqlalchemy import Vector
+
+
+revision = "0001_initial_schema"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS vector")
+
+    op.create_table(
+        "organization",
+        sa.Column("id", sa.Uuid(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+    )
+    op.create_table(
+        "user_account",
+        sa.Column("id", sa.UUID(), primary_key=True),
+        sa.Column("username", sa.String(), nullable=False, unique=True),
+        sa.Column("email", sa.String(), nullable=False, unique=True),
+        sa.Column("organization_id", sa.UUID(), sa.ForeignKey("organization.id"), nullable=True),
+    )
+    op.create_table(
+        "conversation",
+        sa.Column("id", sa.UUID(), primary_key=True),
+        sa.Column("user_id", sa.UUID(), sa.ForeignKey("user_account.id"), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("document_ids", sa.ARRAY(sa.UUID()), nullable=True),
+        sa.Column("title", sa.String(128), nullable=True),
+    )
+    op.create_table(
+        "message",
+        sa.Column("id", sa.UUID(), primary_key=True),
+        sa.Column("conversation_id", sa.UUID(), sa.ForeignKey("conversation.id"), nullable=False),
+        sa.Column("query", sa.String(), nullable=False),
+        sa.Column("response", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("response_at", sa.DateTime(), nullable=True),
+    )
+    op.create_table(
+        "document",
+        sa.Column("id", sa.UUID(), primary_key=True),
+        sa.Column("user_id", sa.UUID(), sa.ForeignKey("user_account.id"), nullable=True),
+        sa.Column("organization_id", sa.UUID(), sa.ForeignKey("organization.id"), nullable=True),
+        sa.Column("file_name", sa.String(), nullable=False),
+    )
+    op.create_table(
+        "chunks",
+        sa.Column("id", sa.UUID(), primary_key=True),
+        sa.Column("document_id", sa.UUID(), sa.ForeignKey("document.id"), nullable=False),
+        sa.Column("chunk", sa.String(), nullable=False),
+        sa.Column("embedding", Vector(384), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("chunks")
+    op.drop_table("document")
+    op.drop_table("message")
+    op.drop_table("conversation")
+    op.drop_table("user_account")
+    op.drop_table("organization")
@@ -0,0 +1,60 @@
+"""foreign-key, lookup and vector indexes
+
+Every index is built with CREATE INDEX CONCURRENTLY so it can run against a
+live database without blocking writes. A concurrent build can't run inside a
+transaction, so each one runs in an autocommit block. If a build fails it
+leaves an INVALID index behind; drop it and run the upgrade again.
+
+Revision ID: 0002_lookup_indexes
+Revises: 0001_initial_schema
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+
+revision = "0002_lookup_indexes"
+down_revision = "0001_initial_schema"
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns, extra create_index kwargs)
+INDEXES = [
+    ("ix_chunks_document_id", "chunks", ["document_id"], {}),
+    ("ix_document_user_id", "document", ["user_id"], {}),
+    ("ix_document_organization_id", "document", ["organization_id"], {}),
+    ("ix_document_file_name", "document", ["file_name"], {}),
+    ("ix_conversation_user_id", "conversation", ["user_id"], {}),
+    ("ix_user_account_organization_id", "user_account", ["organization_id"], {}),
+    ("ix_message_conversation_id_created_at", "message", ["conversation_id", "created_at"], {}),
+    ("ix_chunks_embedding_hnsw", "chunks", ["embedding"], {
+        "postgresql_using": "hnsw",
+        "postgresql_with": {"m": 16, "ef_construction": 64},
+        "postgresql_ops": {"embedding": "vector_l2_ops"},
+    }),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        # fail fast instead of queueing behind long transactions, and give
+        # the HNSW build enough memory to stay off disk
+        op.execute("SET lock_timeout = '5s'")
+        op.execute("SET maintenance_work_mem = '512MB'")
+        for name, table, columns, kwargs in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+                **kwargs
+            )
+        op.execute("RESET lock_timeout")
+        op.execute("RESET maintenance_work_mem")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,60 @@
+"""ON DELETE CASCADE foreign keys
+
+Lets Postgres remove child rows when a document, user, organization or
+conversation is deleted, so the ORM no longer loads them first
+(the relationships use passive_deletes). user_account.organization_id
+cascades too, matching the existing ORM cascade from Organization.users.
+
+Each constraint is re-added NOT VALID and validated in a separate step, so the
+table is only briefly locked and existing rows are checked without blocking
+writes.
+
+Revision ID: 0003_cascading_foreign_keys
+Revises: 0002_lookup_indexes
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+
+revision = "0003_cascading_foreign_keys"
+down_revision = "0002_lookup_indexes"
+branch_labels = None
+depends_on = None
+
+
+# (table, column, referenced table)
+FOREIGN_KEYS = [
+    ("user_account", "organization_id", "organization"),
+    ("conversation", "user_id", "user_account"),
+    ("message", "conversation_id", "conversation"),
+    ("document", "user_id", "user_account"),
+    ("document", "organization_id", "organization"),
+    ("chunks", "document_id", "document"),
+]
+
+
+def replace_foreign_key(table: str, column: str, referred_table: str, on_delete: str):
+    name = f"{table}_{column}_fkey"
+    op.execute(
+        f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}, "
+        f"ADD CONSTRAINT {name} FOREIGN KEY ({column}) "
+        f"REFERENCES {referred_table} (id) {on_delete} NOT VALID"
+    )
+    op.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+
+def upgrade():
+    # autocommit so the validation doesn't run under the lock taken by the ALTER
+    with op.get_context().autocommit_block():
+        op.execute("SET lock_timeout = '5s'")
+        for table, column, referred_table in FOREIGN_KEYS:
+            replace_foreign_key(table, column, referred_table, "ON DELETE CASCADE")
+        op.execute("RESET lock_timeout")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("SET lock_timeout = '5s'")
+        for table, column, referred_table in FOREIGN_KEYS:
+            replace_foreign_key(table, column, referred_table, "")
+        op.execute("RESET lock_timeout")
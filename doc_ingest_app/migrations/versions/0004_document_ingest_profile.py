@@ -0,0 +1,24 @@
+"""per-document ingest profile
+
+Revision ID: 0004_document_ingest_profile
+Revises: 0003_cascading_foreign_keys
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+revision = "0004_document_ingest_profile"
+down_revision = "0003_cascading_foreign_keys"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # nullable without a default, so this is a catalog-only change
+    op.add_column("document", sa.Column("ingest_profile", JSONB(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("document", "ingest_profile")
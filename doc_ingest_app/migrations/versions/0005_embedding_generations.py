@@ -0,0 +1,52 @@
+"""embedding generations
+
+Registers the current embedding model as generation 1, stored in the
+existing chunks.embedding column. tasks.reembed_chunks adds later
+generations as embedding_v<N> columns. The existing column becomes nullable
+because chunks ingested after it is retired no longer fill it.
+
+Revision ID: 0005_embedding_generations
+Revises: 0004_document_ingest_profile
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005_embedding_generations"
+down_revision = "0004_document_ingest_profile"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    generation = op.create_table(
+        "embedding_generation",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("model_name", sa.String(), nullable=False),
+        sa.Column("dim", sa.Integer(), nullable=False),
+        sa.Column("column_name", sa.String(), nullable=False, unique=True),
+        sa.Column("state", sa.String(16), nullable=False),
+        sa.Column("checkpoint_id", sa.UUID(), nullable=True),
+        sa.Column("chunks_done", sa.BigInteger(), nullable=False, server_default="0"),
+        sa.Column("created_at", sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column("activated_at", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_embedding_generation_state", "embedding_generation", ["state"])
+    op.bulk_insert(generation, [{
+        "id": 1,
+        "model_name": "sentence-transformers/all-MiniLM-L6-v2",
+        "dim": 384,
+        "column_name": "embedding",
+        "state": "active",
+        "chunks_done": 0,
+    }])
+    op.execute("SELECT setval('embedding_generation_id_seq', 1)")
+    # catalog-only, no table rewrite
+    op.alter_column("chunks", "embedding", nullable=True)
+
+
+def downgrade():
+    op.alter_column("chunks", "embedding", nullable=False)
+    op.drop_index("ix_embedding_generation_state", table_name="embedding_generation")
+    op.drop_table("embedding_generation")
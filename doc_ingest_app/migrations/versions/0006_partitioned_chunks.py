@@ -0,0 +1,116 @@
+"""partitioned chunks
+
+Rebuilds chunks as a table LIST partitioned on a new owner_id column (the
+document's user_id or organization_id). Owners get their own partition
+through partitions.promote_owner; until then they share chunks_shared, the
+default partition, which is HASH partitioned on owner_id.
+
+Every row is copied into the new table, along with the embedding_v<N>
+columns of generations that weren't dropped, and the indexes are built
+afterwards. Writes to chunks are blocked while it runs, so plan for a
+maintenance window on large databases.
+
+Revision ID: 0006_partitioned_chunks
+Revises: 0005_embedding_generations
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006_partitioned_chunks"
+down_revision = "0005_embedding_generations"
+branch_labels = None
+depends_on = None
+
+
+HASH_PARTITIONS = 16
+
+HNSW_INDEX_SQL = "CREATE INDEX {index} ON chunks USING hnsw ({column} vector_l2_ops) WITH (m = 16, ef_construction = 64)"
+
+
+def generation_columns(conn):
+    # (column, type) of every generation still stored in chunks
+    rows = conn.execute(sa.text("""
+        SELECT g.column_name, format_type(a.atttypid, a.atttypmod) AS type
+        FROM embedding_generation g
+        JOIN pg_attribute a ON a.attrelid = 'chunks'::regclass AND a.attname = g.column_name AND NOT a.attisdropped
+        WHERE g.state <> 'dropped'
+        ORDER BY g.id
+    """)).all()
+    return [(row.column_name, row.type) for row in rows]
+
+
+def create_indexes(columns, partitioned: bool):
+    op.execute("SET LOCAL maintenance_work_mem = '512MB'")
+    if partitioned:
+        op.execute("ALTER TABLE chunks ADD PRIMARY KEY (id, owner_id)")
+    else:
+        op.execute("ALTER TABLE chunks ADD PRIMARY KEY (id)")
+    op.execute(
+        "ALTER TABLE chunks ADD CONSTRAINT chunks_document_id_fkey FOREIGN KEY (document_id) "
+        "REFERENCES document (id) ON DELETE CASCADE"
+    )
+    op.execute("CREATE INDEX ix_chunks_document_id ON chunks (document_id)")
+    for column, _ in columns:
+        op.execute(HNSW_INDEX_SQL.format(index=f"ix_chunks_{column}_hnsw", column=column))
+
+
+def upgrade():
+    conn = op.get_bind()
+    op.execute("SET LOCAL lock_timeout = '5s'")
+    op.execute("LOCK TABLE chunks IN EXCLUSIVE MODE")
+    columns = generation_columns(conn)
+    extra = [(column, type_) for column, type_ in columns if column != "embedding"]
+
+    op.execute("ALTER TABLE chunks RENAME TO chunks_unpartitioned")
+    op.execute(f"""
+        CREATE TABLE chunks (
+            id uuid NOT NULL,
+            owner_id uuid NOT NULL,
+            document_id uuid NOT NULL,
+            chunk varchar NOT NULL,
+            embedding vector(384)
+            {"".join(f", {column} {type_}" for column, type_ in extra)}
+        ) PARTITION BY LIST (owner_id)
+    """)
+    op.execute("CREATE TABLE chunks_shared PARTITION OF chunks DEFAULT PARTITION BY HASH (owner_id)")
+    for i in range(HASH_PARTITIONS):
+        op.execute(
+            f"CREATE TABLE chunks_h{i} PARTITION OF chunks_shared "
+            f"FOR VALUES WITH (MODULUS {HASH_PARTITIONS}, REMAINDER {i})"
+        )
+
+    copied = ["id", "document_id", "chunk", "embedding"] + [column for column, _ in extra]
+    op.execute(f"""
+        INSERT INTO chunks (owner_id, {", ".join(copied)})
+        SELECT coalesce(d.user_id, d.organization_id), {", ".join(f"c.{column}" for column in copied)}
+        FROM chunks_unpartitioned c
+        JOIN document d ON d.id = c.document_id
+    """)
+    op.execute("DROP TABLE chunks_unpartitioned")
+    create_indexes(columns, partitioned=True)
+
+
+def downgrade():
+    conn = op.get_bind()
+    op.execute("SET LOCAL lock_timeout = '5s'")
+    op.execute("LOCK TABLE chunks IN EXCLUSIVE MODE")
+    columns = generation_columns(conn)
+    extra = [(column, type_) for column, type_ in columns if column != "embedding"]
+
+    op.execute("ALTER TABLE chunks RENAME TO chunks_partitioned")
+    op.execute(f"""
+        CREATE TABLE chunks (
+            id uuid NOT NULL,
+            document_id uuid NOT NULL,
+            chunk varchar NOT NULL,
+            embedding vector(384)
+            {"".join(f", {column} {type_}" for column, type_ in extra)}
+        )
+    """)
+    copied = ", ".join(["id", "document_id", "chunk", "embedding"] + [column for column, _ in extra])
+    op.execute(f"INSERT INTO chunks ({copied}) SELECT {copied} FROM chunks_partitioned")
+    # takes the shared and every promoted owner's partition with it
+    op.execute("DROP TABLE chunks_partitioned")
+    create_indexes(columns, partitioned=False)
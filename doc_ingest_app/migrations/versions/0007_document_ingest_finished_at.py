@@ -0,0 +1,39 @@
+"""ingest finished_at index
+
+Indexes document.ingest_profile->>'finished_at' for the profiled documents,
+so GET /admin/ingest/stats reads the most recent ingests from the index
+instead of sorting every profile. Built concurrently like 0002; a failed
+build leaves an INVALID index behind, drop it and run the upgrade again.
+
+Revision ID: 0007_document_ingest_finished_at
+Revises: 0006_partitioned_chunks
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007_document_ingest_finished_at"
+down_revision = "0006_partitioned_chunks"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.execute("SET lock_timeout = '5s'")
+        op.create_index(
+            "ix_document_ingest_finished_at",
+            "document",
+            [sa.text("(ingest_profile ->> 'finished_at')")],
+            postgresql_where=sa.text("ingest_profile IS NOT NULL"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        op.execute("RESET lock_timeout")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_document_ingest_finished_at", table_name="document",
+                      postgresql_concurrently=True, if_exists=True)
@@ -93,6 +93,8 @@ class ConversationUpdateResponse(BaseModel):
 class ConversationEntryResponse(ConversationBase):
     id: UUID
     created_at: datetime
+    # the first message, whose response streams from /{id}/messages/{message_id}/stream
+    message_id: UUID
 
 
 class ConversationResponse(BaseModel):
@@ -101,6 +103,8 @@ class ConversationResponse(BaseModel):
     title: Optional[str]
     document_ids: Optional[List[UUID]]
     messages: Optional[List[MessageResponse]]
+    # delta sync position, pass back as since
+    cursor: Optional[datetime] = None
 
 
 # Enum for Ownership Type
@@ -116,6 +120,16 @@ class SearchResponse(BaseModel):
     chunk: str
     similarity: float
 
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=50)
+    k: int = Field(default=10, ge=1, le=100)
+
+
+class BatchSearchResponse(BaseModel):
+    query: str
+    results: List[SearchResponse]
+
 class MessageBase(BaseModel):
     query: str
     response: Optional[str] = None
@@ -1,5 +1,6 @@
 from typing import List, Optional
-from sqlalchemy import ForeignKey, String, types
+from sqlalchemy import DDL, ForeignKey, Index, String, event, text, types
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from pgvector.sqlalchemy import Vector
 from uuid import UUID
@@ -13,13 +14,13 @@ class User(Base):
     id: Mapped[UUID] = mapped_column(types.UUID, primary_key=True)
     username: Mapped[str] = mapped_column(unique=True)
     email: Mapped[str] = mapped_column(unique=True)
-    organization_id: Mapped[Optional[UUID]] = mapped_column(types.UUID, ForeignKey("organization.id"))
+    organization_id: Mapped[Optional[UUID]] = mapped_column(types.UUID, ForeignKey("organization.id", ondelete="CASCADE"), index=True)
     organization: Mapped[Optional["Organization"]] = relationship(back_populates="users")  # Add this line
     conversations: Mapped[List["Conversation"]] = relationship(
-        back_populates="user", cascade="all, delete-orphan"
+        back_populates="user", cascade="all, delete-orphan", passive_deletes=True
     )
     documents: Mapped[List["Document"]] = relationship(
-        back_populates="user", cascade="all, delete-orphan"
+        back_populates="user", cascade="all, delete-orphan", passive_deletes=True
     )
     def __repr__(self) -> str:
         return f"User(id={self.id!r}, name={self.username!r})"
@@ -27,10 +28,10 @@ class User(Base):
 class Conversation(Base):
     __tablename__ = "conversation"
     id: Mapped[UUID] = mapped_column(types.UUID, primary_key=True)
-    user_id: Mapped[UUID] = mapped_column(types.UUID, ForeignKey("user_account.id"))
+    user_id: Mapped[UUID] = mapped_column(types.UUID, ForeignKey("user_account.id", ondelete="CASCADE"), index=True)
     user: Mapped["User"] = relationship(back_populates="conversations")
     messages: Mapped[List["Message"]] = relationship(
-        back_populates="conversation", cascade="all, delete-orphan"
+        back_populates="conversation", cascade="all, delete-orphan", passive_deletes=True
     )
     created_at: Mapped[datetime] = mapped_column(types.DateTime, default=datetime.now(timezone.utc))
     document_ids: Mapped[Optional[List[UUID]]] = mapped_column(types.ARRAY(types.UUID))
@@ -41,49 +42,128 @@ class Conversation(Base):
 class Message(Base):
     __tablename__ = "message"
     id: Mapped[UUID] = mapped_column(types.UUID, primary_key=True)
-    conversation_id: Mapped[UUID] = mapped_column(types.UUID, ForeignKey("conversation.id"))
+    conversation_id: Mapped[UUID] = mapped_column(types.UUID, ForeignKey("conversation.id", ondelete="CASCADE"))
     conversation: Mapped["Conversation"] = relationship(back_populates="messages")
     query: Mapped[str]
     response: Mapped[Optional[str]]
     created_at: Mapped[datetime] = mapped_column(types.DateTime, default=datetime.now(timezone.utc))
     response_at: Mapped[Optional[datetime]] = mapped_column(types.DateTime)
+    __table_args__ = (
+        # also serves lookups on conversation_id alone
+        Index("ix_message_conversation_id_created_at", "conversation_id", "created_at"),
+    )
     def __repr__(self) -> str:
         return f"Message(id={self.id!r}, content={self.content!r})"
 
 class Document(Base):
     __tablename__ = "document"
     id: Mapped[UUID] = mapped_column(types.UUID, primary_key=True)
-    user_id: Mapped[Optional[UUID]] = mapped_column(types.UUID, ForeignKey("user_account.id"))
-    organization_id: Mapped[Optional[UUID]] = mapped_column(types.UUID, ForeignKey("organization.id"))
+    user_id: Mapped[Optional[UUID]] = mapped_column(types.UUID, ForeignKey("user_account.id", ondelete="CASCADE"), index=True)
+    organization_id: Mapped[Optional[UUID]] = mapped_column(types.UUID, ForeignKey("organization.id", ondelete="CASCADE"), index=True)
     user: Mapped[Optional["User"]] = relationship(back_populates="documents")
     organization: Mapped[Optional["Organization"]] = relationship(back_populates="documents")
-    file_name: Mapped[str]
+    file_name: Mapped[str] = mapped_column(index=True)
+    # per-stage timings recorded by proccess_file, see profiling.IngestProfiler
+    ingest_profile: Mapped[Optional[dict]] = mapped_column(JSONB)
     chunks: Mapped[List["Chunks"]] = relationship(
-        back_populates="document", cascade="all, delete-orphan"
+        back_populates="document", cascade="all, delete-orphan", passive_deletes=True
+    )
+    __table_args__ = (
+        # GET /admin/ingest/stats reads the most recent profiles
+        Index(
+            "ix_document_ingest_finished_at",
+            text("(ingest_profile ->> 'finished_at')"),
+            postgresql_where=text("ingest_profile IS NOT NULL"),
+        ),
     )
     def __repr__(self) -> str:
         return f"Document(id={self.id!r}, file_name={self.file_name!r})"
 
+# partitions of chunks_shared, the default partition of chunks
+CHUNK_HASH_PARTITIONS = 16
+
 class Chunks(Base):
     __tablename__ = "chunks"
     id: Mapped[UUID] = mapped_column(types.UUID, primary_key=True)
-    document_id: Mapped[UUID] = mapped_column(types.UUID, ForeignKey("document.id"))
+    # the document's user_id or organization_id, the partition key
+    owner_id: Mapped[UUID] = mapped_column(types.UUID, primary_key=True)
+    document_id: Mapped[UUID] = mapped_column(types.UUID, ForeignKey("document.id", ondelete="CASCADE"), index=True)
     document: Mapped["Document"] = relationship(back_populates="chunks")
     chunk: Mapped[str]
-    embedding: Mapped[Vector] = mapped_column(Vector(384))
+    # vectors of the first embedding generation; later generations live in
+    # embedding_v<N> columns that the re-embedding job adds, see generations.py
+    embedding: Mapped[Optional[Vector]] = mapped_column(Vector(384))
+    __table_args__ = (
+        # ANN index used by searches over large candidate sets
+        Index(
+            "ix_chunks_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_l2_ops"},
+        ),
+        # owners promoted by partitions.promote_owner get a LIST partition of
+        # their own, the rest share the default one, hashed on owner_id
+        {"postgresql_partition_by": "LIST (owner_id)"},
+    )
     def __repr__(self) -> str:
         return f"Chunks(id={self.id!r}, chunk={self.chunk!r})"
     
 
+event.listen(
+    Chunks.__table__,
+    "after_create",
+    DDL(
+        "CREATE TABLE chunks_shared PARTITION OF chunks DEFAULT PARTITION BY HASH (owner_id);"
+        + "".join(
+            f"CREATE TABLE chunks_h{i} PARTITION OF chunks_shared "
+            f"FOR VALUES WITH (MODULUS {CHUNK_HASH_PARTITIONS}, REMAINDER {i});"
+            for i in range(CHUNK_HASH_PARTITIONS)
+        )
+    )
+)
+
+class EmbeddingGeneration(Base):
+    """
+    One embedding model's vectors for every chunk. Searches use the single
+    `active` generation; a `building` one is being backfilled by
+    tasks.reembed_chunks and written alongside it by new ingests.
+    """
+    __tablename__ = "embedding_generation"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    model_name: Mapped[str]
+    dim: Mapped[int]
+    column_name: Mapped[str] = mapped_column(unique=True)
+    state: Mapped[str] = mapped_column(String(16), index=True)
+    # re-embedding progress: chunks are visited in id order
+    checkpoint_id: Mapped[Optional[UUID]] = mapped_column(types.UUID)
+    chunks_done: Mapped[int] = mapped_column(types.BigInteger, default=0)
+    created_at: Mapped[datetime] = mapped_column(types.DateTime, default=lambda: datetime.now(timezone.utc))
+    activated_at: Mapped[Optional[datetime]] = mapped_column(types.DateTime)
+    def __repr__(self) -> str:
+        return f"EmbeddingGeneration(id={self.id!r}, model_name={self.model_name!r}, state={self.state!r})"
+
+# the row migration 0005 seeds for the `embedding` column, so schemas built
+# with create_all number later generations the same way migrated ones do
+event.listen(
+    EmbeddingGeneration.__table__,
+    "after_create",
+    DDL(
+        "INSERT INTO embedding_generation (id, model_name, dim, column_name, state, chunks_done, created_at) "
+        "VALUES (1, 'sentence-transformers/all-MiniLM-L6-v2', 384, 'embedding', 'active', 0, now());"
+        "SELECT setval('embedding_generation_id_seq', 1);"
+    )
+)
+
 class Organization(Base):
     __tablename__ = "organization"
     id: Mapped[UUID] = mapped_column(primary_key=True,)
     name: Mapped[str]
     users: Mapped[List["User"]] = relationship(
-        back_populates="organization", cascade="all"
+        back_populates="organization", cascade="all", passive_deletes=True
     )
     documents: Mapped[List["Document"]] = relationship(
-        back_populates="organization", cascade="all, delete-orphan"
+        back_populates="organization", cascade="all, delete-orphan", passive_deletes=True
     )
     def __repr__(self) -> str:
         return f"Organization(id={self.id!r}, name={self.name!r})"
\ No newline at end of file
@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import re
+from typing import Iterable, List, Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+
+# chunks is LIST partitioned on owner_id: promoted owners get a partition of
+# their own, everyone else lands in SHARED_PARTITION, the default partition,
+# which is HASH partitioned on owner_id (see models.sql_models)
+SHARED_PARTITION = "chunks_shared"
+OWNER_PARTITION_PREFIX = "chunks_o_"
+MAX_IDENTIFIER_LENGTH = 63
+
+# parents come before their partitions
+PARTITION_TREE_SQL = text("""
+    SELECT relid::regclass::text AS name, parentrelid::regclass::text AS parent, isleaf
+    FROM pg_partition_tree('chunks')
+    ORDER BY level
+""")
+# tables already covered by an index or one of its partition indexes
+INDEXED_TABLES_SQL = text("""
+    SELECT i.indrelid::regclass::text
+    FROM pg_partition_tree(CAST(:index AS regclass)) t
+    JOIN pg_index i ON i.indexrelid = t.relid
+""")
+# indexes defined on chunks itself, with the constraint they back if any
+PARENT_INDEXES_SQL = text("""
+    SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS definition, con.contype
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    LEFT JOIN pg_constraint con ON con.conindid = i.indexrelid AND con.conrelid = i.indrelid
+    WHERE i.indrelid = 'chunks'::regclass
+""")
+PARENT_FOREIGN_KEYS_SQL = text("""
+    SELECT conname AS name, pg_get_constraintdef(oid) AS definition
+    FROM pg_constraint
+    WHERE conrelid = 'chunks'::regclass AND contype = 'f'
+""")
+CHUNK_COLUMNS_SQL = text(
+    "SELECT column_name FROM information_schema.columns WHERE table_name = 'chunks' ORDER BY ordinal_position"
+)
+ATTACHED_SQL = text("SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:name))")
+PARTITION_SIZES_SQL = text("""
+    SELECT c.relname AS name, c.reltuples::bigint AS rows, pg_total_relation_size(c.oid) AS bytes
+    FROM pg_partition_tree('chunks') t
+    JOIN pg_class c ON c.oid = t.relid
+    WHERE t.isleaf
+    ORDER BY bytes DESC
+""")
+
+
+def owner_partition_name(owner_id: UUID) -> str:
+    # task arguments arrive as strings
+    return f"{OWNER_PARTITION_PREFIX}{UUID(str(owner_id)).hex}"
+
+
+def partition_index_name(index: str, table: str) -> str:
+    """
+    Name of `index` on one partition of chunks, shortened with a hash when
+    it would go past Postgres' identifier limit.
+    """
+    name = f"{index}_{table.removeprefix('chunks_')}"
+    if len(name) > MAX_IDENTIFIER_LENGTH:
+        name = f"{name[:MAX_IDENTIFIER_LENGTH - 9]}_{hashlib.md5(name.encode()).hexdigest()[:8]}"
+    return name
+
+
+def _index_state(conn, name: str) -> Optional[bool]:
+    # None when the index doesn't exist, else whether it is valid
+    return conn.scalar(
+        text("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"),
+        {"name": name}
+    )
+
+
+def create_index(engine: Engine, name: str, definition: str) -> None:
+    """
+    Builds `CREATE INDEX name ON chunks <definition>` without blocking
+    writes. CONCURRENTLY isn't available on partitioned tables, so the
+    index is created on the parents only and built concurrently on each
+    leaf partition, then attached. Leaves that already have it are skipped,
+    so an interrupted build can be run again.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if _index_state(conn, name):
+            return
+        conn.execute(text("SET maintenance_work_mem = '512MB'"))
+        tree = conn.execute(PARTITION_TREE_SQL).all()
+        root = tree[0]
+        indexes = {root.name: name}
+        indexed = set()
+        if not root.isleaf:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {root.name} {definition}"))
+            indexed = set(conn.scalars(INDEXED_TABLES_SQL, {"index": name}))
+
+        for partition in tree:
+            index = indexes.setdefault(partition.name, partition_index_name(name, partition.name))
+            if partition.name in indexed:
+                # e.g. built when the partition was attached
+                continue
+            if not partition.isleaf:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON ONLY {partition.name} {definition}"))
+            else:
+                state = _index_state(conn, index)
+                if state is False:
+                    # left behind by a failed concurrent build
+                    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index}"))
+                if not state:
+                    conn.execute(text(f"CREATE INDEX CONCURRENTLY {index} ON {partition.name} {definition}"))
+            if partition.parent is not None:
+                conn.execute(text(f"ALTER INDEX {indexes[partition.parent]} ATTACH PARTITION {index}"))
+
+
+def drop_index(engine: Engine, name: str) -> None:
+    """
+    Drops an index on chunks, concurrently unless it is partitioned: those
+    can only be dropped with a short exclusive lock on the table.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        relkind = conn.scalar(text("SELECT relkind FROM pg_class WHERE relname = :name"), {"name": name})
+        if relkind is None:
+            return
+        if relkind == "I":
+            conn.execute(text("SET lock_timeout = '5s'"))
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        else:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+def _partition_ddl(conn, name: str) -> List[str]:
+    """
+    Statements giving the standalone table `name` the indexes and
+    constraints of chunks, so attaching it only links them.
+    """
+    statements = []
+    for row in conn.execute(PARENT_INDEXES_SQL):
+        index = partition_index_name(row.name, name)
+        definition = re.sub(r"^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+", rf"CREATE \1INDEX {index} ON {name}",
+                            row.definition)
+        statements.append(definition)
+        if row.contype == "p":
+            # attach only matches an index that backs the same kind of constraint
+            statements.append(f"ALTER TABLE {name} ADD CONSTRAINT {index} PRIMARY KEY USING INDEX {index}")
+    for row in conn.execute(PARENT_FOREIGN_KEYS_SQL):
+        statements.append(
+            f"ALTER TABLE {name} ADD CONSTRAINT {partition_index_name(row.name, name)} {row.definition}"
+        )
+    return statements
+
+
+def promote_owner(engine: Engine, owner_id: UUID) -> dict:
+    """
+    Moves an owner's chunks out of the shared partition into a LIST
+    partition of their own, so their searches scan only their rows and
+    deleting them becomes a partition drop.
+
+    The rows are copied and indexed in a standalone table first, without
+    blocking anyone. Then, with writes to chunks held, the changes made
+    since are applied, the rows leave the shared partition and the table
+    is attached, which finds its indexes in place. The attach still scans
+    the shared partition for rows of the owner under an exclusive lock, so
+    run it off-peak.
+    """
+    name = owner_partition_name(owner_id)
+    with engine.connect() as conn:
+        with conn.begin():
+            if conn.scalar(text("SELECT to_regclass(:name)"), {"name": name}):
+                if conn.scalar(ATTACHED_SQL, {"name": name}):
+                    return {"partition": name, "moved": 0}
+                # left behind by an interrupted promotion
+                conn.execute(text(f"DROP TABLE {name}"))
+
+        with conn.begin():
+            column_names = list(conn.scalars(CHUNK_COLUMNS_SQL))
+            columns = ", ".join(column_names)
+            conn.execute(text("SET LOCAL maintenance_work_mem = '512MB'"))
+            conn.execute(text(f"CREATE TABLE {name} (LIKE chunks INCLUDING DEFAULTS)"))
+            copied = conn.execute(
+                text(f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {SHARED_PARTITION} WHERE owner_id = :owner"),
+                {"owner": owner_id}
+            ).rowcount
+            # the HNSW build, the slow part, runs before anything is locked
+            for statement in _partition_ddl(conn, name):
+                conn.execute(text(statement))
+
+        with conn.begin():
+            conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+            # no chunk of the owner can be written to the shared partition while it moves
+            conn.execute(text("LOCK TABLE chunks IN SHARE ROW EXCLUSIVE MODE"))
+            params = {"owner": owner_id}
+            conn.execute(text(
+                f"DELETE FROM {name} n WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {SHARED_PARTITION} s WHERE s.owner_id = :owner AND s.id = n.id)"
+            ), params)
+            # e.g. vectors written by a re-embedding job since the copy
+            shared_row = ", ".join(f"s.{column}" for column in column_names)
+            conn.execute(text(
+                f"UPDATE {name} n SET ({columns}) = ROW({shared_row}) "
+                f"FROM {SHARED_PARTITION} s WHERE s.owner_id = :owner AND s.id = n.id "
+                f"AND ROW({', '.join(f'n.{column}' for column in column_names)}) IS DISTINCT FROM ROW({shared_row})"
+            ), params)
+            conn.execute(text(
+                f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {SHARED_PARTITION} s "
+                f"WHERE s.owner_id = :owner ON CONFLICT DO NOTHING"
+            ), params)
+            moved = conn.execute(
+                text(f"DELETE FROM {SHARED_PARTITION} WHERE owner_id = :owner"), params
+            ).rowcount
+            conn.execute(text(f"ALTER TABLE chunks ATTACH PARTITION {name} FOR VALUES IN ('{owner_id}')"))
+    logger.info("Moved %s chunks of owner %s to partition %s (%s copied ahead)", moved, owner_id, name, copied)
+    return {"partition": name, "moved": moved}
+
+
+def drop_owner_partition(engine: Engine, owner_id: UUID) -> Optional[int]:
+    """
+    Drops a promoted owner's partition with all their chunks, returning
+    roughly how many there were, or None when the owner has no partition.
+    """
+    name = owner_partition_name(owner_id)
+    with engine.connect() as conn, conn.begin():
+        rows = conn.scalar(text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"), {"name": name})
+        if rows is None:
+            return None
+        conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+        conn.execute(text(f"ALTER TABLE chunks DETACH PARTITION {name}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+    logger.info("Dropped partition %s", name)
+    return max(rows, 0)
+
+
+def drop_owner_partitions(engine: Engine, owner_ids: Iterable[UUID]) -> int:
+    return sum(drop_owner_partition(engine, owner_id) or 0 for owner_id in owner_ids)
+
+
+def partition_status(session: Session) -> List[dict]:
+    partitions = []
+    for row in session.execute(PARTITION_SIZES_SQL):
+        partition = row._asdict()
+        if row.name.startswith(OWNER_PARTITION_PREFIX):
+            partition["owner_id"] = UUID(row.name.removeprefix(OWNER_PARTITION_PREFIX))
+        partitions.append(partition)
+    return partitions
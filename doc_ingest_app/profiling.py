@@ -0,0 +1,40 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+class IngestProfiler:
+    """
+    Collects wall time, CPU time, bytes and chunk counts for each stage of an
+    ingest. CPU time is process-wide so it includes the model's worker threads.
+    """
+    def __init__(self):
+        self.stages = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the block as stage `name`. The yielded dict can be updated with
+        the stage's `bytes` and `chunks`. A stage run several times, e.g.
+        once per batch, adds up.
+        """
+        record = {"bytes": 0, "chunks": 0}
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record["wall_ms"] = (time.perf_counter() - wall_start) * 1000
+            record["cpu_ms"] = (time.process_time() - cpu_start) * 1000
+            previous = self.stages.get(name)
+            if previous is not None:
+                record = {key: previous.get(key, 0) + value for key, value in record.items()}
+            self.stages[name] = record
+
+    def as_dict(self) -> dict:
+        return {
+            "stages": self.stages,
+            "total_wall_ms": (time.perf_counter() - self._start) * 1000,
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+        }
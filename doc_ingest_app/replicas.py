@@ -0,0 +1,122 @@
+import logging
+import time
+from itertools import count
+from threading import Lock
+from typing import List, Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.engine import URL, Engine, create_engine
+
+from .cache import has_recent_write, mark_recent_write
+from .metrics import DB_READ_ROUTES, DB_REPLICA_LAG
+
+logger = logging.getLogger(__name__)
+
+
+# streaming replicas of the primary in dependencies.url, reads stay on the primary when empty
+REPLICA_URLS: List[URL] = []
+# replicas further behind than this are skipped until they catch up
+MAX_REPLICA_LAG_SECONDS = 5.0
+# how long an owner's reads stay on the primary after they upload or post a message.
+# Keep it above MAX_REPLICA_LAG_SECONDS: search results read in that window are
+# cached under the owner's new version, so they must not come from a replica
+READ_YOUR_WRITES_SECONDS = 10
+LAG_CHECK_INTERVAL_SECONDS = 1.0
+
+# zero while the replica has replayed everything it received, so an idle
+# primary doesn't make the replica look behind. NULL while its WAL receiver
+# isn't streaming: it has replayed what it got, but that can be arbitrarily old
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class Replica:
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.name = engine.url.render_as_string(hide_password=True)
+        self.lag: Optional[float] = None
+        self.checked_at = 0.0
+
+
+class ReplicaRouter:
+    """
+    Picks the engine for read-only sessions: a replica within the lag
+    tolerance, round-robin, unless one of the owners being read wrote
+    recently. Returns None whenever the primary should serve the read.
+    """
+    def __init__(self, replica_urls: List[URL], max_lag: float = MAX_REPLICA_LAG_SECONDS,
+                 sticky_seconds: int = READ_YOUR_WRITES_SECONDS,
+                 check_interval: float = LAG_CHECK_INTERVAL_SECONDS):
+        self.replicas: List[Replica] = []
+        self.set_replicas(replica_urls)
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+        self.check_interval = check_interval
+        self._next = count()
+        self._lock = Lock()
+
+    def set_replicas(self, replica_urls: List[URL]) -> None:
+        self.dispose()
+        self.replicas = [Replica(create_engine(replica_url, pool_pre_ping=True)) for replica_url in replica_urls]
+
+    def mark_write(self, *owner_ids: Optional[UUID]) -> None:
+        if not self.replicas:
+            return
+        for owner_id in owner_ids:
+            mark_recent_write(owner_id, self.sticky_seconds)
+
+    def _refresh_lag(self, replica: Replica) -> None:
+        now = time.monotonic()
+        if now - replica.checked_at < self.check_interval:
+            return
+        with self._lock:
+            if now - replica.checked_at < self.check_interval:
+                return
+            replica.checked_at = now
+        try:
+            with replica.engine.connect() as conn:
+                lag = conn.scalar(REPLICA_LAG_SQL)
+        except Exception as e:
+            logger.warning("Could not measure lag of replica %s: %s", replica.name, e)
+            replica.lag = None
+            return
+        if lag is None:
+            logger.warning("Replica %s is not streaming from the primary", replica.name)
+            replica.lag = None
+            return
+        replica.lag = float(lag)
+        DB_REPLICA_LAG.labels(replica.name).set(replica.lag)
+
+    def engine_for_read(self, *owner_ids: Optional[UUID]) -> Optional[Engine]:
+        if not self.replicas:
+            return None
+        if has_recent_write(*owner_ids):
+            DB_READ_ROUTES.labels("primary", "recent_write").inc()
+            return None
+
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            self._refresh_lag(replica)
+            if replica.lag is not None and replica.lag <= self.max_lag:
+                DB_READ_ROUTES.labels("replica", "ok").inc()
+                return replica.engine
+
+        DB_READ_ROUTES.labels("primary", "replicas_lagging").inc()
+        return None
+
+    def status(self) -> List[dict]:
+        return [
+            {"replica": replica.name, "lag_s": replica.lag, "healthy": replica.lag is not None and replica.lag <= self.max_lag}
+            for replica in self.replicas
+        ]
+
+    def dispose(self) -> None:
+        for replica in self.replicas:
+            replica.engine.dispose()
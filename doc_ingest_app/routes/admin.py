@@ -0,0 +1,154 @@
+from typing import Literal, Optional
+from uuid import UUID
+
+from fastapi import APIRouter, File, HTTPException, Query, UploadFile, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from ..admission import admission_state
+from ..bulk import export_binary, export_ndjson, import_stream
+from ..cache import bump_owner_version
+from .. import dependencies
+from ..dependencies import SessionDep, identity_cache, read_router
+from ..generations import active_generation, drop_generation, list_generations
+from ..models.api_models import OwnershipType
+from ..partitions import partition_status, promote_owner
+from ..tasks import reembed_chunks
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"]
+)
+
+INGEST_STAGE_STATS = text("""
+    WITH recent AS (
+        SELECT ingest_profile
+        FROM document
+        WHERE ingest_profile IS NOT NULL
+        ORDER BY ingest_profile->>'finished_at' DESC
+        LIMIT :limit
+    )
+    SELECT
+        stage.key AS stage,
+        count(*) AS ingests,
+        percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY (stage.value->>'wall_ms')::float) AS wall_ms,
+        percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY (stage.value->>'cpu_ms')::float) AS cpu_ms,
+        sum((stage.value->>'bytes')::bigint) AS bytes,
+        sum((stage.value->>'chunks')::bigint) AS chunks,
+        sum((stage.value->>'wall_ms')::float) AS total_wall_ms
+    FROM recent, jsonb_each(recent.ingest_profile->'stages') AS stage
+    GROUP BY stage.key
+    ORDER BY stage.key
+""")
+
+
+@router.get("/ingest/stats")
+async def ingest_stage_stats(session: SessionDep, limit: int = Query(500, ge=1, le=10000)):
+    """
+    p50/p95/p99 wall and CPU time per ingest stage over the most recent
+    `limit` profiled documents, with throughput for each stage.
+    """
+    stats = {}
+    for row in session.execute(INGEST_STAGE_STATS, {"limit": limit}):
+        seconds = row.total_wall_ms / 1000 if row.total_wall_ms else 0
+        stats[row.stage] = {
+            "ingests": row.ingests,
+            "wall_ms": dict(zip(["p50", "p95", "p99"], row.wall_ms)),
+            "cpu_ms": dict(zip(["p50", "p95", "p99"], row.cpu_ms)),
+            "bytes_per_sec": row.bytes / seconds if seconds else None,
+            "chunks_per_sec": row.chunks / seconds if seconds else None,
+        }
+    return stats
+
+
+@router.get("/cache/identity")
+async def identity_cache_stats():
+    return identity_cache.stats.as_dict()
+
+
+@router.get("/db/replicas")
+async def replica_status():
+    return read_router.status()
+
+
+@router.get("/ingest/admission")
+async def ingest_admission(owner_id: Optional[UUID] = None):
+    return admission_state(owner_id)
+
+
+@router.get("/embeddings")
+async def embedding_generations(session: SessionDep):
+    return list_generations(session)
+
+
+@router.post("/embeddings/reembed", status_code=status.HTTP_202_ACCEPTED)
+async def start_reembed(model_name: str):
+    """
+    Re-embeds every chunk with `model_name` on the backfill queue and
+    switches searches to it when done. Posting the same model again resumes
+    an interrupted run.
+    """
+    task = reembed_chunks.apply_async(args=[model_name])
+    return {"task_id": task.id}
+
+
+@router.post("/embeddings/{generation_id}/drop")
+async def drop_embedding_generation(generation_id: int):
+    try:
+        return drop_generation(dependencies.engine, generation_id)._asdict()
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.get("/export/{owner_type}/{owner_id}")
+async def export_documents(owner_type: OwnershipType, owner_id: UUID,
+                           export_format: Literal["ndjson", "binary"] = Query("ndjson", alias="format")):
+    """
+    Streams the owner's documents and chunks, with the active generation's
+    vectors, for POST /admin/import on another deployment. The files
+    themselves stay in S3.
+    """
+    owner = (owner_type.value, owner_id)
+    engine = read_router.engine_for_read(owner_id) or dependencies.engine
+    if export_format == "binary":
+        body, media_type, extension = export_binary(engine, owner, active_generation()), "application/octet-stream", "bin"
+    else:
+        body, media_type, extension = export_ndjson(engine, owner, active_generation()), "application/x-ndjson", "ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{owner_type.value}-{owner_id}.{extension}"'}
+    )
+
+
+@router.post("/import")
+async def import_documents(file: UploadFile = File(...)):
+    """
+    Loads an export through COPY. Documents and chunks that already exist
+    are skipped, their users and organizations must exist already.
+    """
+    try:
+        # minutes of COPY for large exports, keep it off the event loop
+        imported = await run_in_threadpool(import_stream, dependencies.engine, file.file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # reads move to the primary before cached results are retired
+    read_router.mark_write(*imported["owners"])
+    for owner_id in imported["owners"]:
+        bump_owner_version(owner_id)
+    return imported
+
+
+@router.get("/partitions")
+async def chunk_partitions(session: SessionDep):
+    return partition_status(session)
+
+
+@router.post("/partitions/{owner_id}/promote")
+async def promote_owner_partition(owner_id: UUID):
+    """
+    Moves a large owner's chunks into a partition of their own. Writes to
+    chunks are held while it runs, see partitions.promote_owner.
+    """
+    return await run_in_threadpool(promote_owner, dependencies.engine, owner_id)
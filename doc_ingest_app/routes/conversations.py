@@ -1,27 +1,102 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import List, Annotated
-from sqlalchemy import select
-from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Annotated, Optional, Tuple
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
 from uuid import UUID
+import hashlib
 import uuid
 
 
-from ..dependencies import SessionDep, UserDep, ConversationDep, validate_document_ids_for_user
-from ..models.sql_models import Document, User, Conversation, Message
-from ..models.api_models import ConversationEntryCreate, ConversationEntryResponse, ConversationResponse, ConversationUpdate, ConversationUpdateResponse, MessageResponse
+from ..cache import TTLCache, get_owner_versions
+from ..deadlines import run_cancellable
+from ..generations import active_generation, embedding_column
+from ..dependencies import SessionDep, UserDep, ConversationDep, ConversationForUpdateDep, ConversationReadSessionDep, identity_cache, read_router, validate_document_ids_for_user
+from ..models.sql_models import Chunks, Document, User, Conversation, Message
+from ..models.api_models import ConversationEntryCreate, ConversationEntryResponse, ConversationResponse, ConversationUpdate, ConversationUpdateResponse, MessageResponse, SearchResponse
+from ..streaming import relay_message_stream, sse_event, stream_exists
+from .. import serialization
+from ..serialization import fast_or_model, json_response, rows_to_dicts
+from ..tasks import answers_messages, respond_to_message
+from .search import encode_queries
 
 router = APIRouter(
     prefix="/conversations",
     tags=["Conversations"]
 )
 
+# candidate sets up to this many chunks are searched exactly instead of through the ANN index
+EXACT_SEARCH_MAX_CHUNKS = 20000
+# messages are stamped before their transaction commits, and reads may come
+# from a replica up to replicas.MAX_REPLICA_LAG_SECONDS behind, so a change
+# can become visible after a client's cursor has passed its stamp. Delta
+# syncs re-read this much before the cursor, clients merge messages by id
+DELTA_SYNC_OVERLAP_SECONDS = 30
+
+# (document ids, their owners, the owners' data versions) -> chunk count
+conversation_chunk_counts = TTLCache(maxsize=4096, ttl=300)
+
+
+def resolve_conversation_documents(conversation: Conversation, session) -> Tuple[List[UUID], List[UUID], int]:
+    """
+    Returns the conversation's document ids that its owner can still access,
+    along with the owners of those documents, which pick the partitions of
+    chunks to read, and the number of chunks they hold. Access is checked on
+    every call; the chunk count is cached under the owners' data versions,
+    so ingests and deletes retire it.
+    """
+    if not conversation.document_ids:
+        return [], [], 0
+
+    user = session.scalar(select(User).where(User.id == conversation.user_id))
+    owner_filter = Document.user_id == user.id
+    if user.organization_id:
+        owner_filter = owner_filter | (Document.organization_id == user.organization_id)
+    documents = session.execute(
+        select(Document.id, func.coalesce(Document.user_id, Document.organization_id))
+        .where(Document.id.in_(conversation.document_ids), owner_filter)
+    ).all()
+    document_ids = [document_id for document_id, _ in documents]
+    owner_ids = sorted({owner_id for _, owner_id in documents})
+    if not document_ids:
+        return [], [], 0
+
+    versions = get_owner_versions(*owner_ids)
+    key = (tuple(sorted(document_ids)), tuple(owner_ids), versions)
+    chunk_count = conversation_chunk_counts.get(key) if versions is not None else None
+    if chunk_count is None:
+        chunk_count = session.scalar(
+            select(func.count()).select_from(Chunks)
+            .where(Chunks.owner_id.in_(owner_ids), Chunks.document_id.in_(document_ids))
+        )
+        if versions is not None:
+            conversation_chunk_counts.set(key, chunk_count)
+    return document_ids, owner_ids, chunk_count
+
+def queue_response(session: Session, message: Message, discard) -> None:
+    """
+    Has a chat worker answer the message, when a response generator is
+    configured; otherwise its response stays NULL. When the task can't be
+    queued nothing would ever answer it, so `discard`, the new message or
+    the conversation it started, is deleted again before the error goes up.
+    """
+    if not answers_messages():
+        return
+    try:
+        respond_to_message.apply_async((message.id, message.conversation_id))
+    except Exception:
+        session.delete(discard)
+        session.commit()
+        raise
+
 @router.post("/{user_id}/entry")
 async def start_conversation(user: UserDep, 
                              session: SessionDep, 
                              conversation_entry: ConversationEntryCreate
                              ) -> ConversationEntryResponse:
     # creates a new conversation and sends first message
-    session.merge(user)
     conversation_id = uuid.uuid4()
 
 
@@ -50,17 +125,19 @@ async def start_conversation(user: UserDep,
     session.commit()
     session.refresh(new_conversation)
     session.refresh(new_message)
+    read_router.mark_write(user.id)
 
-    # send a celery task to process the message and produce a response
+    queue_response(session, new_message, discard=new_conversation)
 
     return ConversationEntryResponse(
         id=new_conversation.id,
         created_at=new_message.created_at,
-        document_ids=new_conversation.document_ids
+        document_ids=new_conversation.document_ids,
+        message_id=new_message.id
     )
 
 @router.post("/{conversation_id}/message")
-async def add_message_to_conversation(conversation: ConversationDep,
+async def add_message_to_conversation(conversation: ConversationForUpdateDep,
                                         session: SessionDep,
                                         message_create: ConversationEntryCreate,
                                         ) -> MessageResponse:
@@ -92,14 +169,17 @@ async def add_message_to_conversation(conversation: ConversationDep,
     session.add(new_message)
     session.commit()
     session.refresh(new_message)
+    read_router.mark_write(conversation.user_id)
+    if message_create.document_ids:
+        identity_cache.invalidate("conversation", conversation.id)
 
-    # send a celery task to process the message and produce a response
+    queue_response(session, new_message, discard=new_message)
 
     return new_message
 
 
 @router.put("/{conversation_id}")
-async def update_conversation(conversation: ConversationDep,
+async def update_conversation(conversation: ConversationForUpdateDep,
                                         session: SessionDep,
                                         conversation_update: ConversationUpdate,
                                         )-> ConversationUpdateResponse:
@@ -124,38 +204,146 @@ async def update_conversation(conversation: ConversationDep,
         conversation.title = conversation_update.title  
     session.commit()
     session.refresh(conversation)
+    identity_cache.invalidate("conversation", conversation.id)
+    read_router.mark_write(conversation.user_id)
     return conversation
 
+
+@router.get("/{conversation_id}/search")
+async def search_conversation(conversation: ConversationDep,
+                              session: ConversationReadSessionDep,
+                              query: str,
+                              request: Request,
+                              k: int = Query(10, ge=1, le=100)
+                              ) -> List[SearchResponse]:
+    """
+    Vector search restricted to the documents attached to the conversation.
+    Small candidate sets are scanned exactly, large ones go through the ANN index.
+    The search is cancelled when the client disconnects, and answered 504
+    when it runs past the route's deadline.
+    """
+    document_ids, owner_ids, chunk_count = resolve_conversation_documents(conversation, session)
+    if not chunk_count:
+        return []
+
+    generation = active_generation()
+    query_embedding = (await run_cancellable(request, None, encode_queries, [query], generation))[0]
+    candidates = select(
+        Chunks.id,
+        Chunks.document_id,
+        Chunks.chunk,
+        embedding_column(generation).l2_distance(query_embedding).label("similarity")
+    ).where(Chunks.owner_id.in_(owner_ids), Chunks.document_id.in_(document_ids))
+
+    if chunk_count <= EXACT_SEARCH_MAX_CHUNKS:
+        # materializing keeps the planner off the ANN index so every candidate is scored
+        candidates = candidates.cte("candidates").prefix_with("MATERIALIZED")
+        stmt = select(candidates).order_by(candidates.c.similarity).limit(k)
+    else:
+        # keep scanning the index until k rows survive the document filter
+        session.execute(text("SET LOCAL hnsw.iterative_scan = strict_order"))
+        stmt = candidates.order_by("similarity").limit(k)
+
+    results = await run_cancellable(request, session, lambda: session.execute(stmt).all())
+    return fast_or_model(rows_to_dicts(results))
+
 @router.get("/{conversation_id}")
 async def get_conversation(conversation: ConversationDep, 
-                           session: SessionDep) -> ConversationResponse:
+                           session: ConversationReadSessionDep,
+                           request: Request,
+                           since: Optional[datetime] = None) -> ConversationResponse:
     """
     get_conversation
+    Pass back the returned `cursor` as `since` to only receive messages
+    created or answered after that point, along with those changed in the
+    DELTA_SYNC_OVERLAP_SECONDS before it, which the client may have seen
+    already and merges by id.
+    Responds 304 when the client's ETag still matches.
     """
-    # Check if the conversation exists
-    conversation = session.merge(conversation)
+    if since is not None and since.tzinfo is not None:
+        # the message timestamps are stored as naive UTC
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    # a message last changes when its response arrives
+    changed_at = func.coalesce(Message.response_at, Message.created_at)
+
+    # cheap fingerprint of the conversation, narrowed by the (conversation_id, created_at) index
+    message_count, last_changed_at = session.execute(
+        select(func.count(Message.id), func.max(changed_at))
+        .where(Message.conversation_id == conversation.id)
+    ).one()
+    etag = 'W/"' + hashlib.sha1(
+        f"{conversation.title}|{conversation.document_ids}|{message_count}|{last_changed_at}|{since}".encode("utf-8")
+    ).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    # Fetch messages associated with the conversation as plain rows, no ORM objects needed
+    stmt = select(
+        Message.id,
+        Message.query,
+        Message.response,
+        Message.created_at,
+        Message.response_at,
+        changed_at.label("changed_at")
+    ).where(Message.conversation_id == conversation.id)
+    if since is not None:
+        stmt = stmt.where(changed_at > since - timedelta(seconds=DELTA_SYNC_OVERLAP_SECONDS))
+        stmt = stmt.order_by(changed_at, Message.id)
+    else:
+        stmt = stmt.order_by(Message.created_at, Message.id)
+    rows = session.execute(stmt).all()
+
+    cursor = since
+    if rows:
+        # rows from the overlap alone must not move the cursor back
+        cursor = max([row.changed_at for row in rows] + ([since] if since is not None else []))
 
-    # Fetch messages associated with the conversation
-    messages = session.scalars(
-        select(Message).where(Message.conversation_id == conversation.id)
-    ).all()
     #convert messages to MessageResponse
-    messages = [
-        {
-            "id": message.id,
-            "query": message.query,
-            "response": message.response,
-            "created_at": message.created_at,
-            "response_at": message.response_at
-        }
-        for message in messages
-    ]
-    return ConversationResponse(
-        id=conversation.id,
-        created_at=conversation.created_at,
-        title=conversation.title,
-        messages=messages,
-        document_ids=conversation.document_ids
+    messages = rows_to_dicts(rows)
+    for message in messages:
+        del message["changed_at"]
+    content = {
+        "id": conversation.id,
+        "created_at": conversation.created_at,
+        "title": conversation.title,
+        "messages": messages,
+        "document_ids": conversation.document_ids,
+        "cursor": cursor
+    }
+    if serialization.FAST_JSON_RESPONSES:
+        return json_response(content, headers={"ETag": etag})
+    return JSONResponse(content=jsonable_encoder(ConversationResponse(**content)), headers={"ETag": etag})
+
+
+@router.get("/{conversation_id}/messages/{message_id}/stream")
+async def stream_message_response(conversation: ConversationDep,
+                                  message_id: UUID,
+                                  session: SessionDep):
+    """
+    Server-sent events carrying the message's response tokens as the worker
+    produces them, followed by a `done` event.
+    """
+    message = session.scalar(
+        select(Message).where(Message.id == message_id,
+                              Message.conversation_id == conversation.id)
+    )
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    response_text = message.response
+    if response_text is not None and not await stream_exists(message_id):
+        # finished long enough ago that the stream expired, send the stored text
+        async def replay():
+            yield sse_event("token", response_text)
+            yield sse_event("done", {})
+        events = replay()
+    else:
+        events = relay_message_stream(message_id)
+
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 
@@ -164,10 +352,14 @@ async def get_conversation_history(user_id: str, session: SessionDep) -> List[Co
     """
     get_conversation_history
     """
-    # Fetch all conversations associated with the user without
-    conversations = session.scalars(
+    # Fetch all conversations associated with the user without their messages
+    conversations = rows_to_dicts(session.execute(
         select(Conversation.id,
                Conversation.created_at,
-               Conversation.title).where(Conversation.user_id == user_id)
-    ).all()
-    return conversations
+               Conversation.title,
+               Conversation.document_ids).where(Conversation.user_id == user_id)
+        .order_by(Conversation.created_at)
+    ))
+    for conversation in conversations:
+        conversation["messages"] = None
+    return fast_or_model(conversations)
@@ -1,41 +1,71 @@
+import logging
 import uuid
-from fastapi import APIRouter, File, HTTPException, UploadFile, status
+from typing import Annotated, Optional
+from fastapi import APIRouter, File, Header, HTTPException, UploadFile, status
 from fastapi.responses import FileResponse, StreamingResponse
-from sqlalchemy import select
+from sqlalchemy import delete, select
 from uuid import UUID
-from boto3.session import Session as BotoSession
 from botocore.exceptions import BotoCoreError, ClientError
 from botocore.response import StreamingBody
-from ..tasks import proccess_file
+from ..admission import admit_upload, defer_upload, release_upload
+from ..cache import bump_owner_version
+from ..idempotency import claim_upload_key, release_upload_key, store_upload_response
+from ..tasks import ingest_queue_depth, proccess_file
 from ..models.sql_models import Organization, User, Document
 from ..models.api_models import OwnershipType
-from ..dependencies import SessionDep
+from ..dependencies import SessionDep, read_router
+from ..storage import S3_BUCKET_NAME, get_s3_client
 import os
 
-# S3 Configuration
-S3_BUCKET_NAME = "documents"
-S3_ENDPOINT_URL = "http://localhost:4566"
-AWS_ACCESS_KEY_ID = "test"  # Default LocalStack credentials
-AWS_SECRET_ACCESS_KEY = "test"
-
-# Initialize Boto3 S3 client
-s3_client = BotoSession(
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-).client("s3", endpoint_url=S3_ENDPOINT_URL)
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/files",
     tags=["Files"]
 )
 
+def discard_upload(session: SessionDep, file_id: UUID) -> None:
+    """
+    Removes a stored upload whose ingest couldn't be queued.
+    """
+    session.rollback()
+    session.execute(delete(Document).where(Document.id == file_id))
+    session.commit()
+    try:
+        get_s3_client().delete_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
+    except (BotoCoreError, ClientError) as e:
+        logger.warning("Could not delete unqueued upload %s from S3: %s", file_id, e)
+
 #files of same name are not allowed to be uploaded for simplicity
 @router.post("/{owner_id}/uploadFile", status_code=status.HTTP_201_CREATED)
-async def upload_file(owner_id: UUID, owner_type: OwnershipType, session: SessionDep, file: UploadFile = File(...)):
+async def upload_file(owner_id: UUID, owner_type: OwnershipType, session: SessionDep, file: UploadFile = File(...),
+                      idempotency_key: Annotated[Optional[str], Header()] = None):
     '''
     Uploads file to an S3 bucket and creates a record in the database.
     Calls the proccess_file task to process the file.
+    Responds 429 with Retry-After while the ingest pipeline is saturated.
+    Owners over their fair share of it get status DEFERRED: the file is
+    stored and queued once one of their earlier uploads finishes.
+    Retries sent with the same Idempotency-Key header get the first
+    upload's response back instead of storing the file again.
     '''
+    if idempotency_key is None:
+        return store_upload(owner_id, owner_type, session, file)
+
+    claim = claim_upload_key(owner_id, idempotency_key)
+    if claim.response is not None:
+        return claim.response
+    if not claim.claimed:
+        raise HTTPException(status_code=409, detail="An upload with this Idempotency-Key is in progress")
+    try:
+        response = store_upload(owner_id, owner_type, session, file)
+    except Exception:
+        release_upload_key(owner_id, idempotency_key)
+        raise
+    store_upload_response(owner_id, idempotency_key, response)
+    return response
+
+def store_upload(owner_id: UUID, owner_type: OwnershipType, session: SessionDep, file: UploadFile) -> dict:
     if owner_type == OwnershipType.user:
         user = session.scalar(select(User).where(User.id == owner_id))
         if not user:
@@ -51,31 +81,66 @@ async def upload_file(owner_id: UUID, owner_type: OwnershipType, session: Sessio
     if existing_file:
         raise HTTPException(status_code=400, detail="File already exists")
 
+    size = file.size
+    if size is None:
+        size = file.file.seek(0, os.SEEK_END)
+        file.file.seek(0)
+
+    # decided before anything is stored, so rejected uploads cost nothing
+    admission = admit_upload(owner_id, size, ingest_queue_depth())
+    if admission.decision == "reject":
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Ingest is at capacity ({admission.reason}), retry later",
+            headers={"Retry-After": str(admission.retry_after)}
+        )
+
     file_id = uuid.uuid4()
     try:
-        # Upload file to S3
-        s3_client.upload_fileobj(
-            file.file,  # File-like object
-            S3_BUCKET_NAME,
-            str(file_id)
-        )
-    except (BotoCoreError, ClientError) as e:
-        raise HTTPException(status_code=500, detail=f"Failed to upload file to S3: {str(e)}")
+        try:
+            # Upload file to S3
+            get_s3_client().upload_fileobj(
+                file.file,  # File-like object
+                S3_BUCKET_NAME,
+                str(file_id)
+            )
+        except (BotoCoreError, ClientError) as e:
+            raise HTTPException(status_code=500, detail=f"Failed to upload file to S3: {str(e)}")
 
 
-    new_file = Document(
-        file_name=file.filename,
-        id=file_id,
-        user_id=user.id if owner_type == OwnershipType.user else None,
-        organization_id=org.id if owner_type == OwnershipType.organization else None
-    )
-    session.add(new_file)
+        new_file = Document(
+            file_name=file.filename,
+            id=file_id,
+            user_id=user.id if owner_type == OwnershipType.user else None,
+            organization_id=org.id if owner_type == OwnershipType.organization else None
+        )
+        session.add(new_file)
 
 
-    session.commit()  # Commit the transaction
+        session.commit()  # Commit the transaction
+    except Exception:
+        if admission.decision == "enqueue":
+            release_upload(owner_id, size, file_id)
+        raise
+    read_router.mark_write(owner_id)
 
-    task = proccess_file.delay(file.filename, owner_id, owner_type, file_id)
-    return {"filename": file.filename, "status": task.status, "task_id": task.id}
+    task_kwargs = {"file_name": file.filename, "owner_id": owner_id, "owner_type": owner_type,
+                   "file_id": file_id, "size": size}
+    if admission.decision == "defer":
+        if defer_upload(owner_id, size, task_kwargs):
+            return {"filename": file.filename, "file_id": file_id, "status": "DEFERRED", "task_id": None}
+        # queued without a reservation, its ingest must not hand back bytes it never took
+        task_kwargs["size"] = None
+
+    try:
+        task = proccess_file.apply_async(kwargs=task_kwargs)
+    except Exception:
+        if admission.decision == "enqueue":
+            release_upload(owner_id, size, file_id)
+        # nothing will ingest the document, so a retry must not be turned away as a duplicate
+        discard_upload(session, file_id)
+        raise
+    return {"filename": file.filename, "file_id": file_id, "status": task.status, "task_id": task.id}
 
 @router.get("/{file_id}/download")
 async def download_file_s3(file_id: UUID, session: SessionDep) -> dict:
@@ -89,7 +154,7 @@ async def download_file_s3(file_id: UUID, session: SessionDep) -> dict:
     
     try:
         # Get the file object from S3
-        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
+        s3_object = get_s3_client().get_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
         file_stream: StreamingBody = s3_object["Body"]  # StreamingBody object
     except (BotoCoreError, ClientError) as e:
         raise HTTPException(status_code=500, detail=f"Failed to stream file from S3: {str(e)}")
@@ -113,10 +178,14 @@ async def delete_file(file_id: UUID, session: SessionDep):
 
     try:
         # Delete the file from S3
-        s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
+        get_s3_client().delete_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
     except (BotoCoreError, ClientError) as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete file from S3: {str(e)}")
 
+    owner_id = file.user_id or file.organization_id
     session.delete(file)
     session.commit()
+    # reads move to the primary before cached results are retired
+    read_router.mark_write(owner_id)
+    bump_owner_version(owner_id)
     return {"message": "File deleted successfully"}
\ No newline at end of file
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
+
+from ..warmup import state
+
+router = APIRouter(
+    prefix="/health",
+    tags=["Health"]
+)
+
+@router.get("/live")
+async def liveness():
+    """
+    The process is up and serving requests; says nothing about warm-up.
+    """
+    return {"status": "alive"}
+
+@router.get("/ready")
+async def readiness():
+    """
+    200 once the database is reachable and the embedding model is loaded,
+    503 with the warm-up state until then.
+    """
+    if not state.ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=state.as_dict())
+    return state.as_dict()
+
+@router.get("/startup")
+async def startup_timings():
+    """
+    Time spent importing, setting up the app and in each warm-up step.
+    """
+    return state.as_dict()
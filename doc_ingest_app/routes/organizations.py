@@ -1,12 +1,19 @@
 from typing import List
 import uuid
 from fastapi import APIRouter, HTTPException, status
-from sqlalchemy import select
+from fastapi.responses import JSONResponse
+from botocore.exceptions import BotoCoreError, ClientError
+from sqlalchemy import delete, select
 
 from ..models.sql_models import Document, Organization, User
-from ..models.api_models import FilesResponse, OrganizationCreate, OrganizationResponse, OrganizationUpdate, OrganizationAddUsers, UserResponse
+from ..models.api_models import FilesResponse, OrganizationCreate, OrganizationResponse, OrganizationUpdate, OrganizationAddUsers, OwnershipType, UserResponse
+from ..tasks import (
+    delete_s3_objects, drop_partitions, owner_chunks_exceed, owner_document_filter, start_purge
+)
 
-from ..dependencies import SessionDep, OrganizationDep
+from ..cache import bump_owner_version
+from ..dependencies import SessionDep, OrganizationDep, OrganizationForUpdateDep, OrganizationReadSessionDep, identity_cache
+from ..serialization import fast_or_model, rows_to_dicts
 
 router = APIRouter(
     prefix="/organizations",
@@ -25,21 +32,17 @@ async def get_organization_by_id(org: OrganizationDep, session: SessionDep) -> O
     return org
 
 @router.get("/{org_id}/getFiles")
-async def get_files_by_organization(org: OrganizationDep, session: SessionDep) -> List[FilesResponse]:
+async def get_files_by_organization(org: OrganizationDep, session: OrganizationReadSessionDep) -> List[FilesResponse]:
     """
     Get all files associated with the organization.
     """
-    # Check if the organization exists in the database
-    org = session.merge(org)
-    if not org:
-        raise HTTPException(status_code=404, detail="Organization not found")
-    
     # Fetch files associated with the organization
-    files = session.scalars(
-        select(Document).where(Document.organization_id == org.id)
-    ).all()
+    files = session.execute(
+        select(Document.id, Document.file_name, Document.user_id, Document.organization_id)
+        .where(Document.organization_id == org.id)
+    )
     
-    return files
+    return fast_or_model(rows_to_dicts(files))
 
 @router.post("/create", status_code=status.HTTP_201_CREATED)
 async def create_organization(org: OrganizationCreate, session: SessionDep) -> OrganizationResponse:
@@ -59,19 +62,21 @@ async def create_organization(org: OrganizationCreate, session: SessionDep) -> O
     return new_org
 
 @router.put("/{org_id}", status_code=status.HTTP_200_OK)
-async def update_organization(existing_org: OrganizationDep, org_data: OrganizationUpdate, session: SessionDep) -> OrganizationResponse:
+async def update_organization(existing_org: OrganizationForUpdateDep, org_data: OrganizationUpdate, session: SessionDep) -> OrganizationResponse:
     # Ensure the organization instance is attached to the current session
     existing_org = session.merge(existing_org)
     if org_data.name:
         existing_org.name = org_data.name
     session.commit()  # Commit the transaction
     session.refresh(existing_org)
+    identity_cache.invalidate("organization", existing_org.id)
 
     return existing_org
 
 @router.put("/{org_id}/addUsers")
-async def add_user_to_organization(org: OrganizationDep, user_data: OrganizationAddUsers, session: SessionDep) -> OrganizationResponse:
+async def add_user_to_organization(org: OrganizationForUpdateDep, user_data: OrganizationAddUsers, session: SessionDep) -> OrganizationResponse:
     org = session.merge(org)
+    previous_org_ids = set()
     # Check if users exist and associate them with the organization
     for user_id in user_data.user_ids:
         existing_user = session.scalar(
@@ -79,15 +84,20 @@ async def add_user_to_organization(org: OrganizationDep, user_data: Organization
         )
         if not existing_user:
             raise HTTPException(status_code=404, detail="User not found")
+        previous_org_ids.add(existing_user.organization_id)
         existing_user.organization_id = org.id
         org.users.append(existing_user)
     session.commit()  # Commit the transaction
     session.refresh(org)
+    for user_id in user_data.user_ids:
+        identity_cache.invalidate("user", user_id)
+    for org_id in (previous_org_ids | {org.id}) - {None}:
+        identity_cache.invalidate("organization", org_id)
     return org
 
 #only disassociate users from the organization not delete them
 @router.put("/{org_id}/removeUsers")
-async def delete_users_from_organization(org: OrganizationDep, user_data: OrganizationAddUsers, session: SessionDep) -> OrganizationResponse:
+async def delete_users_from_organization(org: OrganizationForUpdateDep, user_data: OrganizationAddUsers, session: SessionDep) -> OrganizationResponse:
     org = session.merge(org)
     # Check if users exist and disassociate them from the organization
     for user_id in user_data.user_ids:
@@ -101,13 +111,44 @@ async def delete_users_from_organization(org: OrganizationDep, user_data: Organi
     
     session.commit()
     session.refresh(org)
+    for user_id in user_data.user_ids:
+        identity_cache.invalidate("user", user_id)
+    identity_cache.invalidate("organization", org.id)
 
     return org
 
 @router.delete("/{org_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_organization(existing_org: OrganizationDep, session: SessionDep) -> None:
-    session.delete(existing_org)
+    """
+    Deletes the organization along with its users and all of their documents.
+    Large organizations are purged in the background and get a 202 with the
+    purge task id instead, the same one while it is still running.
+    """
+    owner_id = existing_org.id
+    if owner_chunks_exceed(session, owner_id, OwnershipType.organization):
+        task = start_purge(owner_id, OwnershipType.organization)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                            content={"status": task.status, "task_id": task.id})
+
+    document_ids = session.scalars(
+        select(Document.id).where(owner_document_filter(owner_id, OwnershipType.organization))
+    ).all()
+    user_ids = session.scalars(select(User.id).where(User.organization_id == owner_id)).all()
+    try:
+        delete_s3_objects([str(document_id) for document_id in document_ids])
+    except (BotoCoreError, ClientError) as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete files from S3: {str(e)}")
+
+    # users, documents, chunks and conversations go through ON DELETE CASCADE
+    session.execute(delete(Organization).where(Organization.id == owner_id))
     session.commit()
+    # promoted owners' partitions are empty by now, dropping them needs a lock on chunks
+    drop_partitions.delay([owner_id, *user_ids])
+    for affected_owner in [owner_id, *user_ids]:
+        bump_owner_version(affected_owner)
+    identity_cache.invalidate("organization", owner_id)
+    for user_id in user_ids:
+        identity_cache.invalidate("user", user_id)
     return None
 
 
@@ -1,65 +1,330 @@
-from typing import Annotated, List
-from fastapi import APIRouter, Depends, HTTPException
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import select
+from typing import Annotated, Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Integer, cast, column, select, text, true, values
+from sqlalchemy.exc import DBAPIError
 
+from .. import dependencies
+from ..embeddings import get_embedding_model
+from ..generations import Generation, active_generation, embedding_column
+from ..cache import CacheStats, EmbeddingCache, TTLCache, get_owner_versions
+from ..deadlines import Deadline, DeadlineDep, query_canceled, route_path, run_cancellable, set_statement_timeout
+from ..metrics import REQUEST_DEADLINE_OUTCOMES
 from ..models.sql_models import Organization, User, Document, Chunks
-from ..models.api_models import SearchResponse
-from ..dependencies import get_user, SessionDep, UserDep
+from ..models.api_models import BatchSearchRequest, BatchSearchResponse, SearchResponse
+from ..dependencies import get_user, UserDep, UserReadSessionDep
+from ..serialization import fast_or_model, rows_to_dicts
+from ..vector_tier import Hit, HotVectorTier
 
 router = APIRouter(
     prefix="/search",
     tags=["Search"]
 )
-embedding_dim = 384
-embedding_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
 
+# share query embeddings across API workers through Redis
+USE_REDIS_EMBEDDING_CACHE = False
+SEARCH_RESULTS_TTL = 60
 
-#run vector search to get the most similar chunks on users documents including documents from the organization
-@router.get("/{user_id}")
-async def search(user: UserDep, session: SessionDep, query: str)-> List[SearchResponse]:
-    #get user documents
-    user_documents = session.scalars(
-        select(Document).where(Document.user_id == user.id)
-    ).all()
-    #get organization documents
-    if user.organization_id:
-        org = session.scalar(
-            select(Organization).where(Organization.id == user.organization_id)
+# model name -> its query embedding cache
+query_embedding_caches: Dict[str, EmbeddingCache] = {}
+# (user_id, org_id, generation, owner versions, query, k) -> results
+search_results_cache = TTLCache(maxsize=2048, ttl=SEARCH_RESULTS_TTL)
+search_results_stats = CacheStats()
+
+# answer searches over the most searched owners from in-memory embedding matrices
+USE_HOT_VECTOR_TIER = False
+HOT_VECTOR_TIER_MEMORY_BUDGET = 1024 ** 3
+# float16 halves the memory but numpy multiplies it without BLAS, so it is slower
+HOT_VECTOR_TIER_DTYPE = "float32"
+hot_vector_tier = HotVectorTier(
+    lambda: dependencies.engine,
+    memory_budget=HOT_VECTOR_TIER_MEMORY_BUDGET,
+    dtype=HOT_VECTOR_TIER_DTYPE
+)
+
+# the exact query is stopped this long before the request's deadline, leaving
+# the rest for an approximate one
+APPROXIMATE_RESERVE_SECONDS = 0.5
+# approximate searches only walk the HNSW index, with a short candidate list
+# and a bounded number of visited tuples, so they can return fewer than k rows
+APPROXIMATE_SEARCH_SETTINGS = {
+    # only the index returns rows in distance order without sorting them all
+    "enable_sort": "off",
+    "hnsw.ef_search": 20,
+    "hnsw.iterative_scan": "strict_order",
+    "hnsw.max_scan_tuples": 5000,
+}
+# set to "approximate" or "partial" when results were cut short by the deadline
+DEGRADED_HEADER = "X-Search-Degraded"
+
+
+def encode_queries(queries: List[str], generation: Generation) -> List[List[float]]:
+    cache = query_embedding_caches.get(generation.model_name)
+    if cache is None:
+        cache = query_embedding_caches.setdefault(
+            generation.model_name,
+            EmbeddingCache(namespace=generation.model_name, use_redis=USE_REDIS_EMBEDDING_CACHE)
         )
-        if not org:
-            raise HTTPException(status_code=404, detail="Organization not found")
-    else:
-        org = None
-        
-    org_documents = session.scalars(
-        select(Document).where(Document.organization_id == org.id)
-    ).all() if org else []
+    return cache.encode(get_embedding_model(generation.model_name), queries)
+
+
+def user_document_scope(user: User):
+    """
+    Select of the document ids visible to the user: their own documents plus
+    their organization's.
+    """
+    owner_filter = Document.user_id == user.id
+    if user.organization_id:
+        owner_filter = owner_filter | (Document.organization_id == user.organization_id)
+    return select(Document.id).where(owner_filter)
+
+
+def user_chunk_owners(user: User) -> List[UUID]:
+    """
+    Owner ids of the chunks visible to the user, filtering on them lets
+    Postgres skip every other partition of chunks.
+    """
+    return [user.id, user.organization_id] if user.organization_id else [user.id]
+
+
+def use_approximate_search(session) -> None:
+    for name, value in APPROXIMATE_SEARCH_SETTINGS.items():
+        session.execute(text(f"SET LOCAL {name} = {value}"))
+
+
+async def run_within_deadline(request: Request, session, deadline: Deadline,
+                              fn: Callable[..., Any], *args) -> Tuple[Any, bool]:
+    """
+    Runs fn(*args, approximate) on the threadpool, cancelled if the client
+    leaves. The exact run gets the deadline less APPROXIMATE_RESERVE_SECONDS;
+    when it runs out of that, or not even the reserve is left, fn runs
+    again approximately on what remains. Returns fn's result and whether
+    it is approximate.
+    """
+    if deadline.remaining() > APPROXIMATE_RESERVE_SECONDS:
+        set_statement_timeout(session, deadline, reserve=APPROXIMATE_RESERVE_SECONDS)
+        try:
+            return await run_cancellable(request, session, fn, *args, False), False
+        except DBAPIError as e:
+            if not query_canceled(e):
+                raise
+            # the next transaction starts with the rest of the deadline
+            session.rollback()
+    REQUEST_DEADLINE_OUTCOMES.labels(route_path(request), "approximate").inc()
+    return await run_cancellable(request, session, fn, *args, True), True
+
+
+def search_response(response: Response, content, degraded: Optional[str]):
+    if degraded is None:
+        return fast_or_model(content)
+    response.headers[DEGRADED_HEADER] = degraded
+    return fast_or_model(content, headers={DEGRADED_HEADER: degraded})
+
+
+def search_cache_key(user: User, generation: Generation, versions: tuple, query: str, k: int):
+    # the column tells generations apart even when one has BASE_GENERATION's id
+    return (user.id, user.organization_id, generation.column_name, versions, query, k)
+
+
+def hot_tier_search(user: User, generation: Generation, versions: Optional[tuple],
+                    query_embeddings, k: int) -> Optional[List[List[Hit]]]:
+    """
+    Hits from the hot vector tier, or None when the query has to go to SQL.
+    `versions` must come from get_owner_versions(user.id, user.organization_id).
+    """
+    if not USE_HOT_VECTOR_TIER:
+        return None
+    owners = [("user", user.id)]
+    if user.organization_id:
+        owners.append(("organization", user.organization_id))
+    return hot_vector_tier.search(owners, generation, versions, query_embeddings, k)
+
+
+def hits_to_results(session, user: User, hits: List[List[Hit]]) -> List[List[dict]]:
+    """
+    SearchResponse dicts for each query's hot tier hits, with the chunk text
+    looked up by primary key in one statement.
+    """
+    chunk_ids = {chunk_id for query_hits in hits for chunk_id, _, _ in query_hits}
+    texts = dict(session.execute(
+        select(Chunks.id, Chunks.chunk)
+        .where(Chunks.owner_id.in_(user_chunk_owners(user)), Chunks.id.in_(chunk_ids))
+    ).all())
+    return [
+        [
+            {"id": chunk_id, "document_id": document_id, "chunk": texts[chunk_id], "similarity": similarity}
+            for chunk_id, document_id, similarity in query_hits
+            if chunk_id in texts
+        ]
+        for query_hits in hits
+    ]
 
-    # Embed the query
-    query_embedding = embedding_model.encode(query).tolist()
 
-    
+@router.get("/cache/stats", tags=["Admin"])
+async def search_cache_stats():
+    return {
+        "query_embeddings": {name: cache.stats.as_dict() for name, cache in query_embedding_caches.items()},
+        "search_results": search_results_stats.as_dict(),
+        "hot_vector_tier": hot_vector_tier.status(),
+    }
+
+
+def search_sql(user: User, session, generation: Generation, query_embedding, k: int,
+               approximate: bool = False) -> List[dict]:
+    if approximate:
+        use_approximate_search(session)
     results = session.execute(
             select(
                 Chunks.id,
                 Chunks.document_id,
                 Chunks.chunk,
-                Chunks.embedding.l2_distance(query_embedding).label("similarity")
+                embedding_column(generation).l2_distance(query_embedding).label("similarity")
+            )
+            .where(
+                Chunks.owner_id.in_(user_chunk_owners(user)),
+                Chunks.document_id.in_(user_document_scope(user))
             )
-            .where(Chunks.document_id.in_([doc.id for doc in user_documents + org_documents]))
             .order_by("similarity")
-            .limit(10)
+            .limit(k)
         ).all()
 
-    # Format the results
-    formatted_results = [
-        SearchResponse(
-            id=row.id,
-            document_id=row.document_id,
-            chunk=row.chunk,
-            similarity=row.similarity  # Include similarity score
+    # Format the results, rows already carry the SearchResponse fields
+    return rows_to_dicts(results)
+
+
+#run vector search to get the most similar chunks on users documents including documents from the organization
+@router.get("/{user_id}")
+async def search(user: UserDep, session: UserReadSessionDep, query: str, request: Request, response: Response,
+                 deadline: DeadlineDep) -> List[SearchResponse]:
+    """
+    Results that only the approximate fallback could find within the
+    route's deadline come with an `X-Search-Degraded: approximate` header.
+    """
+    # the query must be encoded by the model that produced the column it searches
+    generation = active_generation()
+    # versions change whenever the user's or org's documents do, which retires old entries
+    versions = get_owner_versions(user.id, user.organization_id)
+    if versions is not None:
+        cached = search_results_cache.get(search_cache_key(user, generation, versions, query, 10))
+        search_results_stats.record(cached is not None)
+        if cached is not None:
+            return fast_or_model(cached)
+
+    # Embed the query, off the event loop so a client that leaves is noticed
+    query_embedding = (await run_cancellable(request, None, encode_queries, [query], generation))[0]
+
+    degraded = None
+    hits = hot_tier_search(user, generation, versions, [query_embedding], 10)
+    if hits is not None:
+        formatted_results = hits_to_results(session, user, hits)[0]
+    else:
+        formatted_results, approximate = await run_within_deadline(
+            request, session, deadline, search_sql, user, session, generation, query_embedding, 10
         )
-        for row in results
-    ]
-    return formatted_results
\ No newline at end of file
+        degraded = "approximate" if approximate else None
+    if versions is not None and degraded is None:
+        search_results_cache.set(search_cache_key(user, generation, versions, query, 10), formatted_results)
+    return search_response(response, formatted_results, degraded)
+
+
+def search_batch_sql(user: User, session, generation: Generation, pending: List[int],
+                     query_embeddings, k: int, results: List[dict], approximate: bool = False) -> None:
+    """
+    Fills results[idx] for each pending query from pgvector, all queries in one statement.
+    """
+    if approximate:
+        use_approximate_search(session)
+    queries = values(
+        column("idx", Integer),
+        column("embedding", Vector(generation.dim)),
+        name="queries"
+    ).data(list(zip(pending, query_embeddings)))
+
+    top_k = (
+        select(
+            Chunks.id,
+            Chunks.document_id,
+            Chunks.chunk,
+            embedding_column(generation).l2_distance(
+                cast(queries.c.embedding, Vector(generation.dim))
+            ).label("similarity")
+        )
+        .where(
+            Chunks.owner_id.in_(user_chunk_owners(user)),
+            Chunks.document_id.in_(user_document_scope(user))
+        )
+        .order_by("similarity")
+        .limit(k)
+        .lateral("top_k")
+    )
+
+    rows = session.execute(
+        select(queries.c.idx, top_k)
+        .select_from(queries)
+        .join(top_k, true())
+        .order_by(queries.c.idx, top_k.c.similarity)
+    ).all()
+
+    for row in rows:
+        result = row._asdict()
+        results[result.pop("idx")]["results"].append(result)
+
+
+@router.post("/{user_id}/batch")
+async def batch_search(user: UserDep, session: UserReadSessionDep, batch: BatchSearchRequest, request: Request,
+                       response: Response, deadline: DeadlineDep) -> List[BatchSearchResponse]:
+    """
+    Runs several queries against the same scope in one round trip.
+    Queries are encoded together and each one gets its own top-k through a
+    LATERAL join, so results come back in request order.
+    When the deadline cuts the search short, `X-Search-Degraded` is
+    `approximate`, or `partial` when only the cached queries have results.
+    """
+    results = [{"query": query, "results": []} for query in batch.queries]
+
+    generation = active_generation()
+    versions = get_owner_versions(user.id, user.organization_id)
+    pending = []
+    for idx, query in enumerate(batch.queries):
+        cached = None
+        if versions is not None:
+            cached = search_results_cache.get(search_cache_key(user, generation, versions, query, batch.k))
+            search_results_stats.record(cached is not None)
+        if cached is not None:
+            results[idx]["results"] = list(cached)
+        else:
+            pending.append(idx)
+    if not pending:
+        return fast_or_model(results)
+
+    query_embeddings = await run_cancellable(
+        request, None, encode_queries, [batch.queries[idx] for idx in pending], generation
+    )
+
+    degraded = None
+    hits = hot_tier_search(user, generation, versions, query_embeddings, batch.k)
+    if hits is not None:
+        for idx, query_results in zip(pending, hits_to_results(session, user, hits)):
+            results[idx]["results"] = query_results
+    else:
+        try:
+            _, approximate = await run_within_deadline(
+                request, session, deadline, search_batch_sql,
+                user, session, generation, pending, query_embeddings, batch.k, results
+            )
+            degraded = "approximate" if approximate else None
+        except DBAPIError as e:
+            # with nothing cached there is nothing to answer with
+            if not query_canceled(e) or len(pending) == len(batch.queries):
+                raise
+            REQUEST_DEADLINE_OUTCOMES.labels(route_path(request), "partial").inc()
+            degraded = "partial"
+
+    if versions is not None and degraded is None:
+        for idx in pending:
+            search_results_cache.set(
+                search_cache_key(user, generation, versions, batch.queries[idx], batch.k),
+                list(results[idx]["results"])
+            )
+    return search_response(response, results, degraded)
@@ -3,11 +3,18 @@ import uuid
 from fastapi import APIRouter
 from typing import Annotated, List
 from fastapi import Depends, HTTPException, status
-from sqlalchemy import select
+from fastapi.responses import JSONResponse
+from botocore.exceptions import BotoCoreError, ClientError
+from sqlalchemy import delete, select
 
 from ..models.sql_models import Document, Organization, User
-from ..models.api_models import FilesResponse, UserCreate, UserResponse, UserUpdate
-from ..dependencies import get_user, SessionDep, UserDep
+from ..models.api_models import FilesResponse, OwnershipType, UserCreate, UserResponse, UserUpdate
+from ..tasks import (
+    delete_s3_objects, drop_partitions, owner_chunks_exceed, owner_document_filter, start_purge
+)
+from ..cache import bump_owner_version
+from ..dependencies import get_user, identity_cache, SessionDep, UserDep, UserForUpdateDep, UserReadSessionDep
+from ..serialization import fast_or_model, rows_to_dicts
 
 router = APIRouter(
     prefix="/users",
@@ -26,26 +33,23 @@ async def get_user_by_id(user: UserDep) -> UserResponse:
 
 @router.get("/{user_id}/getFiles")
 async def get_user_files(existing_user: UserDep, 
-                         session: SessionDep, 
+                         session: UserReadSessionDep, 
                          include_org: bool = False
                          ) -> List[FilesResponse]:
     """
     Get all files associated with a user.
     If include_org is True, also include files from the user's organization.
     """
-    if include_org:
-        files = session.scalars(
-            select(Document).where(
-                (Document.user_id == existing_user.id) | 
-                (Document.organization_id == existing_user.organization_id)
-            )
-        ).all()
+    files = select(Document.id, Document.file_name, Document.user_id, Document.organization_id)
+    if include_org and existing_user.organization_id:
+        files = files.where(
+            (Document.user_id == existing_user.id) | 
+            (Document.organization_id == existing_user.organization_id)
+        )
     else:
-        files = session.scalars(
-            select(Document).where(Document.user_id == existing_user.id)
-        ).all()
+        files = files.where(Document.user_id == existing_user.id)
     
-    return files
+    return fast_or_model(rows_to_dicts(session.execute(files)))
 
 @router.post("/create", status_code=status.HTTP_201_CREATED)
 async def create_user(user: UserCreate, session: SessionDep) -> UserResponse:
@@ -66,13 +70,16 @@ async def create_user(user: UserCreate, session: SessionDep) -> UserResponse:
     session.add(new_user)
     session.commit()
     session.refresh(new_user)
+    if new_user.organization_id:
+        identity_cache.invalidate("organization", new_user.organization_id)
     return new_user
 
 @router.put("/{user_id}", status_code=status.HTTP_200_OK)
-async def update_user(existing_user: UserDep, 
+async def update_user(existing_user: UserForUpdateDep, 
                       user_data: UserUpdate, 
                       session: SessionDep) -> UserResponse:
     existing_user = session.merge(existing_user)
+    previous_org_id = existing_user.organization_id
 
     if user_data.username:
         existing_user.username = user_data.username
@@ -83,13 +90,43 @@ async def update_user(existing_user: UserDep,
     
     session.commit() 
     session.refresh(existing_user)
+    identity_cache.invalidate("user", existing_user.id)
+    # both organizations' member lists may have changed
+    for org_id in {previous_org_id, existing_user.organization_id} - {None}:
+        identity_cache.invalidate("organization", org_id)
     return existing_user
 
 
 @router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_user(existing_user: UserDep, 
                       session: SessionDep) -> None:
-    session.delete(existing_user)
+    """
+    Deletes the user with their documents, chunks and conversations.
+    Users with a large corpus are purged in the background and get a 202
+    with the purge task id instead, the same one while it is still running.
+    """
+    owner_id = existing_user.id
+    if owner_chunks_exceed(session, owner_id, OwnershipType.user):
+        task = start_purge(owner_id, OwnershipType.user)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                            content={"status": task.status, "task_id": task.id})
+
+    document_ids = session.scalars(
+        select(Document.id).where(owner_document_filter(owner_id, OwnershipType.user))
+    ).all()
+    try:
+        delete_s3_objects([str(document_id) for document_id in document_ids])
+    except (BotoCoreError, ClientError) as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete files from S3: {str(e)}")
+
+    # documents, chunks and conversations go through ON DELETE CASCADE
+    session.execute(delete(User).where(User.id == owner_id))
     session.commit()
+    # a promoted user's partition is empty by now, dropping it needs a lock on chunks
+    drop_partitions.delay([owner_id])
+    bump_owner_version(owner_id)
+    identity_cache.invalidate("user", owner_id)
+    if existing_user.organization_id:
+        identity_cache.invalidate("organization", existing_user.organization_id)
     return None
 
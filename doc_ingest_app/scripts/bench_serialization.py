@@ -0,0 +1,72 @@
+"""
+Compares the cost of serializing 1,000 result rows through FastAPI's default
+path (response-model validation + jsonable_encoder + json.dumps) against the
+orjson fast path used when serialization.FAST_JSON_RESPONSES is on.
+
+    python -m doc_ingest_app.scripts.bench_serialization [--rows 1000] [--repeat 20]
+"""
+import argparse
+import json
+import timeit
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+from typing import List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from doc_ingest_app.models.api_models import ConversationResponse, FilesResponse, SearchResponse
+from doc_ingest_app.serialization import rows_to_dicts
+
+
+SearchRow = namedtuple("SearchRow", ["id", "document_id", "chunk", "similarity"])
+FileRow = namedtuple("FileRow", ["id", "file_name", "user_id", "organization_id"])
+MessageRow = namedtuple("MessageRow", ["id", "query", "response", "created_at", "response_at"])
+
+
+# namedtuples expose _asdict like SQLAlchemy rows do
+def search_rows(n: int):
+    return [SearchRow(uuid.uuid4(), uuid.uuid4(), "lorem ipsum " * 85, i / n) for i in range(n)]
+
+def file_rows(n: int):
+    return [FileRow(uuid.uuid4(), f"file_{i}.txt", uuid.uuid4(), None) for i in range(n)]
+
+def message_rows(n: int):
+    now = datetime.now(timezone.utc)
+    return [MessageRow(uuid.uuid4(), f"question {i}", "answer " * 40, now, now) for i in range(n)]
+
+
+def default_path(adapter: TypeAdapter, rows) -> bytes:
+    validated = adapter.validate_python(rows_to_dicts(rows))
+    return json.dumps(jsonable_encoder(validated)).encode("utf-8")
+
+def fast_path(rows) -> bytes:
+    return orjson.dumps(rows_to_dicts(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    # validate messages the way ConversationResponse does
+    message_adapter = TypeAdapter(ConversationResponse.model_fields["messages"].annotation)
+    cases = [
+        ("search", TypeAdapter(List[SearchResponse]), search_rows(args.rows)),
+        ("files", TypeAdapter(List[FilesResponse]), file_rows(args.rows)),
+        ("messages", message_adapter, message_rows(args.rows)),
+    ]
+
+    scale = 1000 / args.rows
+    print(f"{'endpoint':<10} {'default ms/1k':>14} {'orjson ms/1k':>13} {'speedup':>8}")
+    for name, adapter, rows in cases:
+        default = min(timeit.repeat(lambda: default_path(adapter, rows), number=1, repeat=args.repeat))
+        fast = min(timeit.repeat(lambda: fast_path(rows), number=1, repeat=args.repeat))
+        print(f"{name:<10} {default * 1000 * scale:>14.3f} {fast * 1000 * scale:>13.3f} {default / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
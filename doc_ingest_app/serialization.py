@@ -0,0 +1,42 @@
+from typing import Any, Iterable, List, Optional
+
+import orjson
+from fastapi.responses import Response
+
+
+# Serialize the hot endpoints (search, file listings, conversation history)
+# straight from result rows with orjson, skipping response-model validation
+# and FastAPI's generic encoder. Off by default.
+FAST_JSON_RESPONSES = False
+
+
+def rows_to_dicts(rows: Iterable) -> List[dict]:
+    """
+    Converts SQLAlchemy result rows of plain columns to dicts keyed by column label.
+    """
+    return [row._asdict() for row in rows]
+
+
+def json_response(content: Any, status_code: int = 200, headers: Optional[dict] = None) -> Response:
+    """
+    orjson-encoded response. orjson handles UUID and datetime natively, so
+    row dicts can be passed as they are.
+    """
+    return Response(
+        content=orjson.dumps(content),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/json"
+    )
+
+
+def fast_or_model(content: Any, headers: Optional[dict] = None):
+    """
+    Returns `content` as an orjson response when fast responses are enabled,
+    otherwise unchanged so FastAPI validates it against the response model.
+    `headers` only apply to the orjson response, routes set them on their
+    injected Response for the other case.
+    """
+    if FAST_JSON_RESPONSES:
+        return json_response(content, headers=headers)
+    return content
@@ -0,0 +1,29 @@
+from threading import Lock
+
+from .metrics import instrument_s3_client
+
+
+# S3 Configuration
+S3_BUCKET_NAME = "documents"
+S3_ENDPOINT_URL = "http://localhost:4566"
+AWS_ACCESS_KEY_ID = "test"  # Default LocalStack credentials
+AWS_SECRET_ACCESS_KEY = "test"
+
+_s3_client = None
+_s3_client_lock = Lock()
+
+
+def get_s3_client():
+    """
+    Returns the shared boto3 S3 client, creating it on first use.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                from boto3.session import Session as BotoSession
+                _s3_client = instrument_s3_client(BotoSession(
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                ).client("s3", endpoint_url=S3_ENDPOINT_URL))
+    return _s3_client
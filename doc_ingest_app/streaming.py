@@ -0,0 +1,78 @@
+import json
+from typing import AsyncIterator
+from uuid import UUID
+
+import redis.asyncio
+
+from .cache import REDIS_URL, redis_client
+
+
+# partial responses are kept around long enough for a late client to catch up
+STREAM_TTL = 600
+# how long the SSE relay waits for the next token before sending a keep-alive
+STREAM_BLOCK_MS = 15000
+# keep-alives sent without any new token before the relay gives up
+STREAM_MAX_IDLE = 8
+
+async_redis_client = redis.asyncio.Redis.from_url(REDIS_URL)
+
+
+def message_stream_key(message_id: UUID) -> str:
+    return f"message_stream:{message_id}"
+
+
+def publish_token(message_id: UUID, token: str) -> None:
+    """
+    Appends a partial response token to the message's Redis stream.
+    """
+    key = message_stream_key(message_id)
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xadd(key, {"token": token})
+        pipe.expire(key, STREAM_TTL)
+        pipe.execute()
+
+
+def publish_done(message_id: UUID) -> None:
+    """
+    Marks the message's stream as complete. Call after the full response is persisted.
+    """
+    key = message_stream_key(message_id)
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xadd(key, {"done": 1})
+        pipe.expire(key, STREAM_TTL)
+        pipe.execute()
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_exists(message_id: UUID) -> bool:
+    return bool(await async_redis_client.exists(message_stream_key(message_id)))
+
+
+async def relay_message_stream(message_id: UUID) -> AsyncIterator[str]:
+    """
+    Yields server-sent events for every token in the message's stream,
+    starting from the beginning so late subscribers get the full text.
+    """
+    key = message_stream_key(message_id)
+    last_id = "0-0"
+    idle = 0
+    while True:
+        entries = await async_redis_client.xread({key: last_id}, count=100, block=STREAM_BLOCK_MS)
+        if not entries:
+            idle += 1
+            if idle >= STREAM_MAX_IDLE:
+                yield sse_event("timeout", {})
+                return
+            yield ": keep-alive\n\n"
+            continue
+        idle = 0
+        for _, items in entries:
+            for entry_id, fields in items:
+                last_id = entry_id
+                if b"done" in fields:
+                    yield sse_event("done", {})
+                    return
+                yield sse_event("token", fields[b"token"].decode("utf-8"))
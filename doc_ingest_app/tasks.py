@@ -1,28 +1,117 @@
+import glob
+import logging
+import os
+import re
 import uuid
 from celery import Celery
+from celery.result import AsyncResult
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import (
+    before_task_publish, celeryd_init, task_postrun, task_prerun, worker_process_init, worker_process_shutdown,
+    worker_ready
+)
+from kombu import Queue
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess, start_http_server
+import redis
 import time
 from io import BytesIO
 
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import URL, select
+from sqlalchemy import URL, delete, func, literal, select, update
 from sqlalchemy.engine import create_engine
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 from botocore.exceptions import BotoCoreError, ClientError
-from boto3.session import Session as BotoSession
 
+from typing import Callable, Dict, Iterator, List, Optional
 from uuid import UUID
 from datetime import datetime, timezone
 
 from doc_ingest_app.models.api_models import OwnershipType
 
-from .models.sql_models import Organization, User, Document, Chunks, Message, Conversation
+from .admission import defer_upload, deferred_owners, release_upload, take_deferred
+from .cache import bump_owner_version
+from .dependencies import identity_cache, read_router
+from .embeddings import get_embedding_model
+from .idempotency import INGEST_LOCK_TTL, acquire_ingest_lock, claim_purge, release_ingest_lock, release_purge
+from .generations import (
+    BASE_GENERATION, activate_generation, build_generation_index, build_missing_index, embedding_column,
+    fill_missing_vectors, live_generations, start_generation, write_vectors
+)
+from .partitions import drop_owner_partitions
+from .metrics import CELERY_QUEUE_WAIT_SECONDS, CELERY_TASK_SECONDS, QueueDepthCollector, observe_embedding
+from .storage import S3_BUCKET_NAME, get_s3_client
+from .profiling import IngestProfiler
+from .streaming import publish_done, publish_token
+from .models.sql_models import Organization, User, Document, Chunks, Message, Conversation, EmbeddingGeneration
+
+logger = logging.getLogger(__name__)
+
+BROKER_URL = "redis://localhost:6379"
 
 celery = Celery(
     "doc_ingest_app.tasks",
-    broker="redis://localhost:6379",
+    broker=BROKER_URL,
     backend="redis://localhost:6379/0"
 )
 
+# interactive chat responses, bulk document ingestion, and low priority maintenance work
+CHAT_QUEUE = "chat"
+INGEST_QUEUE = "ingest"
+BACKFILL_QUEUE = "backfill"
+QUEUES = [CHAT_QUEUE, INGEST_QUEUE, BACKFILL_QUEUE]
+
+# the redis transport serves lower numbers first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+PRIORITY_STEPS = list(range(10))
+PRIORITY_SEP = ":"
+
+RESULT_TTL_SECONDS = 6 * 3600
+# how often `celery beat` queues the backlogs no finishing ingest is left to queue
+DRAIN_DEFERRED_INTERVAL_SECONDS = 60
+
+celery.conf.update(
+    task_queues=[Queue(queue) for queue in QUEUES],
+    task_default_queue=INGEST_QUEUE,
+    task_routes={
+        "doc_ingest_app.tasks.respond_to_message": {"queue": CHAT_QUEUE},
+        "doc_ingest_app.tasks.proccess_file": {"queue": INGEST_QUEUE},
+        "doc_ingest_app.tasks.purge_owner": {"queue": BACKFILL_QUEUE},
+        "doc_ingest_app.tasks.reembed_chunks": {"queue": BACKFILL_QUEUE},
+        "doc_ingest_app.tasks.fake_task_remote": {"queue": BACKFILL_QUEUE},
+    },
+    task_default_priority=PRIORITY_NORMAL,
+    broker_transport_options={
+        "queue_order_strategy": "priority",
+        "priority_steps": PRIORITY_STEPS,
+        "sep": PRIORITY_SEP,
+        # unacknowledged tasks go back to the queue after this long; well past
+        # the ingest lock's TTL, so a redelivered ingest finds the lock lapsed
+        "visibility_timeout": 2 * INGEST_LOCK_TTL,
+    },
+    worker_prefetch_multiplier=1,
+    # results are small status records; keep them around long enough to be polled
+    result_expires=RESULT_TTL_SECONDS,
+    beat_schedule={
+        "drain-deferred-uploads": {
+            "task": "doc_ingest_app.tasks.drain_deferred_uploads",
+            "schedule": DRAIN_DEFERRED_INTERVAL_SECONDS,
+        },
+    },
+)
+
+# per-queue worker settings, applied when a worker consumes exactly one of the queues:
+#   celery -A doc_ingest_app.tasks worker -Q chat -n chat@%h --pool=threads
+#   celery -A doc_ingest_app.tasks worker -Q ingest -n ingest@%h
+WORKER_PROFILES = {
+    # short, I/O bound tasks: many at once, a few prefetched each
+    CHAT_QUEUE: {"concurrency": 16, "prefetch_multiplier": 4, "metrics_port": 9101},
+    # long, CPU bound embedding: take one at a time so a big file doesn't hold others back
+    INGEST_QUEUE: {"concurrency": 2, "prefetch_multiplier": 1, "metrics_port": 9100},
+    BACKFILL_QUEUE: {"concurrency": 1, "prefetch_multiplier": 1, "metrics_port": 9102},
+}
+
 url = URL.create(
     drivername="postgresql+psycopg2",
     username="postgres",
@@ -33,60 +122,246 @@ url = URL.create(
 )
 engine = create_engine(url, echo=True)
 
-embedding_dim = 384
-# Initialize the embedding model
-embedding_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+# the worker serves its own Prometheus metrics (embedding, S3, SQL and task timings)
+WORKER_METRICS_PORT = 9100
+# prefork children record their metrics into files in this directory, which
+# the worker's metrics server adds up. It has to be set in the environment,
+# prometheus_client reads it on import, and be a different one per worker
+METRICS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+# set on workers started for a single queue
+worker_profile: Dict[str, int] = {}
+# the queues the worker was started for, empty when it consumes all of them
+worker_queues: set = set()
 
-# S3 Configuration
-S3_BUCKET_NAME = "documents"
-S3_ENDPOINT_URL = "http://localhost:4566"
-AWS_ACCESS_KEY_ID = "test"  # Default LocalStack credentials
-AWS_SECRET_ACCESS_KEY = "test"
+broker_redis = redis.Redis.from_url(BROKER_URL)
 
-# Initialize Boto3 S3 client
-s3_client = BotoSession(
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-).client("s3", endpoint_url=S3_ENDPOINT_URL)
 
-# We want atomic transactions because we want to ensure that if any part of the process fails, the entire transaction is rolled back
-@celery.task
-def proccess_file(file_name: str, owner_id: UUID, owner_type: OwnershipType, file_id: UUID):
+def queue_depths(queues: List[str] = QUEUES) -> Dict[str, int]:
     """
-    Process the file and return the result.
+    Number of tasks waiting in each queue, across its priority lists.
     """
-    # Download the file from S3
+    pipe = broker_redis.pipeline()
+    for queue in queues:
+        for priority in PRIORITY_STEPS:
+            pipe.llen(f"{queue}{PRIORITY_SEP}{priority}" if priority else queue)
+    lengths = pipe.execute()
+    steps = len(PRIORITY_STEPS)
+    return {queue: sum(lengths[i * steps:(i + 1) * steps]) for i, queue in enumerate(queues)}
+
+
+def ingest_queue_depth() -> Optional[int]:
     try:
-        s3_object = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
-        file_content = s3_object["Body"].read()  # Read the file content as bytes
-    except (BotoCoreError, ClientError) as e:
-        raise FileNotFoundError(f"Failed to download file {file_name} from S3: {str(e)}")
+        return queue_depths([INGEST_QUEUE])[INGEST_QUEUE]
+    except redis.RedisError as e:
+        logger.warning("Could not read the ingest queue depth: %s", e)
+        return None
+
+
+queue_depth_collector = QueueDepthCollector(queue_depths)
+REGISTRY.register(queue_depth_collector)
+
+
+@celeryd_init.connect
+def apply_worker_profile(options=None, conf=None, **kwargs):
+    queues = (options or {}).get("queues") or []
+    if isinstance(queues, str):
+        queues = queues.split(",")
+    worker_queues.update(queues)
+    if METRICS_MULTIPROC_DIR:
+        # files of a previous run would be added to this one's metrics
+        os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(METRICS_MULTIPROC_DIR, "*.db")):
+            os.remove(path)
+    if len(queues) != 1 or queues[0] not in WORKER_PROFILES:
+        return
+    worker_profile.update(WORKER_PROFILES[queues[0]])
+    # explicit command line options still win
+    if not options.get("concurrency"):
+        conf.worker_concurrency = worker_profile["concurrency"]
+    if not options.get("prefetch_multiplier"):
+        conf.worker_prefetch_multiplier = worker_profile["prefetch_multiplier"]
+
+@worker_ready.connect
+def start_worker_metrics_server(sender=None, **kwargs):
+    port = worker_profile.get("metrics_port", WORKER_METRICS_PORT)
+    if not METRICS_MULTIPROC_DIR:
+        if isinstance(getattr(sender, "pool", None), PreforkPool):
+            logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, metrics of the prefork children won't be served")
+        start_http_server(port)
+        return
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    # read from the broker at scrape time, not recorded by any process
+    registry.register(queue_depth_collector)
+    start_http_server(port, registry=registry)
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    if METRICS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+def _serves_ingest() -> bool:
+    # chat-only workers never need the model
+    return not worker_queues or INGEST_QUEUE in worker_queues
+
+@worker_process_init.connect
+def load_embedding_model_in_child(**kwargs):
+    # each prefork child runs tasks with its own copy of the model, load it
+    # before the first task arrives instead of inside it
+    if _serves_ingest():
+        get_embedding_model()
+
+@worker_ready.connect
+def load_embedding_model(sender=None, **kwargs):
+    # solo and threads pools run tasks in the worker process itself
+    if isinstance(getattr(sender, "pool", None), PreforkPool):
+        return
+    if _serves_ingest():
+        get_embedding_model()
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("published_at", time.time())
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    if task.request.is_eager:
+        return
+    queue = (task.request.delivery_info or {}).get("routing_key") or "unknown"
+    published_at = getattr(task.request, "published_at", None)
+    if published_at:
+        CELERY_QUEUE_WAIT_SECONDS.labels(queue).observe(max(0.0, time.time() - published_at))
+    task.request.started_at = time.perf_counter()
+
+@task_postrun.connect
+def record_task_duration(task=None, **kwargs):
+    started_at = getattr(task.request, "started_at", None)
+    if started_at is None:
+        return
+    queue = (task.request.delivery_info or {}).get("routing_key") or "unknown"
+    CELERY_TASK_SECONDS.labels(queue, task.name).observe(time.perf_counter() - started_at)
+
+class IngestTask(celery.Task):
+    """
+    Hands an admitted upload's bytes back to the admission budget once its
+    ingest is over, successful or not, and queues the owner's next deferred
+    upload in its place. A file's bytes are handed back only once, however
+    often its ingest runs.
+    """
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        if status == "RETRY" or kwargs.get("size") is None:
+            return
+        if not release_upload(kwargs["owner_id"], kwargs["size"], kwargs["file_id"]):
+            return
+        deferred = take_deferred(kwargs["owner_id"])
+        if deferred:
+            self.apply_async(kwargs=deferred["kwargs"])
+
+def chunk_id(file_id: UUID, index: int) -> UUID:
+    # the same file always yields the same chunk ids, so a rerun can tell which are stored
+    return uuid.uuid5(UUID(str(file_id)), str(index))
 
+# chunks embedded and committed per transaction, a rerun after a crash
+# carries on after the last committed batch
+INGEST_COMMIT_CHUNKS = 256
+
+def lock_document(session: Session, file_name: str, file_id: UUID) -> Document:
+    # concurrent runs of the same file take turns on the row
+    file = session.scalar(
+        select(Document).where(Document.id == file_id).with_for_update()
+    )
+    if not file:
+        raise FileNotFoundError(f"File {file_name} with id {file_id} not found in database")
+    return file
+
+def load_owner(session: Session, owner_id: UUID, owner_type: OwnershipType):
+    if owner_type == OwnershipType.user:
+        owner = session.scalar(
+            select(User).where(User.id == owner_id)
+        )
+    elif owner_type == OwnershipType.organization:
+        owner = session.scalar(
+            select(Organization).where(Organization.id == owner_id)
+        )
+    else:
+        raise ValueError(f"Invalid owner type {owner_type}")
+    if not owner:
+        raise FileNotFoundError(f"Owner {owner_id} not found in database")
+    return owner
+
+def store_chunks(profiler: IngestProfiler, session: Session, file: Document, owner_id: UUID, batch) -> None:
+    """
+    Embeds (chunk id, text) pairs with every live generation's model, for
+    the time a re-embedding job is running, and adds them to the document.
+    """
+    with profiler.stage("embed") as stage:
+        generations = live_generations(session)
+        vectors = {}
+        for generation in generations:
+            with observe_embedding("ingest"):
+                # keyed by column: a schema without the seeded row has a building generation with BASE_GENERATION's id
+                vectors[generation.column_name] = get_embedding_model(generation.model_name).encode(
+                    [chunk for _, chunk in batch]
+                ).tolist()
+        # the mapped `embedding` column, until its generation is retired
+        base = next((generation for generation in generations
+                     if generation.column_name == BASE_GENERATION.column_name), None)
+        for i, (new_chunk_id, chunk) in enumerate(batch):
+            # Create a new chunk object
+            new_chunk = Chunks(
+                id=new_chunk_id,
+                owner_id=owner_id,
+                chunk=chunk,
+                embedding=vectors[base.column_name][i] if base else None
+            )
+            # Add the chunk to the document
+            file.chunks.append(new_chunk)
+            # Add the chunk to the database
+            session.add(new_chunk)
+        stage["chunks"] = len(batch)
+
+    with profiler.stage("db_flush") as stage:
+        session.flush()
+        chunk_ids = [new_chunk_id for new_chunk_id, _ in batch]
+        for generation in generations:
+            if generation is not base:
+                write_vectors(session, generation, chunk_ids, vectors[generation.column_name], owner_id)
+        stage["chunks"] = len(batch)
+
+def ingest_document(profiler: IngestProfiler, file_name: str, owner_id: UUID, owner_type: OwnershipType,
+                    file_id: UUID) -> dict:
+    """
+    Stores the file's chunks and vectors, committing every
+    INGEST_COMMIT_CHUNKS chunks, and writes the ingest profile last, which
+    marks the document as done. Files that have their profile are left
+    alone, and a rerun of one that was cut off only embeds the chunks that
+    weren't committed. Every transaction holds the document's row lock.
+    """
     # Use a context manager for session management
     with Session(engine) as session:
         with session.begin():
             # Ensure the file_id is in the database
-            file = session.scalar(
-                select(Document).where(Document.id == file_id)
-            )
-            if not file:
-                raise FileNotFoundError(f"File {file_name} with id {file_id} not found in database")
-            
+            file = lock_document(session, file_name, file_id)
+            if file.ingest_profile is not None:
+                return {"document_id": str(file_id), "status": "already_ingested"}
             # Ensure the owner_id is in the database
-            if owner_type == OwnershipType.user:
-                owner = session.scalar(
-                    select(User).where(User.id == owner_id)
-                )
-            elif owner_type == OwnershipType.organization:
-                owner = session.scalar(
-                    select(Organization).where(Organization.id == owner_id)
-                )
-            else:
-                raise ValueError(f"Invalid owner type {owner_type}")
-            if not owner:
-                raise FileNotFoundError(f"Owner {owner_id} not found in database")
+            load_owner(session, owner_id, owner_type)
+            stored = set(session.scalars(
+                select(Chunks.id).where(Chunks.owner_id == owner_id, Chunks.document_id == file_id)
+            ))
+
+        # Download the file from S3, no transaction is held open meanwhile
+        with profiler.stage("download") as stage:
+            try:
+                s3_object = get_s3_client().get_object(Bucket=S3_BUCKET_NAME, Key=str(file_id))
+                file_content = s3_object["Body"].read()  # Read the file content as bytes
+            except (BotoCoreError, ClientError) as e:
+                raise FileNotFoundError(f"Failed to download file {file_name} from S3: {str(e)}")
+            stage["bytes"] = len(file_content)
 
-            # Chunk the file
+        # Chunk the file
+        with profiler.stage("chunk") as stage:
             chunk_size = 1024
             chunks = []
             file_stream = BytesIO(file_content)  # Create a file-like object from the downloaded content
@@ -96,57 +371,386 @@ def proccess_file(file_name: str, owner_id: UUID, owner_type: OwnershipType, fil
                     break
                 # Process the chunk
                 chunks.append(chunk)
+            stage["bytes"] = len(file_content)
+            stage["chunks"] = len(chunks)
 
-            # Create embeddings for the chunks and associate them
-            for chunk in chunks:
-                # Create embedding for the chunk
-                embedding = embedding_model.encode(chunk).tolist()  # Convert to list for JSON serialization
-                # Create a new chunk object
-                new_chunk = Chunks(
-                    id=uuid.uuid4(),
-                    chunk=chunk,
-                    embedding=embedding
-                )
-                # Add the chunk to the document
-                file.chunks.append(new_chunk)
-                # Add the chunk to the database
-                session.add(new_chunk)
+        chunk_ids = [chunk_id(file_id, i) for i in range(len(chunks))]
+        if stored - set(chunk_ids):
+            # random chunk ids: ingested in full before ingests were resumable
+            return {"document_id": str(file_id), "status": "already_ingested"}
+        pending = [(new_chunk_id, chunk) for new_chunk_id, chunk in zip(chunk_ids, chunks)
+                   if new_chunk_id not in stored]
+
+        for start in range(0, len(pending), INGEST_COMMIT_CHUNKS):
+            batch = pending[start:start + INGEST_COMMIT_CHUNKS]
+            with session.begin() as transaction:
+                file = lock_document(session, file_name, file_id)
+                # stored meanwhile by a run that went ahead without the ingest lock
+                committed = set(session.scalars(
+                    select(Chunks.id).where(Chunks.owner_id == owner_id,
+                                            Chunks.id.in_([new_chunk_id for new_chunk_id, _ in batch]))
+                ))
+                batch = [item for item in batch if item[0] not in committed]
+                if batch:
+                    store_chunks(profiler, session, file, owner_id, batch)
+                    # db_flush stops short of the commit, which waits on the WAL flush
+                    with profiler.stage("db_commit") as stage:
+                        transaction.commit()
+                        stage["chunks"] = len(batch)
 
+        with session.begin():
+            file = lock_document(session, file_name, file_id)
             # Associate the file with the owner
-            if owner_type == "user":
-                owner.documents.append(file)
-            elif owner_type == "organization":
-                owner.documents.append(file)
+            load_owner(session, owner_id, owner_type).documents.append(file)
+            # written last, the document counts as ingested from here on
+            file.ingest_profile = profiler.as_dict()
+    return {"document_id": str(file_id), "status": "ingested", "chunks": len(pending), "skipped": len(stored)}
+
+# a run that finds its file locked by another one tries again after this long
+INGEST_LOCK_RETRY_SECONDS = 30
+INGEST_MAX_RETRIES = 10
+
+# acks_late with reject_on_worker_lost redelivers the file when the worker dies
+# mid-ingest; the file lock and the document's row lock keep reruns from
+# ingesting it twice
+@celery.task(bind=True, base=IngestTask, acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(OperationalError,), retry_backoff=True, max_retries=INGEST_MAX_RETRIES)
+def proccess_file(self, file_name: str, owner_id: UUID, owner_type: OwnershipType, file_id: UUID,
+                  size: Optional[int] = None):
+    """
+    Process the file and return a short status record.
+    Each stage is profiled; the profile is stored on the document and sent
+    as a `task-ingest-profile` event.
+    `size` is set for uploads that went through admission control.
+    """
+    lock = acquire_ingest_lock(file_id)
+    if lock is None:
+        raise self.retry(countdown=INGEST_LOCK_RETRY_SECONDS)
+    profiler = IngestProfiler()
+    try:
+        result = ingest_document(profiler, file_name, owner_id, owner_type, file_id)
+    finally:
+        release_ingest_lock(file_id, lock)
+
+    # eager runs (tests, benchmarks) have no worker to publish events from
+    if result["status"] == "ingested" and not self.request.is_eager:
+        self.send_event("task-ingest-profile", document_id=str(file_id), profile=profiler.as_dict())
+
+    # keep the owner's searches on the primary until replicas have the new chunks,
+    # before retiring their cached results: a search in between would cache
+    # what a replica still has under the new version
+    read_router.mark_write(owner_id)
+    bump_owner_version(owner_id)
+    return result
+
+@celery.task(ignore_result=True)
+def drain_deferred_uploads():
+    """
+    Queues the oldest deferred upload of each owner with nothing in flight.
+    Their backlog is normally drained as their ingests finish, this picks up
+    the ones left behind when that never happens: a worker died before
+    after_return, or the in-flight counters expired.
+    """
+    for owner_id in deferred_owners():
+        deferred = take_deferred(owner_id, idle_only=True)
+        if not deferred:
+            continue
+        try:
+            proccess_file.apply_async(kwargs=deferred["kwargs"])
+        except Exception as e:
+            logger.warning("Could not queue deferred upload of owner %s: %s", owner_id, e)
+            release_upload(owner_id, deferred["size"])
+            # back where it was, ahead of the uploads deferred after it
+            defer_upload(owner_id, deferred["size"], deferred["kwargs"], front=True)
 
-@celery.task
+# owners with more chunks than this are deleted by purge_owner instead of in the request
+PURGE_ASYNC_MIN_CHUNKS = 50000
+PURGE_DOCUMENT_BATCH = 100
+PURGE_CHUNK_BATCH = 10000
+# delete_objects accepts at most 1000 keys per call
+S3_DELETE_BATCH = 1000
+
+def delete_s3_objects(keys: List[str]):
+    """
+    Deletes the keys from the documents bucket with bulk delete_objects calls.
+    """
+    for i in range(0, len(keys), S3_DELETE_BATCH):
+        get_s3_client().delete_objects(
+            Bucket=S3_BUCKET_NAME,
+            Delete={"Objects": [{"Key": key} for key in keys[i:i + S3_DELETE_BATCH]], "Quiet": True}
+        )
+
+def owner_document_filter(owner_id: UUID, owner_type: OwnershipType):
+    """
+    Documents removed along with the owner. Deleting an organization also
+    deletes its users, so their documents are included.
+    """
+    if owner_type == OwnershipType.user:
+        return Document.user_id == owner_id
+    return (Document.organization_id == owner_id) | \
+        Document.user_id.in_(select(User.id).where(User.organization_id == owner_id))
+
+def owner_chunks_exceed(session: Session, owner_id: UUID, owner_type: OwnershipType,
+                        limit: int = PURGE_ASYNC_MIN_CHUNKS) -> bool:
+    """
+    Whether the owner has more than `limit` chunks, reading at most
+    limit + 1 of them rather than counting them all.
+    """
+    chunks = (
+        select(literal(1))
+        .select_from(Chunks)
+        .join(Document, Chunks.document_id == Document.id)
+        .where(owner_document_filter(owner_id, owner_type))
+        .limit(limit + 1)
+        .subquery()
+    )
+    return session.scalar(select(func.count()).select_from(chunks)) > limit
+
+def start_purge(owner_id: UUID, owner_type: OwnershipType) -> AsyncResult:
+    """
+    Queues purge_owner for the owner, or returns the purge already queued
+    for it, so a retried delete doesn't start a second one.
+    """
+    task_id = uuid.uuid4().hex
+    running = claim_purge(owner_id, task_id)
+    if running is not None:
+        return purge_owner.AsyncResult(running)
+    try:
+        return purge_owner.apply_async((owner_id, owner_type), task_id=task_id)
+    except Exception:
+        release_purge(owner_id, task_id)
+        raise
+
+@celery.task(bind=True, priority=PRIORITY_LOW)
+def purge_owner(self, owner_id: UUID, owner_type: OwnershipType):
+    """
+    Deletes a user or organization with everything they own in small
+    transactions: chunks in batches, the documents' S3 objects in bulk,
+    then the documents and finally the owner row, whose remaining children
+    go through ON DELETE CASCADE. Owners with a partition of their own lose
+    their chunks with it up front. Progress is reported through the task state.
+    """
+    try:
+        return _purge_owner(self, owner_id, OwnershipType(owner_type))
+    finally:
+        release_purge(owner_id, self.request.id)
+
+def _purge_owner(self, owner_id: UUID, owner_type: OwnershipType) -> dict:
+    document_filter = owner_document_filter(owner_id, owner_type)
+    with Session(engine) as session:
+        total_documents = session.scalar(
+            select(func.count(Document.id)).where(document_filter)
+        )
+        # cached searches of everyone removed here have to be retired
+        affected_owners = [owner_id]
+        if owner_type == OwnershipType.organization:
+            affected_owners += session.scalars(
+                select(User.id).where(User.organization_id == owner_id)
+            ).all()
+
+    purged_documents = 0
+    purged_chunks = drop_owner_partitions(engine, affected_owners)
+    while True:
+        with Session(engine) as session:
+            document_ids = session.scalars(
+                select(Document.id).where(document_filter).limit(PURGE_DOCUMENT_BATCH)
+            ).all()
+        if not document_ids:
+            break
+
+        while True:
+            with Session(engine) as session:
+                with session.begin():
+                    deleted = session.execute(
+                        delete(Chunks).where(Chunks.id.in_(
+                            select(Chunks.id)
+                            .where(Chunks.document_id.in_(document_ids))
+                            .limit(PURGE_CHUNK_BATCH)
+                        )).execution_options(synchronize_session=False)
+                    ).rowcount
+            purged_chunks += deleted
+            if deleted < PURGE_CHUNK_BATCH:
+                break
+
+        delete_s3_objects([str(document_id) for document_id in document_ids])
+        with Session(engine) as session:
+            with session.begin():
+                session.execute(
+                    delete(Document).where(Document.id.in_(document_ids))
+                    .execution_options(synchronize_session=False)
+                )
+        purged_documents += len(document_ids)
+
+        self.update_state(state="PROGRESS", meta={
+            "documents": purged_documents,
+            "total_documents": total_documents,
+            "chunks": purged_chunks,
+        })
+
+    owner_model = User if owner_type == OwnershipType.user else Organization
+    with Session(engine) as session:
+        with session.begin():
+            session.execute(
+                delete(owner_model).where(owner_model.id == owner_id)
+                .execution_options(synchronize_session=False)
+            )
+
+    owner_kind = "user" if owner_type == OwnershipType.user else "organization"
+    identity_cache.invalidate(owner_kind, owner_id)
+    for affected_owner in affected_owners:
+        bump_owner_version(affected_owner)
+        if affected_owner != owner_id:
+            identity_cache.invalidate("user", affected_owner)
+    return {"documents": purged_documents, "chunks": purged_chunks}
+
+@celery.task(priority=PRIORITY_LOW, ignore_result=True, autoretry_for=(OperationalError,),
+             retry_backoff=True, max_retries=10)
+def drop_partitions(owner_ids: List[UUID]):
+    """
+    Drops the partitions deleted owners leave behind, empty by the time
+    this runs. Retried while chunks is too busy to take the lock, so the
+    delete route doesn't have to wait for it.
+    """
+    drop_owner_partitions(engine, owner_ids)
+
+# chunks encoded and written per transaction, and streamed per server-side cursor
+REEMBED_BATCH = 512
+REEMBED_WINDOW = 20000
+# pause between batches, and while ingest has more than REEMBED_MAX_INGEST_DEPTH files waiting
+REEMBED_PAUSE_SECONDS = 0.05
+REEMBED_MAX_INGEST_DEPTH = 20
+REEMBED_BACKOFF_SECONDS = 5
+
+def reembed_throttle():
+    time.sleep(REEMBED_PAUSE_SECONDS)
+    while (ingest_queue_depth() or 0) > REEMBED_MAX_INGEST_DEPTH:
+        time.sleep(REEMBED_BACKOFF_SECONDS)
+
+@celery.task(bind=True, priority=PRIORITY_LOW)
+def reembed_chunks(self, model_name: str):
+    """
+    Re-embeds every chunk with `model_name` into a new generation column,
+    then switches searches over to it. Progress is checkpointed on the
+    generation row after every batch, so running the task again for the
+    same model resumes where it stopped. New ingests write the new column
+    too while the job runs.
+    """
+    model = get_embedding_model(model_name)
+    generation = start_generation(engine, model_name, model.get_sentence_embedding_dimension())
+    if generation.state == "active":
+        return {"generation": generation.id, "state": "active"}
+    build_missing_index(engine, generation)
+
+    with Session(engine) as session:
+        row = session.get(EmbeddingGeneration, generation.id)
+        checkpoint, chunks_done = row.checkpoint_id, row.chunks_done
+
+    column = embedding_column(generation)
+    while True:
+        stmt = select(Chunks.id, Chunks.chunk).where(column.is_(None))
+        if checkpoint is not None:
+            stmt = stmt.where(Chunks.id > checkpoint)
+        streamed = 0
+        # a fresh cursor per window keeps the reading transaction short
+        with engine.connect() as conn:
+            rows = conn.execution_options(stream_results=True, yield_per=REEMBED_BATCH).execute(
+                stmt.order_by(Chunks.id).limit(REEMBED_WINDOW)
+            )
+            for batch in rows.partitions():
+                chunk_ids = [row.id for row in batch]
+                with observe_embedding("reembed"):
+                    vectors = model.encode([row.chunk for row in batch], batch_size=REEMBED_BATCH)
+                with Session(engine) as session, session.begin():
+                    write_vectors(session, generation, chunk_ids, vectors)
+                    session.execute(
+                        update(EmbeddingGeneration)
+                        .where(EmbeddingGeneration.id == generation.id)
+                        .values(checkpoint_id=chunk_ids[-1], chunks_done=EmbeddingGeneration.chunks_done + len(chunk_ids))
+                    )
+                checkpoint = chunk_ids[-1]
+                chunks_done += len(chunk_ids)
+                streamed += len(chunk_ids)
+                self.update_state(state="PROGRESS", meta={"generation": generation.id, "chunks_done": chunks_done})
+                reembed_throttle()
+        if streamed < REEMBED_WINDOW:
+            break
+
+    # chunks ingested before the generation existed may sit behind the
+    # checkpoint, fill them before taking the lock in activate_generation
+    with Session(engine) as session, session.begin():
+        fill_missing_vectors(session, generation, model, REEMBED_BATCH)
+    build_generation_index(engine, generation)
+    activate_generation(engine, generation, model, REEMBED_BATCH)
+    return {"generation": generation.id, "state": "active", "chunks_done": chunks_done}
+
+@celery.task(priority=PRIORITY_LOW)
 def fake_task_remote():
     time.sleep(20)
     return "Fake task completed"
 
-@celery.task
-def respond_to_message(message_id: UUID, conversation_id: UUID, response: str):
+# answers a message's query a token at a time, e.g. a streaming model
+# client. Until one is set, posted messages aren't answered and keep a
+# NULL response
+RESPONSE_GENERATOR: Optional[Callable[[str], Iterator[str]]] = None
+
+def answers_messages() -> bool:
+    return RESPONSE_GENERATOR is not None
+
+def generate_response_tokens(response: str):
     """
-    Respond to a message in a conversation.
+    Yields a response whose text is already known a token at a time, for
+    callers that pass it in, e.g. the benchmarks. Whitespace is kept with
+    the preceding word.
     """
+    for token in re.findall(r"\s*\S+\s*|\s+", response):
+        yield token
+
+# progress goes through the message's stream, nobody polls the result
+@celery.task(priority=PRIORITY_HIGH, ignore_result=True)
+def respond_to_message(message_id: UUID, conversation_id: UUID, response: Optional[str] = None):
+    """
+    Respond to a message in a conversation, with `response` when given and
+    otherwise with what RESPONSE_GENERATOR produces for its query.
+    Tokens are published to the message's Redis stream as they are produced,
+    and the full response is persisted once generation finishes.
+    """
+    if response is None and RESPONSE_GENERATOR is None:
+        raise RuntimeError("No response generator is configured")
+    with Session(engine) as session:
+        # Ensure the message_id is in the database
+        message = session.scalar(
+            select(Message).where(Message.id == message_id)
+        )
+        if not message:
+            raise FileNotFoundError(f"Message {message_id} not found in database")
+
+        # Ensure the conversation_id is in the database
+        conversation = session.scalar(
+            select(Conversation).where(Conversation.id == conversation_id)
+        )
+        if not conversation:
+            raise FileNotFoundError(f"Conversation {conversation_id} not found in database")
+        user_id = conversation.user_id
+        query = message.query
+
+    # no transaction is held open while tokens are produced
+    tokens = []
+    produced = generate_response_tokens(response) if response is not None else RESPONSE_GENERATOR(query)
+    for token in produced:
+        publish_token(message_id, token)
+        tokens.append(token)
+
     with Session(engine) as session:
         with session.begin():
-            # Ensure the message_id is in the database
             message = session.scalar(
                 select(Message).where(Message.id == message_id)
             )
             if not message:
                 raise FileNotFoundError(f"Message {message_id} not found in database")
-            
-            # Ensure the conversation_id is in the database
-            conversation = session.scalar(
-                select(Conversation).where(Conversation.id == conversation_id)
-            )
-            if not conversation:
-                raise FileNotFoundError(f"Conversation {conversation_id} not found in database")
-            
+
             # Update the message with the response
-            message.response = response
+            message.response = "".join(tokens)
             message.response_at = datetime.now(timezone.utc)
-            session.add(message)
-            session.commit()
-            session.refresh(message)
\ No newline at end of file
+
+    read_router.mark_write(user_id)
+    publish_done(message_id)
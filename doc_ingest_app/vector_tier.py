@@ -0,0 +1,248 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from .cache import CacheStats, get_owner_versions
+from .generations import Generation, embedding_column
+from .models.sql_models import Chunks, Document
+
+logger = logging.getLogger(__name__)
+
+
+# ("user" | "organization", owner id)
+OwnerKey = Tuple[str, UUID]
+# (chunk id, document id, l2 distance)
+Hit = Tuple[UUID, UUID, float]
+
+# rough per-row cost of the id arrays next to the matrix
+ROW_OVERHEAD_BYTES = 120
+LOAD_BATCH_ROWS = 10000
+
+
+class OwnerVectors:
+    """
+    One owner's chunk embeddings as a contiguous matrix, with the ids needed
+    to turn row numbers back into chunks and the per-document chunk counts
+    used to refresh it incrementally.
+    """
+    def __init__(self, generation: Generation, version: int, chunk_ids: np.ndarray, document_ids: np.ndarray,
+                 matrix: np.ndarray, doc_counts: Dict[UUID, int]):
+        self.generation = generation
+        self.version = version
+        self.chunk_ids = chunk_ids
+        self.document_ids = document_ids
+        self.matrix = matrix
+        # ||x||^2 per row, so distances only need one matmul
+        self.norms = np.einsum("ij,ij->i", matrix, matrix, dtype=np.float32)
+        self.doc_counts = doc_counts
+        self.last_used = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.norms.nbytes + len(self.chunk_ids) * ROW_OVERHEAD_BYTES
+
+    def top_k(self, queries: np.ndarray, k: int) -> List[List[Hit]]:
+        rows = len(self.chunk_ids)
+        if not rows:
+            return [[] for _ in queries]
+        k = min(k, rows)
+        # ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2, the first term doesn't change the order
+        scores = self.norms[None, :] - 2 * (queries.astype(self.matrix.dtype) @ self.matrix.T).astype(np.float32)
+        if k < rows:
+            candidates = np.argpartition(scores, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(rows), (len(queries), rows))
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        hits = []
+        for i, row_ids in enumerate(candidates):
+            ordered = row_ids[np.argsort(scores[i, row_ids])]
+            distances = np.sqrt(np.maximum(scores[i, ordered] + query_norms[i], 0))
+            hits.append([
+                (self.chunk_ids[j], self.document_ids[j], float(distance))
+                for j, distance in zip(ordered, distances)
+            ])
+        return hits
+
+
+def owner_filter(owner: OwnerKey):
+    kind, owner_id = owner
+    if kind == "user":
+        return Document.user_id == owner_id
+    return Document.organization_id == owner_id
+
+
+class HotVectorTier:
+    """
+    In-memory copies of the chunk embeddings of the owners searched most,
+    answering top-k with a matmul instead of a pgvector scan.
+
+    An owner becomes hot after `min_searches` searches within `window`
+    seconds and is then loaded in the background. Entries are tagged with
+    the owner's data version (see cache.get_owner_versions); once it moves,
+    searches fall back to SQL until the background refresh has reloaded the
+    documents whose chunks changed, or all of them when another embedding
+    generation became active. Least recently used owners are evicted to
+    stay within `memory_budget` bytes.
+    """
+    def __init__(self, engine_getter, memory_budget: int, dtype=np.float32,
+                 min_searches: int = 20, window: float = 300.0):
+        self.engine_getter = engine_getter
+        self.memory_budget = memory_budget
+        self.dtype = np.dtype(dtype)
+        self.min_searches = min_searches
+        self.window = window
+        self.entries: Dict[OwnerKey, OwnerVectors] = {}
+        self.stats = CacheStats()
+        self._searches: Dict[OwnerKey, Tuple[float, int]] = {}
+        self._pending = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hot-vectors")
+
+    def search(self, owners: Sequence[OwnerKey], generation: Generation, versions: Optional[Sequence[int]],
+               queries: Sequence[Sequence[float]], k: int) -> Optional[List[List[Hit]]]:
+        """
+        Top-k hits per query over all the owners' chunks, or None when any of
+        them isn't loaded at its current version and in the generation the
+        queries were encoded for, and the caller should use SQL.
+        """
+        if versions is None:
+            return None
+        entries = []
+        for owner, version in zip(owners, versions):
+            entry = self._current_entry(owner, generation, version)
+            if entry is None:
+                self.stats.record(False)
+                return None
+            entries.append(entry)
+        self.stats.record(True)
+
+        query_matrix = np.asarray(queries, dtype=np.float32)
+        per_owner = [entry.top_k(query_matrix, k) for entry in entries]
+        return [
+            sorted((hit for hits in owner_hits for hit in hits), key=lambda hit: hit[2])[:k]
+            for owner_hits in zip(*per_owner)
+        ]
+
+    def _current_entry(self, owner: OwnerKey, generation: Generation, version: int) -> Optional[OwnerVectors]:
+        entry = self.entries.get(owner)
+        if entry is not None and entry.generation == generation and entry.version == version:
+            entry.last_used = time.monotonic()
+            return entry
+        if entry is not None or self._is_hot(owner):
+            self._schedule(owner, generation)
+        return None
+
+    def _is_hot(self, owner: OwnerKey) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            started, count = self._searches.get(owner, (now, 0))
+            if now - started > self.window:
+                started, count = now, 0
+            self._searches[owner] = (started, count + 1)
+            return count + 1 >= self.min_searches
+
+    def _schedule(self, owner: OwnerKey, generation: Generation) -> None:
+        with self._lock:
+            if owner in self._pending:
+                return
+            self._pending.add(owner)
+        self._executor.submit(self._load, owner, generation)
+
+    def _load(self, owner: OwnerKey, generation: Generation) -> None:
+        try:
+            versions = get_owner_versions(owner[1])
+            if versions is None:
+                return
+            with Session(self.engine_getter()) as session:
+                entry = self._refreshed(session, owner, generation, versions[0], self.entries.get(owner))
+            if entry.nbytes > self.memory_budget:
+                logger.info("Owner %s needs %s bytes, more than the hot tier budget", owner, entry.nbytes)
+                self.entries.pop(owner, None)
+                return
+            self._make_room(entry.nbytes, keep=owner)
+            self.entries[owner] = entry
+        except Exception as e:
+            logger.warning("Could not load hot vectors for %s: %s", owner, e)
+        finally:
+            with self._lock:
+                self._pending.discard(owner)
+
+    def _refreshed(self, session: Session, owner: OwnerKey, generation: Generation, version: int,
+                   entry: Optional[OwnerVectors]) -> OwnerVectors:
+        if entry is not None and entry.generation != generation:
+            # vectors of another model can't be mixed in
+            entry = None
+        doc_counts = dict(session.execute(
+            select(Chunks.document_id, func.count())
+            .join(Document, Chunks.document_id == Document.id)
+            .where(Chunks.owner_id == owner[1], owner_filter(owner))
+            .group_by(Chunks.document_id)
+        ).all())
+        old_counts = entry.doc_counts if entry is not None else {}
+        # chunks of a document never change in place, so only added, removed or
+        # still ingesting documents need their rows replaced
+        changed = {
+            document_id for document_id in doc_counts.keys() | old_counts.keys()
+            if doc_counts.get(document_id) != old_counts.get(document_id)
+        }
+        reload = [document_id for document_id in changed if document_id in doc_counts]
+
+        chunk_ids = [np.empty(0, dtype=object)]
+        document_ids = [np.empty(0, dtype=object)]
+        blocks = [np.empty((0, generation.dim), dtype=self.dtype)]
+        if entry is not None:
+            keep = np.fromiter((document_id not in changed for document_id in entry.document_ids),
+                               dtype=bool, count=len(entry.document_ids))
+            chunk_ids.append(entry.chunk_ids[keep])
+            document_ids.append(entry.document_ids[keep])
+            blocks.append(entry.matrix[keep])
+
+        for start in range(0, len(reload), 1000):
+            rows = session.execute(
+                select(Chunks.id, Chunks.document_id, embedding_column(generation).label("embedding"))
+                .where(Chunks.owner_id == owner[1], Chunks.document_id.in_(reload[start:start + 1000]))
+                .execution_options(yield_per=LOAD_BATCH_ROWS)
+            )
+            for batch in rows.partitions():
+                chunk_ids.append(np.array([row.id for row in batch], dtype=object))
+                document_ids.append(np.array([row.document_id for row in batch], dtype=object))
+                blocks.append(np.asarray([row.embedding for row in batch], dtype=self.dtype))
+
+        return OwnerVectors(
+            generation,
+            version,
+            np.concatenate(chunk_ids),
+            np.concatenate(document_ids),
+            np.ascontiguousarray(np.vstack(blocks)),
+            doc_counts,
+        )
+
+    def _make_room(self, needed: int, keep: OwnerKey) -> None:
+        with self._lock:
+            used = sum(entry.nbytes for owner, entry in self.entries.items() if owner != keep)
+            for owner, entry in sorted(list(self.entries.items()), key=lambda item: item[1].last_used):
+                if used + needed <= self.memory_budget:
+                    break
+                if owner == keep:
+                    continue
+                del self.entries[owner]
+                used -= entry.nbytes
+
+    def status(self) -> dict:
+        entries = list(self.entries.items())
+        return {
+            **self.stats.as_dict(),
+            "memory_budget": self.memory_budget,
+            "memory_used": sum(entry.nbytes for _, entry in entries),
+            "owners": [
+                {"kind": kind, "owner_id": str(owner_id), "chunks": len(entry.chunk_ids), "bytes": entry.nbytes}
+                for (kind, owner_id), entry in entries
+            ],
+        }
@@ -0,0 +1,118 @@
+import logging
+import time
+from threading import Thread
+from typing import Callable, List, Tuple
+
+from sqlalchemy import text
+
+
+logger = logging.getLogger(__name__)
+
+
+def _warm_embedding_model():
+    from .embeddings import get_embedding_model
+    from .generations import active_generation
+    # the first encode initializes torch kernels, do it before a user's query does
+    get_embedding_model(active_generation().model_name).encode(["warm up"])
+
+
+def _warm_database():
+    from . import dependencies
+    with dependencies.engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+
+def _warm_redis():
+    from . import cache
+    cache.redis_client.ping()
+
+
+def _warm_s3():
+    from .storage import S3_BUCKET_NAME, get_s3_client
+    get_s3_client().head_bucket(Bucket=S3_BUCKET_NAME)
+
+
+# (name, step, whether the app is unready without it)
+WARMUP_STEPS: List[Tuple[str, Callable[[], None], bool]] = [
+    ("database", _warm_database, True),
+    ("embedding_model", _warm_embedding_model, True),
+    ("redis", _warm_redis, False),
+    ("s3", _warm_s3, False),
+]
+
+
+class WarmupState:
+    """
+    Startup phases and warm-up steps with their timings. The app is ready
+    once every critical step has finished.
+    """
+    def __init__(self):
+        self.process_started = time.perf_counter()
+        self.timings = {}
+        self.steps = {name: "pending" for name, _, _ in WARMUP_STEPS}
+        self.errors = {}
+        self.ready_after = None
+
+    def record(self, phase: str, seconds: float):
+        self.timings[phase] = seconds
+
+    @property
+    def ready(self) -> bool:
+        return all(self.steps[name] == "done" for name, _, critical in WARMUP_STEPS if critical)
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "steps": self.steps,
+            "errors": self.errors,
+            "timings_s": self.timings,
+            "time_to_ready_s": self.ready_after,
+        }
+
+
+state = WarmupState()
+
+
+# failed critical steps are retried, e.g. when Postgres comes up after the app,
+# waiting twice as long each round up to the maximum
+WARMUP_RETRY_SECONDS = 1.0
+WARMUP_MAX_RETRY_SECONDS = 30.0
+
+
+def _run_step(name: str, step: Callable[[], None]) -> None:
+    state.steps[name] = "running"
+    start = time.perf_counter()
+    try:
+        step()
+    except Exception as e:
+        state.steps[name] = "failed"
+        state.errors[name] = str(e)
+        logger.warning("Warm-up step %s failed: %s", name, e)
+    else:
+        state.steps[name] = "done"
+        state.errors.pop(name, None)
+    state.record(f"warmup.{name}", time.perf_counter() - start)
+
+
+def run_warmup():
+    for name, step, _ in WARMUP_STEPS:
+        _run_step(name, step)
+
+    delay = WARMUP_RETRY_SECONDS
+    while not state.ready:
+        time.sleep(delay)
+        delay = min(delay * 2, WARMUP_MAX_RETRY_SECONDS)
+        for name, step, critical in WARMUP_STEPS:
+            if critical and state.steps[name] != "done":
+                _run_step(name, step)
+
+    state.ready_after = time.perf_counter() - state.process_started
+    logger.info("Startup timings: %s", state.as_dict())
+
+
+def start_warmup():
+    """
+    Runs the warm-up steps on a background thread so the server starts
+    accepting requests (and liveness probes) immediately.
+    """
+    Thread(target=run_warmup, name="warmup", daemon=True).start()
@@ -0,0 +1,141 @@
+import uuid
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+# fakeredis runs the Lua scripts through lupa
+pytest.importorskip("lupa")
+
+from doc_ingest_app import admission, cache
+from doc_ingest_app.admission import (
+    DEFERRED_OWNERS_KEY, INFLIGHT_BYTES_KEY, OWNER_DEFERRED_KEY, OWNER_INFLIGHT_BYTES_KEY, OWNER_INFLIGHT_FILES_KEY,
+    admit_upload, defer_upload, deferred_owners, release_upload, take_deferred,
+)
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(cache, "redis_client", client)
+    return client
+
+
+@pytest.fixture
+def owner_id():
+    return uuid.uuid4()
+
+
+def inflight(client, owner_id) -> tuple:
+    values = client.mget(INFLIGHT_BYTES_KEY, OWNER_INFLIGHT_BYTES_KEY.format(owner_id),
+                         OWNER_INFLIGHT_FILES_KEY.format(owner_id))
+    return tuple(int(value or 0) for value in values)
+
+
+def test_admit_reserves_and_release_hands_back(redis_client, owner_id):
+    assert admit_upload(owner_id, 100, queue_depth=0).decision == "enqueue"
+    assert inflight(redis_client, owner_id) == (100, 100, 1)
+
+    assert release_upload(owner_id, 100)
+    assert inflight(redis_client, owner_id) == (0, 0, 0)
+
+
+def test_release_with_file_id_happens_once(redis_client, owner_id):
+    file_id = uuid.uuid4()
+    admit_upload(owner_id, 100, queue_depth=0)
+    admit_upload(owner_id, 50, queue_depth=0)
+
+    assert release_upload(owner_id, 100, file_id)
+    assert not release_upload(owner_id, 100, file_id)
+    assert inflight(redis_client, owner_id) == (50, 50, 1)
+
+
+def test_release_never_goes_negative(redis_client, owner_id):
+    release_upload(owner_id, 100)
+    assert inflight(redis_client, owner_id) == (0, 0, 0)
+
+
+def test_rejects_over_global_budget(redis_client, owner_id, monkeypatch):
+    monkeypatch.setattr(admission, "INGEST_MAX_INFLIGHT_BYTES", 150)
+    admit_upload(owner_id, 100, queue_depth=0)
+    decision = admit_upload(uuid.uuid4(), 100, queue_depth=0)
+    assert (decision.decision, decision.reason) == ("reject", "inflight_bytes")
+    assert decision.retry_after == admission.UPLOAD_RETRY_AFTER_SECONDS
+
+
+def test_rejects_deep_queue_without_redis_call(redis_client, owner_id):
+    decision = admit_upload(owner_id, 100, queue_depth=admission.INGEST_MAX_QUEUE_DEPTH)
+    assert (decision.decision, decision.reason) == ("reject", "queue_depth")
+    assert inflight(redis_client, owner_id) == (0, 0, 0)
+
+
+def test_defers_beyond_owner_share(redis_client, owner_id, monkeypatch):
+    monkeypatch.setattr(admission, "OWNER_MAX_INFLIGHT_FILES", 1)
+    admit_upload(owner_id, 100, queue_depth=0)
+    decision = admit_upload(owner_id, 100, queue_depth=0)
+    assert (decision.decision, decision.reason) == ("defer", "fair_share")
+    # deferring reserves nothing until the upload is taken
+    assert inflight(redis_client, owner_id) == (100, 100, 1)
+
+
+def test_single_file_larger_than_share_goes_through(redis_client, owner_id, monkeypatch):
+    monkeypatch.setattr(admission, "OWNER_MAX_INFLIGHT_BYTES", 10)
+    assert admit_upload(owner_id, 100, queue_depth=0).decision == "enqueue"
+    assert admit_upload(owner_id, 1, queue_depth=0).decision == "defer"
+
+
+def test_rejects_full_backlog(redis_client, owner_id, monkeypatch):
+    monkeypatch.setattr(admission, "OWNER_MAX_INFLIGHT_FILES", 1)
+    monkeypatch.setattr(admission, "OWNER_MAX_DEFERRED", 1)
+    admit_upload(owner_id, 100, queue_depth=0)
+    defer_upload(owner_id, 100, {"file_id": "a"})
+    decision = admit_upload(owner_id, 100, queue_depth=0)
+    assert (decision.decision, decision.reason) == ("reject", "owner_backlog")
+
+
+def test_backlog_waits_behind_inflight_uploads(redis_client, owner_id):
+    admit_upload(owner_id, 100, queue_depth=0)
+    defer_upload(owner_id, 100, {"file_id": "a"})
+    # within the owner's share, but the backlog goes first
+    assert admit_upload(owner_id, 1, queue_depth=0).decision == "defer"
+
+
+def test_take_deferred_reserves_in_order(redis_client, owner_id):
+    defer_upload(owner_id, 10, {"file_id": "a"})
+    defer_upload(owner_id, 20, {"file_id": "b"})
+    assert deferred_owners() == [str(owner_id)]
+
+    assert take_deferred(owner_id) == {"size": 10, "kwargs": {"file_id": "a"}}
+    assert inflight(redis_client, owner_id) == (10, 10, 1)
+    assert take_deferred(owner_id)["kwargs"] == {"file_id": "b"}
+    assert inflight(redis_client, owner_id) == (30, 30, 2)
+
+
+def test_take_deferred_forgets_drained_owner(redis_client, owner_id):
+    defer_upload(owner_id, 10, {"file_id": "a"})
+    take_deferred(owner_id)
+    assert deferred_owners() == [str(owner_id)]
+
+    assert take_deferred(owner_id) is None
+    assert deferred_owners() == []
+    assert not redis_client.exists(OWNER_DEFERRED_KEY.format(owner_id))
+
+
+def test_idle_only_take_waits_for_inflight(redis_client, owner_id):
+    admit_upload(owner_id, 100, queue_depth=0)
+    defer_upload(owner_id, 10, {"file_id": "a"})
+
+    assert take_deferred(owner_id, idle_only=True) is None
+    assert redis_client.sismember(DEFERRED_OWNERS_KEY, str(owner_id))
+    release_upload(owner_id, 100)
+    assert take_deferred(owner_id, idle_only=True)["kwargs"] == {"file_id": "a"}
+
+
+def test_defer_to_front_keeps_backlog_order(redis_client, owner_id):
+    defer_upload(owner_id, 10, {"file_id": "a"})
+    defer_upload(owner_id, 20, {"file_id": "b"})
+    taken = take_deferred(owner_id)
+    release_upload(owner_id, taken["size"])
+    defer_upload(owner_id, taken["size"], taken["kwargs"], front=True)
+
+    assert take_deferred(owner_id)["kwargs"] == {"file_id": "a"}
+    assert take_deferred(owner_id)["kwargs"] == {"file_id": "b"}
@@ -0,0 +1,239 @@
+import io
+import queue
+import struct
+import threading
+import uuid
+
+import orjson
+import pytest
+
+from doc_ingest_app import bulk
+from doc_ingest_app.bulk import (
+    CHUNK_COLUMNS, DOCUMENT_COLUMNS, ExportCancelled, _copy_text, _FrameReader, _FrameWriter, _load_staging,
+    _RecordReader,
+)
+
+COPY_ESCAPES = {"\\": "\\", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def parse_copy_text(data: bytes) -> list:
+    """
+    Rows of COPY's text format, as Postgres reads what _RecordReader writes.
+    """
+    rows = []
+    for line in data.decode().split("\n")[:-1]:
+        row = []
+        for field in line.split("\t"):
+            if field == "\\N":
+                row.append(None)
+                continue
+            value, i = [], 0
+            while i < len(field):
+                if field[i] == "\\":
+                    value.append(COPY_ESCAPES[field[i + 1]])
+                    i += 2
+                else:
+                    value.append(field[i])
+                    i += 1
+            row.append("".join(value))
+        rows.append(row)
+    return rows
+
+
+def ndjson(*records: dict) -> list:
+    return [orjson.dumps(record) + b"\n" for record in records]
+
+
+def document(file_name="report.pdf", **fields) -> dict:
+    return {"type": "document", "id": str(uuid.uuid4()), "file_name": file_name,
+            "user_id": str(uuid.uuid4()), "organization_id": None, "ingest_profile": None, **fields}
+
+
+def chunk(document_id: str, text="some text", embedding=None) -> dict:
+    return {"type": "chunk", "id": str(uuid.uuid4()), "document_id": document_id, "chunk": text,
+            "embedding": embedding if embedding is not None else [0.5, -1.25, 3.0]}
+
+
+class CopyingCursor:
+    """
+    Stands in for a psycopg2 cursor: copy_expert reads the file the way
+    psycopg2 does and keeps what each COPY received.
+    """
+    def __init__(self, read_size: int = 8192):
+        self.read_size = read_size
+        self.copied = []
+
+    def copy_expert(self, sql: str, file) -> None:
+        data = bytearray()
+        while True:
+            block = file.read(self.read_size)
+            if not block:
+                break
+            data += block
+        self.copied.append((sql, bytes(data)))
+
+
+@pytest.mark.parametrize("value", [
+    "plain",
+    "tab\there",
+    "line\nbreak",
+    "carriage\rreturn",
+    "back\\slash",
+    "\\N",
+    "\\\\n mixed \t\n\r",
+    "unicode ünïcødé 文件.pdf",
+    "",
+])
+def test_copy_text_round_trips_strings(value):
+    assert parse_copy_text(_copy_text(value) + b"\n") == [[value]]
+
+
+def test_copy_text_writes_null_marker():
+    assert _copy_text(None) == b"\\N"
+    assert parse_copy_text(_copy_text(None) + b"\n") == [[None]]
+
+
+def test_copy_text_formats_vectors_and_json():
+    assert _copy_text([0.5, -1.25, 3.0]) == b"[0.5,-1.25,3.0]"
+    profile = {"stages": {"embed": {"wall_ms": 1.5}}, "note": "tab\tinside"}
+    (value,), = parse_copy_text(_copy_text(profile) + b"\n")
+    assert orjson.loads(value) == profile
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 8192, -1])
+def test_record_reader_round_trips_documents(read_size):
+    documents = [
+        document("tab\tand\nnewline\\.pdf"),
+        document("quarterly \\N report.pdf", ingest_profile={"total_wall_ms": 12.5}),
+        document("org.pdf", user_id=None, organization_id=str(uuid.uuid4())),
+    ]
+    reader = _RecordReader(iter(ndjson(*documents)), "document", DOCUMENT_COLUMNS)
+    data = bytearray()
+    while True:
+        block = reader.read(read_size)
+        if not block:
+            break
+        data += block
+
+    rows = parse_copy_text(bytes(data))
+    assert [row[:4] for row in rows] == [
+        [record["id"], record["file_name"], record["user_id"], record["organization_id"]] for record in documents
+    ]
+    assert rows[0][4] is None
+    assert orjson.loads(rows[1][4]) == {"total_wall_ms": 12.5}
+    assert reader.pending is None
+
+
+def test_record_reader_skips_blank_lines():
+    record = document()
+    lines = [b"\n", *ndjson(record), b"   \n"]
+    rows = parse_copy_text(_RecordReader(iter(lines), "document", DOCUMENT_COLUMNS).read())
+    assert [row[0] for row in rows] == [record["id"]]
+
+
+def test_record_reader_stops_at_next_section():
+    record = document()
+    first_chunk = chunk(record["id"])
+    lines = iter(ndjson(record, first_chunk))
+    documents = _RecordReader(lines, "document", DOCUMENT_COLUMNS)
+    assert [row[0] for row in parse_copy_text(documents.read())] == [record["id"]]
+    assert orjson.loads(documents.pending) == first_chunk
+
+    chunks = _RecordReader(lines, "chunk", CHUNK_COLUMNS, pending=documents.pending)
+    assert parse_copy_text(chunks.read()) == [
+        [first_chunk["id"], record["id"], first_chunk["chunk"], "[0.5,-1.25,3.0]"]
+    ]
+
+
+def test_load_staging_copies_both_sections():
+    record = document("name\twith\ttabs.pdf")
+    chunks = [chunk(record["id"], "first\nline"), chunk(record["id"], "second")]
+    cursor = CopyingCursor(read_size=5)
+    _load_staging(cursor, io.BytesIO(b"".join(ndjson(record, *chunks))), binary=False)
+
+    (document_sql, document_data), (chunk_sql, chunk_data) = cursor.copied
+    assert document_sql.startswith("COPY import_document")
+    assert parse_copy_text(document_data)[0][1] == "name\twith\ttabs.pdf"
+    assert chunk_sql.startswith("COPY import_chunks")
+    assert [row[2] for row in parse_copy_text(chunk_data)] == ["first\nline", "second"]
+
+
+def test_load_staging_rejects_document_after_chunks():
+    record = document()
+    stray = document()
+    stream = io.BytesIO(b"".join(ndjson(record, chunk(record["id"]), stray)))
+    with pytest.raises(ValueError, match="after its chunks"):
+        _load_staging(CopyingCursor(), stream, binary=False)
+
+
+def test_load_staging_rejects_unknown_record_type():
+    record = document()
+    stream = io.BytesIO(b"".join(ndjson(record, {"type": "message", "id": str(uuid.uuid4())})))
+    with pytest.raises(ValueError, match="after its chunks"):
+        _load_staging(CopyingCursor(), stream, binary=False)
+
+
+def drain_frames(frames: queue.Queue) -> bytes:
+    data = bytearray()
+    while not frames.empty():
+        data += frames.get_nowait()
+    return bytes(data)
+
+
+def write_sections(sections: list, frame_bytes: int, monkeypatch) -> bytes:
+    monkeypatch.setattr(bulk, "COPY_FRAME_BYTES", frame_bytes)
+    frames = queue.Queue()
+    writer = _FrameWriter(frames, threading.Event())
+    for section in sections:
+        for i in range(0, len(section), 3):
+            writer.write(section[i:i + 3])
+        writer.end_section()
+    return drain_frames(frames)
+
+
+def read_all(reader, read_size: int) -> bytes:
+    data = bytearray()
+    while True:
+        block = reader.read(read_size)
+        if not block:
+            return bytes(data)
+        data += block
+
+
+@pytest.mark.parametrize("frame_bytes", [1, 4, 64 * 1024])
+@pytest.mark.parametrize("read_size", [1, 5, -1])
+def test_frames_round_trip(frame_bytes, read_size, monkeypatch):
+    sections = [b"PGCOPY\n\xff\r\n\x00" + bytes(range(256)) * 3, b"", b"\x00\x00\x00\x00second section"]
+    stream = io.BytesIO(write_sections(sections, frame_bytes, monkeypatch) + b"trailing")
+    assert [read_all(_FrameReader(stream), read_size) for _ in sections] == sections
+    assert stream.read() == b"trailing"
+
+
+def test_frame_writer_ends_sections_with_empty_frame(monkeypatch):
+    data = write_sections([b"abc"], 64 * 1024, monkeypatch)
+    assert data == struct.pack(">I", 3) + b"abc" + struct.pack(">I", 0)
+
+
+@pytest.mark.parametrize("cut", [2, 4, 6, 7])
+def test_frame_reader_rejects_truncated_stream(cut, monkeypatch):
+    # length prefix, data and the end-of-section frame each cut short
+    data = write_sections([b"abc"], 64 * 1024, monkeypatch)
+    with pytest.raises(ValueError, match="truncated"):
+        read_all(_FrameReader(io.BytesIO(data[:cut])), -1)
+
+
+def test_load_staging_reads_binary_sections(monkeypatch):
+    sections = [b"documents" * 100, b"chunks" * 100]
+    cursor = CopyingCursor(read_size=10)
+    _load_staging(cursor, io.BytesIO(write_sections(sections, 16, monkeypatch)), binary=True)
+    assert [data for _, data in cursor.copied] == sections
+
+
+def test_frame_writer_gives_up_once_cancelled():
+    frames = queue.Queue(maxsize=1)
+    cancelled = threading.Event()
+    writer = _FrameWriter(frames, cancelled)
+    writer.put(b"fills the queue")
+    cancelled.set()
+    with pytest.raises(ExportCancelled):
+        writer.put(b"nobody reads this")